@@ -2,13 +2,16 @@ import io
 import os
 import json
 import pprint
-import html5lib
 
-from requests.compat import urljoin, unquote, quote
+from six.moves.urllib.parse import urljoin, unquote, quote
 
 import blackboard
 from blackboard import logger, ParserError, BlackboardSession
-from blackboard.datatable import fetch_datatable
+from blackboard.datatable import stream_datatable
+from blackboard.dwr import dwr_get_groups
+from blackboard.trace import traced
+from blackboard.htmlparser import parse_response
+from blackboard.fragments import parse_fragments, element_attributes
 from blackboard.elementtext import (
     element_to_markdown, element_text_content, form_field_value,
     html_to_markdown)
@@ -22,18 +25,21 @@ except ImportError:
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
+# The elements of the grade attempt page read by fetch_attempt
+ATTEMPT_FRAGMENTS = (
+    'currentAttempt', 'submissionTextView', 'currentAttempt_comments',
+    'currentAttempt_submissionList', 'currentAttempt_grade', 'feedbacktext',
+    'gradingNotestext', 'feedbackFiles_table_body',
+)
 
+
+@traced
 def is_course_id_valid(session, course_id=None):
     if course_id is None:
         course_id = session.course_id
-    url = (
-        'https://bb.au.dk/webapps/blackboard/execute/' +
-        'courseMain?course_id=%s' % course_id)
+    url = session.url('course_main', course_id=course_id)
     response = session.get(url)
-    document = html5lib.parse(response.content, encoding=response.encoding)
-
-    content_panel_path = './/h:div[@id="contentPanel"]'
-    content_panel = document.find(content_panel_path, NS)
+    content_panel = element_attributes(response, 'contentPanel')
     if content_panel is None:
         logger.debug("is_course_id_valid: No contentPanel")
         return True
@@ -41,15 +47,12 @@ def is_course_id_valid(session, course_id=None):
     return 'error' not in classes
 
 
+@traced
 def fetch_overview(session):
     """Fetch gradebook information. Returns (assignments, students)."""
     assert isinstance(session, BlackboardSession)
-    url = (
-        'https://bb.au.dk/webapps/gradebook/do/instructor/getJSONData' +
-        '?course_id=%s' % session.course_id)
-    l = blackboard.slowlog()
+    url = session.url('gradebook')
     response = session.get(url)
-    l("Fetching gradebook took %.1f s")
     try:
         o = response.json()
     except JSONDecodeError:
@@ -103,27 +106,23 @@ def fetch_overview(session):
     return assignments, users
 
 
+@traced
 def fetch_attempt(session, attempt_id, is_group_assignment):
     assert isinstance(session, BlackboardSession)
     if is_group_assignment:
-        url = ('https://bb.au.dk/webapps/assignment/' +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&groupAttemptId=%s' % attempt_id)
+        url = session.url('group_attempt', attempt_id=attempt_id)
     else:
-        url = ('https://bb.au.dk/webapps/assignment/' +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&attempt_id=%s' % attempt_id)
-    l = blackboard.slowlog()
+        url = session.url('attempt', attempt_id=attempt_id)
     response = session.get(url)
-    l("Fetching attempt took %.1f s")
-    document = html5lib.parse(response.content, encoding=response.encoding)
+    rubric_input_id = '%s_rubricEvaluation' % attempt_id
+    document = parse_fragments(
+        response, ATTEMPT_FRAGMENTS + (rubric_input_id,),
+        required=('currentAttempt',))
 
     currentAttempt_container = document.find(
         './/h:div[@id="currentAttempt"]', NS)
     if currentAttempt_container is None:
-        raise blackboard.ParserError('No <div id="currentAttempt">')
+        raise blackboard.ParserError('No <div id="currentAttempt">', response)
 
     submission_text = document.find(
         './/h:div[@id="submissionTextView"]', NS)
@@ -232,7 +231,7 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
     rubric_data = None
     if is_group_assignment:
         rubric_input = document.find(
-            './/h:input[@id="%s_rubricEvaluation"]' % attempt_id, NS)
+            './/h:input[@id="%s"]' % rubric_input_id, NS)
         if rubric_input is not None:
             rubric_data_str = form_field_value(rubric_input)
             try:
@@ -267,21 +266,86 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
     )
 
 
+def assignment_bundle_form(document):
+    """
+    Find the downloadAssignment form in the parsed document and return
+    its action and the fields to post to download the attempts of all
+    students, or None if there is no such form.
+
+    >>> from blackboard.htmlparser import parse_html
+    >>> document = parse_html(
+    ...     b'<form action="search"><input name="q"></form>'
+    ...     b'<form action="downloadAssignment" method="post">'
+    ...     b'<input type="hidden" name="outcome_definition_id" value="_5_1">'
+    ...     b'<input type="checkbox" name="students_to_export" value="_1_1"'
+    ...     b' checked><input type="checkbox" name="students_to_export"'
+    ...     b' value="_2_1"><input type="radio" name="downloadOption"'
+    ...     b' value="LAST"><input type="submit" name="bottom_Submit">'
+    ...     b'</form>')
+    >>> action, data = assignment_bundle_form(document)
+    >>> action
+    'downloadAssignment'
+    >>> data  # doctest: +NORMALIZE_WHITESPACE
+    [('outcome_definition_id', '_5_1'), ('students_to_export', '_1_1'),
+     ('students_to_export', '_2_1'), ('downloadOption', 'ALL')]
+    >>> assignment_bundle_form(parse_html(b'<p>Nothing here</p>')) is None
+    True
+    """
+    student_input = './/h:input[@name="students_to_export"]'
+    for form in document.findall('.//h:form', NS):
+        if form.find(student_input, NS) is not None:
+            break
+    else:
+        return
+    data = []
+    for field in form.findall('.//h:input[@name]', NS):
+        input_type = (field.get('type') or 'text').lower()
+        if input_type == 'radio' or input_type == 'submit':
+            continue
+        # Select all students, regardless of whether they are checked.
+        data.append((field.get('name'), form_field_value(field)))
+    data.append(('downloadOption', 'ALL'))
+    return form.get('action'), data
+
+
+@traced
+def fetch_assignment_bundle(session, assignment_id, fp):
+    """
+    Download all attempts of the given assignment as a single ZIP file
+    (the "Download assignment" feature of the Grade Centre)
+    and write it to the binary file object fp.
+    """
+    assert isinstance(session, BlackboardSession)
+    url = session.url('download_assignment', assignment_id=assignment_id)
+    response = session.get(url)
+    form = assignment_bundle_form(parse_response(response))
+    if form is None:
+        raise ParserError("No <form> with students_to_export", response)
+    action, data = form
+    post_url = urljoin(response.url, action)
+    response = session.post(post_url, data)
+    document = parse_response(response)
+    download_link = None
+    for a in document.findall('.//h:a[@href]', NS):
+        if '.zip' in a.get('href'):
+            download_link = urljoin(response.url, a.get('href'))
+            break
+    if download_link is None:
+        raise ParserError("No link to ZIP file after downloadAssignment",
+                          response)
+    session.download(download_link, fp)
+
+
+@traced
 def fetch_rubric(session, assoc_id, rubric_object):
     rubric_id = rubric_object['id']
     rubric_title = rubric_object['title']
     prefix = 'BBFETCH'
-    url = (
-        'https://bb.au.dk/webapps/rubric/do/course/gradeRubric' +
-        '?mode=grid&isPopup=true&rubricCount=1&prefix=%s' % prefix +
-        '&course_id=%s' % session.course_id +
-        '&maxValue=1.0&rubricId=%s' % rubric_id +
-        '&viewOnly=false&displayGrades=true&type=grading' +
-        '&rubricAssoId=%s' % assoc_id)
-    l = blackboard.slowlog()
+    url = session.url('rubric', prefix=prefix, rubric_id=rubric_id,
+                      assoc_id=assoc_id)
     response = session.get(url)
-    l("Fetching attempt rubric took %.1f s")
-    document = html5lib.parse(response.content, encoding=response.encoding)
+    table_id = '%s_rubricGradingTable' % prefix
+    document = parse_fragments(response, (table_id,), required=(table_id,))
 
     def is_desc(div_element):
         classes = (div_element.get('class') or '').split()
@@ -289,8 +353,9 @@ def fetch_rubric(session, assoc_id, rubric_object):
                 'radioLabel' not in classes and
                 'feedback' not in classes)
 
-    table = document.find(
-        './/h:table[@id="%s_rubricGradingTable"]' % prefix, NS)
+    table = document.find('.//h:table[@id="%s"]' % table_id, NS)
+    if table is None:
+        raise ParserError("No <table id=%s>" % table_id, response)
 
     column_headers = list(map(
         element_text_content, table.findall('./h:thead/h:tr/h:th', NS)[1:]))
@@ -330,22 +395,18 @@ def fetch_rubric(session, assoc_id, rubric_object):
                 columns=column_headers, rows=rubric_rows)
 
 
+@traced
 def submit_grade(session, attempt_id, is_group_assignment,
                  grade, text, filenames, rubrics):
     assert isinstance(session, BlackboardSession)
     if is_group_assignment:
-        url = ('https://bb.au.dk/webapps/assignment/' +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&groupAttemptId=%s' % attempt_id)
+        url = session.url('group_attempt', attempt_id=attempt_id)
     else:
-        url = ('https://bb.au.dk/webapps/assignment/' +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&attempt_id=%s' % attempt_id)
+        url = session.url('attempt', attempt_id=attempt_id)
     # We need to fetch the page to get the nonce
     response = session.get(url)
-    document = html5lib.parse(response.content, encoding=response.encoding)
+    form_id = 'currentAttempt_form'
+    document = parse_fragments(response, (form_id,), required=(form_id,))
     form = document.find('.//h:form[@id="currentAttempt_form"]', NS)
     if form is None:
         raise ParserError("No <form id=currentAttempt_form>", response)
@@ -412,11 +473,9 @@ def submit_grade(session, attempt_id, is_group_assignment,
             fdata = fp.read()
         files.append(('feedbackFiles_LocalFile%d' % i, (base, fdata)))
     if is_group_assignment:
-        post_url = (
-            'https://bb.au.dk/webapps/assignment//gradeGroupAssignment/submit')
+        post_url = session.url('submit_group_grade')
     else:
-        post_url = (
-            'https://bb.au.dk/webapps/assignment//gradeAssignment/submit')
+        post_url = session.url('submit_grade')
     if not files:
         # Blackboard requires the POST to be
         # Content-Type: multipart/form-data.
@@ -428,7 +487,7 @@ def submit_grade(session, attempt_id, is_group_assignment,
     except:
         logger.exception("data=%r files=%r", data, files)
         raise
-    document = html5lib.parse(response.content, encoding=response.encoding)
+    document = parse_response(response)
     badmsg = document.find('.//h:span[@id="badMsg1"]', NS)
     if badmsg is not None:
         raise ParserError(
@@ -444,12 +503,15 @@ def submit_grade(session, attempt_id, is_group_assignment,
     logger.debug("goodMsg1: %s", element_text_content(msg))
 
 
-def fetch_groups(session):
+@traced
+def fetch_groups(session, edit_mode=True):
     """
     Computes a mapping from usernames (au123) to dictionaries,
     each dictionary containing the first/last name, role and group
     memberships of the particular user.
     The 'groups' entry is a list of (name, group id) pairs.
+    The list only has the groups in edit mode, which is switched to
+    unless edit_mode is false (see BlackboardSession.set_edit_mode).
     """
     def strip_prefix(s, prefix):
         if s.startswith(prefix):
@@ -471,13 +533,12 @@ def fetch_groups(session):
             res.append((name, strip_prefix(i, 'rmv_')))
         return res
 
-    url = ('https://bb.au.dk/webapps/bb-group-mgmt-LEARN/execute/' +
-           'groupInventoryList?course_id=%s' % session.course_id +
-           '&toggleType=users&chkAllRoles=on')
+    url = session.url('group_list')
 
-    response, keys, rows = fetch_datatable(
+    rows = stream_datatable(
         session, url, extract=extract, table_id='userGroupList_datatable',
-        edit_mode=True)
+        edit_mode=edit_mode)
+    keys = rows.keys
     username = keys.index('userorgroupname')
     first_name = keys.index('firstname')
     last_name = keys.index('lastname')
@@ -499,3 +560,79 @@ def fetch_groups(session):
             groups=row[groups],
         )
     return users
+
+
+@traced
+def fetch_groups_dwr(session, students, previous):
+    """
+    Computes the same mapping as fetch_groups from the group memberships
+    that GradebookDWRFacade.getGroups returns (see dwr_get_groups),
+    which takes a single request instead of the paged group list.
+
+    getGroups only returns the user ids of the members of each group,
+    so usernames and names are taken from the gradebook students
+    (a dictionary by user id), and group names and roles from the
+    mapping previously returned by fetch_groups. Users that are not in
+    the gradebook keep their previous entry.
+    Returns None if a group or a student is not in the previous mapping,
+    in which case fetch_groups must be used instead.
+    """
+    group_names = {}
+    for user in previous.values():
+        for name, group_id in user['groups']:
+            group_names[group_id] = name
+    memberships = {}
+    for group_id, members in dwr_get_groups(session):
+        if group_id not in group_names:
+            logger.debug("Group %s is not in the group list", group_id)
+            return None
+        for user_id in members:
+            memberships.setdefault(str(user_id), []).append(
+                (group_names[group_id], group_id))
+    if memberships and not any(u in students for u in memberships):
+        # The user ids are not those of the gradebook
+        logger.debug("No group member is in the gradebook")
+        return None
+    users = {}
+    for user_id, student in students.items():
+        username = student['username']
+        try:
+            prev = previous[username]
+        except KeyError:
+            logger.debug("User %s is not in the group list", username)
+            return None
+        groups = memberships.get(user_id, [])
+        # Keep the order of the group list, which decides how groups
+        # are displayed (see Grading.get_student_group_display).
+        order = {g[1]: i for i, g in enumerate(prev['groups'])}
+        groups.sort(key=lambda g: order.get(g[1], len(order)))
+        users[username] = dict(
+            username=username,
+            first_name=student['first_name'],
+            last_name=student['last_name'],
+            role=prev['role'],
+            groups=groups,
+        )
+    for username, user in previous.items():
+        users.setdefault(username, user)
+    return users
+
+
+def compare_groups(expected, actual):
+    """
+    Return the usernames whose group memberships differ between two
+    mappings returned by fetch_groups or fetch_groups_dwr.
+
+    >>> a = {'au1': dict(groups=[('G1', '1')]), 'au2': dict(groups=[])}
+    >>> b = {'au1': dict(groups=[['G1', '1']]), 'au3': dict(groups=[])}
+    >>> compare_groups(a, b)
+    ['au2', 'au3']
+    """
+    def group_ids(users, username):
+        try:
+            return set(g[1] for g in users[username]['groups'])
+        except KeyError:
+            return None
+
+    return sorted(u for u in set(expected) | set(actual)
+                  if group_ids(expected, u) != group_ids(actual, u))
@@ -38,21 +38,8 @@ class BadAuth(Exception):
     pass
 
 
-def slowlog(threshold=2):
-    t1 = time.time()
-
-    def report(msg, *args, **kwargs):
-        t2 = time.time()
-        t = t2 - t1
-        if t > threshold:
-            if kwargs:
-                kwargs['t'] = t
-                logger.debug(msg, kwargs)
-            else:
-                args += (t,)
-                logger.debug(msg, *args)
-
-    return report
+class NoCredentials(Exception):
+    """Raised instead of asking for a username or password."""
 
 
 def configure_logging(quiet):
@@ -77,6 +64,12 @@ def wrapper(fun):
     parser.add_argument('--course')
     parser.add_argument('--cookiejar', default='cookies.txt')
     parser.add_argument('--session-class', default='BlackboardSession')
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--trace', metavar='FILE')
+    parser.add_argument('--base-url', metavar='URL')
+    parser.add_argument('--record', metavar='FILE')
+    parser.add_argument('--replay', metavar='FILE')
+    parser.add_argument('--replay-latency', type=float, default=0.0)
     args = parser.parse_args()
     configure_logging(quiet=args.quiet)
 
@@ -96,6 +89,12 @@ def wrapper(fun):
         raise
 
     session = session_class(args.cookiejar, args.username, args.course)
+    if args.base_url:
+        session.endpoints.base_url = args.base_url
+    if args.record:
+        session.record_fixtures(args.record)
+    elif args.replay:
+        session.replay_fixtures(args.replay, latency=args.replay_latency)
     try:
         fun(session)
     except ParserError as exn:
@@ -105,6 +104,11 @@ def wrapper(fun):
         print("Bad username or password. Forgetting password.")
         session.forget_password()
     session.save_cookies()
+    if args.stats:
+        session.tracer.print_stats()
+    if args.trace:
+        session.tracer.save(args.trace)
+    session.close()
 
 
 class Serializable:
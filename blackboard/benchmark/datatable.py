@@ -0,0 +1,119 @@
+"""
+Time the text extraction from the cells of a datatable.
+
+Extracts the text of every cell of the userGroupList_datatable (the
+group membership list that fetch_groups reads) in the pages of fixture
+archives recorded with `grading --record` (see blackboard.fixtures),
+or plain .html files. Without files, the page is generated with the
+mock server's markup (see blackboard.mockserver) with --rows rows.
+
+The text is extracted with the recursive implementation that
+element_text_content used to have, with element_text_content for each
+cell, with row_text_content for each row and with parse_datatable,
+and the results are checked to be the same.
+Run it with `python -m blackboard.benchmark.datatable [ARCHIVE...]`.
+"""
+
+import time
+import argparse
+import collections
+
+from blackboard.htmlparser import parse_html, NS
+from blackboard.elementtext import (
+    element_hidden, element_text_content, row_text_content,
+)
+from blackboard.datatable import parse_datatable
+from blackboard.benchmark.parsers import iter_pages
+
+
+def reference_text_content(element):
+    """element_text_content as it was before it was made iterative."""
+
+    def visit(e):
+        if not element_hidden(e):
+            yield e.text or ''
+            for c in e:
+                yield ''.join(visit(c))
+            yield e.tail or ''
+
+    return ' '.join(''.join(visit(element)).split())
+
+
+def iter_tables(filenames, table_id, rows):
+    """Yield (name, table element) of the tables to extract."""
+    if not filenames:
+        from blackboard.mockserver import SyntheticCourse
+        course = SyntheticCourse(students=rows, assignments=0)
+        content = course.group_list_page(0, rows)
+        filenames = [('synthetic %d rows' % rows, content, 'utf-8')]
+    else:
+        filenames = [page for filename in filenames
+                     for page in iter_pages(filename)]
+    for name, content, encoding in filenames:
+        document = parse_html(content, encoding)
+        table = document.find('.//h:table[@id="%s"]' % table_id, NS)
+        if table is not None:
+            yield name, document, table
+
+
+def timed(fn, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='*',
+                        help='Fixture archive or HTML file')
+    parser.add_argument('--table-id', default='userGroupList_datatable')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='Rows of the generated page (without files)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    times = collections.OrderedDict()
+    tables = cells = 0
+    for name, document, table in iter_tables(
+            args.filename, args.table_id, args.rows):
+        tables += 1
+        rows = table.findall('./h:tbody/h:tr', NS)
+        cells += sum(len(row) for row in rows)
+        results = collections.OrderedDict()
+        methods = collections.OrderedDict([
+            ('reference', lambda: [[reference_text_content(cell)
+                                    for cell in row] for row in rows]),
+            ('element_text_content', lambda: [[element_text_content(cell)
+                                               for cell in row]
+                                              for row in rows]),
+            ('row_text_content', lambda: [row_text_content(row)
+                                          for row in rows]),
+            ('parse_datatable', lambda: parse_datatable(
+                None, document, table_id=args.table_id)[1]),
+        ])
+        for method, fn in methods.items():
+            t, results[method] = timed(fn, args.repeat)
+            times[method] = times.get(method, 0) + t
+        expected = results.pop('reference')
+        for method, result in results.items():
+            if method == 'parse_datatable':
+                # parse_datatable only returns the cells that have a key
+                expected_ = [row[:len(r)] for row, r in zip(expected, result)]
+            else:
+                expected_ = expected
+            if result != expected_:
+                raise SystemExit("%s: %s differs from the reference" %
+                                 (name, method))
+    if not tables:
+        raise SystemExit("No table with id %r" % args.table_id)
+    print("%d tables, %d cells" % (tables, cells))
+    for method, t in times.items():
+        print("%-20s %8.1f ms" % (method, t * 1000))
+
+
+if __name__ == "__main__":
+    main()
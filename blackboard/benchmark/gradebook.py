@@ -0,0 +1,318 @@
+"""
+Measure how the offline gradebook operations scale with the course size.
+
+Generates synthetic courses (the `_students`/`_assignments` gradebook
+payload, the group memberships and `attempt_state` of a grading.json)
+with 100, 1000 and 10000 students, and times:
+
+* print_gradebook (with the output discarded)
+* get_attempts and get_attempts(needs_grading=True, needs_download=True)
+* attempt_keys: Gradebook.get_attempt_keys as used by refresh_attempts
+* save: Grading.save to a temporary grading.json
+* load: Grading.load of that file
+* deserialize: Grading.deserialize of the already parsed JSON
+
+No network access is needed. The results are printed as a table and
+can be saved as JSON with --output. With --compare, the results are
+compared to a previous --output file, and the benchmark fails if an
+operation got slower by more than --threshold.
+
+Run it with `python -m blackboard.benchmark.gradebook`.
+"""
+
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import collections
+
+from blackboard import BlackboardSession
+from blackboard.grading import Grading
+from blackboard.mockserver import FIRST_NAMES, LAST_NAMES
+
+
+COURSE_ID = '_1234_1'
+
+
+class BenchmarkGrading(Grading):
+    """A Grading configured like a typical course script."""
+
+    username = 'au100000'
+    course = COURSE_ID
+    student_group_display_regex = (r'Gruppe (\S+) - (\S+)', r'\1-\2')
+    assignment_name_display_regex = (r'Aflevering (\d+)', r'\1')
+    classes = ('Hold 1', 'Hold 2')
+    positive_list = ()
+    negative_list = ()
+    attempt_directory_name = None
+    # Don't touch the download store when loading
+    download_store = None
+
+
+def make_course(students, assignments=14, max_attempts=3, classes=4,
+                group_size=3, seed=0):
+    """
+    Return the payload of a grading.json for a synthetic course.
+
+    >>> o = make_course(students=10, assignments=2)
+    >>> len(o['gradebook']['_students']), len(o['gradebook']['_assignments'])
+    (10, 2)
+    >>> sorted(len(g['groups']) for g in o['groups'].values())[0]
+    2
+    """
+    rng = random.Random(seed)
+    next_id = [100000]
+
+    def new_id():
+        next_id[0] += 1
+        return str(next_id[0])
+
+    assignment_data = collections.OrderedDict()
+    for k in range(assignments):
+        aid = new_id()
+        assignment_data[aid] = dict(
+            id=aid, name='Aflevering %d' % (k + 1),
+            src='resource/x-bb-assignment', groupActivity=k % 2 == 1,
+            due=1599480000000 + k * 7 * 86400000, points=1, pos=k,
+            vis=True, gbvis=True, manual=False, type='N')
+
+    # Every student is on a class (Hold) and in a handin group within it
+    users = collections.OrderedDict()
+    groups = {}
+    group_of = {}
+    class_ids = [new_id() for c in range(classes)]
+    group_ids = {}
+    for i in range(students):
+        uid = '_%s_1' % new_id()
+        username = 'au%06d' % (500000 + i)
+        c = i % classes
+        g = (i // classes) // group_size + 1
+        if (c, g) not in group_ids:
+            group_ids[c, g] = new_id()
+        group_name = 'Gruppe %d - %02d' % (c + 1, g)
+        group_of[uid] = group_ids[c, g], group_name
+        users[uid] = dict(
+            first_name=rng.choice(FIRST_NAMES),
+            last_name=rng.choice(LAST_NAMES), username=username,
+            student_number='2020%05d' % i, last_access=1599480000000,
+            id=uid, available=True, assignments={})
+        groups[username] = dict(
+            username=username, first_name=users[uid]['first_name'],
+            last_name=users[uid]['last_name'], role='Student',
+            groups=[['Hold %d' % (c + 1), class_ids[c]],
+                    [group_name, group_ids[c, g]]])
+
+    attempt_state = {}
+    group_attempts = {}
+    for uid, user in users.items():
+        for aid, a in assignment_data.items():
+            if a['groupActivity']:
+                gid, group_name = group_of[uid]
+                if (gid, aid) not in group_attempts:
+                    group_attempts[gid, aid] = [
+                        new_id() for i in range(rng.randint(0, max_attempts))]
+                attempt_ids = group_attempts[gid, aid]
+            else:
+                group_name = None
+                attempt_ids = [new_id()
+                               for i in range(rng.randint(0, max_attempts))]
+            attempts = []
+            for i, attempt_id in enumerate(attempt_ids):
+                latest = i == len(attempt_ids) - 1
+                graded = not latest or rng.random() < 0.7
+                score = float(rng.randint(0, 1)) if graded else 0.0
+                status = None if graded else 'ng'
+                group_attempt_id = '_%s_1' % attempt_id
+                attempts.append(dict(
+                    date='0%d/09/20' % (i + 1), exempt=False,
+                    groupAttemptId=group_attempt_id if group_name else None,
+                    groupName=group_name, groupScore=score,
+                    groupStatus=status, id='_%s_1' % new_id(),
+                    override=False, score=score, status=status))
+                key = (group_attempt_id if group_name
+                       else attempts[-1]['id'] + 'I')
+                if key in attempt_state or rng.random() < 0.5:
+                    continue
+                attempt_state[key] = dict(
+                    directory='/nonexistent/A%s/%s' % (aid, attempt_id),
+                    submission='Her er min aflevering.\n' * 5,
+                    comments=None, feedback='', grading_notes='',
+                    feedbackfiles=[], score=score if graded else None,
+                    files=[dict(filename='handin%d.pdf' % j,
+                                download_link='https://bb.au.dk/' +
+                                'bbcswebdav/xid-%s_1' % new_id())
+                           for j in range(rng.randint(1, 3))],
+                    downloads={})
+            needs_grading = bool(attempts) and attempts[-1]['status'] == 'ng'
+            user['assignments'][aid] = dict(
+                score=attempts[-1]['score'] if attempts else '',
+                needs_grading=needs_grading, attempts=attempts)
+
+    gradebook = collections.OrderedDict([
+        ('_students', users), ('fetch_time', 1599480000.0),
+        ('_assignments', assignment_data)])
+    return collections.OrderedDict([
+        ('attempt_state', attempt_state), ('gradebook', gradebook),
+        ('username', BenchmarkGrading.username), ('groups', groups),
+        ('rubrics', {})])
+
+
+def timed(fn, repeat):
+    """Run fn repeat times. Returns the list of durations in seconds."""
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def run(students, repeat, directory, **kwargs):
+    """
+    Time the operations on a synthetic course of the given size.
+    Returns a dict mapping each operation to its list of durations.
+    """
+    payload = make_course(students, **kwargs)
+    filename = os.path.join(directory, 'grading-%d.json' % students)
+    session = BlackboardSession(os.path.join(directory, 'cookies.txt'),
+                                BenchmarkGrading.username, COURSE_ID)
+    grading = BenchmarkGrading(session)
+    grading.deserialize(json.loads(json.dumps(payload)))
+    grading.filename = filename
+
+    def print_gradebook():
+        with open(os.devnull, 'w') as fp:
+            with contextlib.redirect_stdout(fp):
+                grading.print_gradebook()
+
+    def get_attempts_todo():
+        grading.get_attempts(needs_grading=True, needs_download=True)
+
+    def attempt_keys():
+        grading.gradebook.get_attempt_keys(
+            student_visible=grading.get_student_visible, refresh_all=True)
+
+    def load():
+        BenchmarkGrading(session).load(filename, refresh=False)
+
+    parsed = []
+
+    def deserialize():
+        BenchmarkGrading(session).deserialize(parsed.pop())
+
+    results = collections.OrderedDict()
+    results['print_gradebook'] = timed(print_gradebook, repeat)
+    results['get_attempts'] = timed(grading.get_attempts, repeat)
+    results['get_attempts_todo'] = timed(get_attempts_todo, repeat)
+    results['attempt_keys'] = timed(attempt_keys, repeat)
+    results['save'] = timed(grading.save, repeat)
+    results['load'] = timed(load, repeat)
+    with open(filename) as fp:
+        data = fp.read()
+    # deserialize() modifies its argument, so give each run a fresh copy
+    parsed.extend(json.loads(data)['payload'] for i in range(repeat))
+    results['deserialize'] = timed(deserialize, repeat)
+    results['size'] = len(data)
+    return results
+
+
+def summarize(times):
+    times = sorted(times)
+    return collections.OrderedDict([
+        ('best', times[0]), ('median', times[len(times) // 2]),
+        ('runs', len(times))])
+
+
+def compare(results, baseline, threshold, file=None):
+    """
+    Print the change of each best time relative to baseline.
+    Returns the (students, operation) pairs that got slower by more
+    than the fraction threshold.
+
+    >>> import sys
+    >>> r = {'100': {'save': {'best': 0.3}, 'load': {'best': 0.1}}}
+    >>> b = {'100': {'save': {'best': 0.2}, 'load': {'best': 0.1}}}
+    >>> compare(r, b, 0.25, file=sys.stdout)
+    100 save: 200.0 ms -> 300.0 ms (+50%)
+    100 load: 100.0 ms -> 100.0 ms (+0%)
+    [('100', 'save')]
+    """
+    regressions = []
+    for n, ops in results.items():
+        for op, r in ops.items():
+            try:
+                before = baseline[n][op]['best']
+            except (KeyError, TypeError):
+                continue
+            change = r['best'] / before - 1 if before else 0
+            print("%s %s: %.1f ms -> %.1f ms (%+.0f%%)" %
+                  (n, op, before * 1000, r['best'] * 1000, change * 100),
+                  file=file)
+            if change > threshold:
+                regressions.append((n, op))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--students', default='100,1000,10000',
+                        help='Comma-separated course sizes')
+    parser.add_argument('--assignments', type=int, default=14)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='FILE',
+                        help='Save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare with results saved by --output')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='With --compare, fail if an operation is ' +
+                        'this fraction slower than before')
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.students.split(',')]
+    results = collections.OrderedDict()
+    directory = tempfile.mkdtemp(prefix='bbfetch-benchmark-')
+    try:
+        for n in sizes:
+            r = run(n, args.repeat, directory, assignments=args.assignments,
+                    max_attempts=args.max_attempts, seed=args.seed)
+            size = r.pop('size')
+            results[str(n)] = collections.OrderedDict(
+                (op, summarize(times)) for op, times in r.items())
+            print("%d students (grading.json %.1f MiB)" %
+                  (n, size / 1024**2))
+            for op, s in results[str(n)].items():
+                print("  %-18s %9.1f ms  (median %.1f ms)" %
+                      (op, s['best'] * 1000, s['median'] * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        o = collections.OrderedDict([
+            ('time', time.time()),
+            ('python', platform.python_version()),
+            ('assignments', args.assignments),
+            ('max_attempts', args.max_attempts),
+            ('seed', args.seed),
+            ('results', results),
+        ])
+        with open(args.output, 'w') as fp:
+            json.dump(o, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Slower than %s: %s" % (args.compare, ', '.join(
+                '%s %s' % r for r in regressions)))
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Check that element_to_markdown agrees with html2text, and compare
+their speed.
+
+Finds the submission texts, comments and forum post bodies in the HTML
+pages of fixture archives recorded with `grading --record` (see
+blackboard.fixtures), or of plain .html files, converts each of them
+with element_to_markdown and with html2text, and reports the ones on
+which the two differ. Run it with
+`python -m blackboard.benchmark.markdown ARCHIVE...`.
+
+Some differences are kept on purpose and removed by normalize before
+the outputs are compared:
+
+* element_to_markdown does not wrap lines, so html2text is run without
+  wrapping (element_to_markdown used to wrap at 78 columns).
+* Code blocks are fenced with ``` rather than indented by four spaces,
+  so that code that starts or ends with blank lines is kept.
+* Text is not escaped (html2text writes e.g. `1\\.` and `\\-` at the
+  start of a line), since the Markdown is read as plain text.
+* html2text indents top-level lists by two spaces, puts no space
+  before the | between table cells, puts a space between emphasis and
+  the punctuation after it, and adds trailing spaces and blank lines
+  that do not change the Markdown.
+
+html2text puts the second paragraph of a list item after the list
+instead of in the item. element_to_markdown keeps it in the item, but
+since that cannot be told apart from a paragraph after the list in the
+output of html2text, it is reported as a difference.
+"""
+
+import re
+import time
+import difflib
+import argparse
+
+from blackboard.htmlparser import parse_html
+from blackboard.elementtext import element_to_markdown, element_to_html
+from blackboard.benchmark.parsers import iter_pages
+
+
+NS = {'h': 'http://www.w3.org/1999/xhtml'}
+
+# The elements that are converted to Markdown
+# (see blackboard.backend.fetch_attempt and blackboard.example.forum)
+ELEMENTS = (
+    ('submission', './/h:div[@id="submissionTextView"]'),
+    ('comment', './/h:div[@id="currentAttempt_comments"]'
+                '//h:div[@class="vtbegenerated"]'),
+    ('post', './/h:div[@class="dbThreadBody"]'),
+)
+
+ESCAPE = re.compile(r'\\([\\`*_{}\[\]()#+\-.!|>])')
+CELL_SEPARATOR = re.compile(r' *\| *')
+# Emphasis followed by a space and punctuation, as html2text writes it
+EMPHASIS_SPACE = re.compile(r'(\*\*|_|`) (?=[.,:;!?])')
+# A top-level list item as html2text writes it
+HTML2TEXT_LIST = re.compile(r'  (?:\* |\d+\. )')
+
+
+def html2text_markdown(element):
+    # html2text is slow to import, so only import it when needed.
+    import html2text
+    h = html2text.HTML2Text()
+    h.body_width = 0
+    return h.handle(element_to_html(element))
+
+
+def normalize(markdown):
+    """
+    Remove the differences that are kept on purpose (see above).
+
+    >>> normalize('  1. en\\n     * a\\n\\n\\n    x = 1\\n    \\n\\nA| B  \\n')
+    '1. en\\n   * a\\n\\n    x = 1\\n\\nA | B'
+    >>> normalize('1. en\\n   * a\\n\\n```\\nx = 1\\n```\\n\\nA | B')
+    '1. en\\n   * a\\n\\n    x = 1\\n\\nA | B'
+
+    Hard line breaks (two spaces at the end of a line that is followed
+    by another line of the same paragraph) are kept:
+
+    >>> normalize('a  \\nb  \\n\\n\\\\- **c** .')
+    'a  \\nb\\n\\n- **c**.'
+    """
+    lines = []
+    fenced = False
+    for line in ESCAPE.sub(r'\1', markdown).split('\n'):
+        if line.strip() == '```':
+            fenced = not fenced
+        elif fenced:
+            lines.append(('    ' + line).rstrip())
+        else:
+            lines.append(line)
+    paragraphs = []
+    paragraph = []
+    for line in lines + ['']:
+        if line.strip():
+            paragraph.append(line)
+            continue
+        if paragraph:
+            paragraphs.append(paragraph)
+            paragraph = []
+    result = []
+    for paragraph in paragraphs:
+        for i, line in enumerate(paragraph):
+            hard_break = (line.endswith('  ') and '|' not in line and
+                          i + 1 < len(paragraph))
+            line = CELL_SEPARATOR.sub(' | ', line.rstrip())
+            line = EMPHASIS_SPACE.sub(r'\1', line)
+            paragraph[i] = line + '  ' if hard_break else line
+        if HTML2TEXT_LIST.match(paragraph[0]):
+            paragraph = [line[2:] if line.startswith('  ') else line
+                         for line in paragraph]
+        result.append('\n'.join(paragraph))
+    return '\n\n'.join(result)
+
+
+def compare(element):
+    """
+    Return None if element_to_markdown and html2text agree on element,
+    otherwise a diff of their normalized outputs.
+
+    >>> from xml.etree.ElementTree import fromstring
+    >>> compare(fromstring(
+    ...     '<div><p>Se <a href="http://x.dk">her</a><br/>og <b>her</b></p>'
+    ...     '<ol><li>en</li><li>to</li></ol><pre>  x = 1\\n</pre>'
+    ...     '<table><tr><th>A</th><th>B</th></tr><tr><td>1</td><td>2</td>'
+    ...     '</tr></table></div>'))
+
+    html2text does not indent the second paragraph of a list item:
+
+    >>> print(compare(fromstring(
+    ...     '<div><ul><li><p>b</p><p>c</p></li></ul></div>')))
+    --- element_to_markdown
+    +++ html2text
+    @@ -1,2 +1,3 @@
+     * b
+    -  c
+    +
+    +c
+    """
+    return diff(element_to_markdown(element), html2text_markdown(element))
+
+
+def diff(markdown, reference):
+    """Return None or a diff of the normalized markdown and reference."""
+    expected = normalize(markdown)
+    actual = normalize(reference)
+    if expected == actual:
+        return None
+    return '\n'.join(difflib.unified_diff(
+        expected.split('\n'), actual.split('\n'),
+        'element_to_markdown', 'html2text', lineterm=''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='+',
+                        help='Fixture archive or HTML file')
+    args = parser.parse_args()
+
+    times = dict(element_to_markdown=0.0, html2text=0.0)
+    counts = dict.fromkeys((kind for kind, xpath in ELEMENTS), 0)
+    mismatches = 0
+    seen = set()
+    for filename in args.filename:
+        for url, content, encoding in iter_pages(filename):
+            document = parse_html(content, encoding)
+            for kind, xpath in ELEMENTS:
+                for element in document.findall(xpath, NS):
+                    html = element_to_html(element)
+                    if html in seen:
+                        continue
+                    seen.add(html)
+                    counts[kind] += 1
+                    t = time.perf_counter()
+                    markdown = element_to_markdown(element)
+                    times['element_to_markdown'] += time.perf_counter() - t
+                    t = time.perf_counter()
+                    reference = html2text_markdown(element)
+                    times['html2text'] += time.perf_counter() - t
+                    difference = diff(markdown, reference)
+                    if difference is not None:
+                        mismatches += 1
+                        print("%s: %s differs\n%s" % (url, kind, difference))
+    print("Converted %s" % ', '.join(
+        '%d %s%s' % (n, kind, '' if n == 1 else 's')
+        for kind, n in counts.items()))
+    for n, t in times.items():
+        print("%-20s %8.1f ms" % (n, t * 1000))
+    if mismatches:
+        print("%d mismatches" % mismatches)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Check that the HTML parsers in blackboard.htmlparser agree, and compare
+their speed.
+
+Parses the HTML pages in fixture archives recorded with
+`grading --record` (see blackboard.fixtures), or plain .html files,
+with each installed parser and reports the pages on which the trees
+differ. Run it with `python -m blackboard.benchmark.parsers ARCHIVE...`.
+"""
+
+import json
+import time
+import zipfile
+import argparse
+import itertools
+import collections
+
+from blackboard.htmlparser import PARSERS, available_parsers
+
+
+def _normalize_space(s):
+    return ' '.join((s or '').split())
+
+
+def tree_items(element):
+    """
+    Iterate over the elements of a tree as comparable tuples.
+    Whitespace in text is collapsed, since the parsers differ in where
+    they put insignificant whitespace (e.g. after </body>), and
+    element_text_content collapses whitespace anyway.
+
+    >>> from xml.etree.ElementTree import fromstring
+    >>> list(tree_items(fromstring('<p class="x">a<b>b</b>\\n c </p>')))
+    [(0, 'p', [('class', 'x')], 'a', ''), (1, 'b', [], 'b', 'c')]
+    """
+    stack = [(0, element)]
+    while stack:
+        depth, e = stack.pop()
+        tag = e.tag if isinstance(e.tag, str) else '<!-- -->'
+        yield (depth, tag, sorted(e.attrib.items()), _normalize_space(e.text),
+               _normalize_space(e.tail) if depth else '')
+        stack.extend((depth + 1, c) for c in reversed(list(e)))
+
+
+def compare_trees(a, b):
+    """
+    Return None if the trees a and b are identical,
+    otherwise a description of the first difference.
+
+    >>> from xml.etree.ElementTree import fromstring
+    >>> compare_trees(fromstring('<p>a<b/></p>'), fromstring('<p>a<b/></p>'))
+    >>> compare_trees(fromstring('<p>a<b/></p>'), fromstring('<p>a<i/></p>'))
+    "element 2: (1, 'b', [], '', '') != (1, 'i', [], '', '')"
+    """
+    pairs = itertools.zip_longest(tree_items(a), tree_items(b))
+    for i, (x, y) in enumerate(pairs):
+        if x is None or y is None:
+            return 'element %d: only in the %s tree' % (
+                i + 1, 'second' if x is None else 'first')
+        if x != y:
+            return 'element %d: %r != %r' % (i + 1, x, y)
+
+
+def iter_pages(filename):
+    """
+    Yield (name, content, encoding) of the HTML pages in a fixture
+    archive (see blackboard.fixtures), or of a single HTML file.
+    """
+    if not zipfile.is_zipfile(filename):
+        with open(filename, 'rb') as fp:
+            yield filename, fp.read(), None
+        return
+    with zipfile.ZipFile(filename) as zf:
+        seen = set()
+        for name in sorted(zf.namelist()):
+            if not name.startswith('entries/'):
+                continue
+            entry = json.loads(zf.read(name).decode('utf8'))
+            content_type = entry['headers'].get('Content-Type', '')
+            if 'html' not in content_type or entry['body'] in seen:
+                continue
+            seen.add(entry['body'])
+            encoding = None
+            if 'charset=' in content_type:
+                encoding = content_type.split('charset=')[1].split(';')[0]
+                encoding = encoding.strip(' "') or None
+            yield entry['url'], zf.read('bodies/' + entry['body']), encoding
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='+',
+                        help='Fixture archive or HTML file')
+    parser.add_argument('--parser', action='append', choices=PARSERS,
+                        help='Parsers to compare (default: all installed)')
+    args = parser.parse_args()
+
+    names = args.parser or available_parsers()
+    if not names:
+        raise SystemExit("No HTML parser installed")
+    times = collections.OrderedDict((n, 0.0) for n in names)
+    pages = mismatches = 0
+    for filename in args.filename:
+        for url, content, encoding in iter_pages(filename):
+            pages += 1
+            documents = []
+            for n in names:
+                parse, module = PARSERS[n]
+                t = time.perf_counter()
+                documents.append(parse(content, encoding))
+                times[n] += time.perf_counter() - t
+            for n, d in zip(names[1:], documents[1:]):
+                difference = compare_trees(documents[0], d)
+                if difference is not None:
+                    mismatches += 1
+                    print("%s: %s and %s differ at %s" %
+                          (url, names[0], n, difference))
+    print("Parsed %d pages" % pages)
+    for n, t in times.items():
+        print("%-14s %8.1f ms" % (n, t * 1000))
+    if mismatches:
+        print("%d mismatches" % mismatches)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measure how long it takes to import the grading program.
+
+Runs `python -X importtime -c 'import blackboard.grading'` a few times
+in fresh interpreters and reports the fastest run. Offline commands
+such as `grading -n` should not pay for importing requests, html5lib,
+keyring, markdown2 or html2text, so the benchmark fails if any of these
+are imported at startup, or if the import takes longer than --max-ms.
+
+Run it with `python -m blackboard.benchmark.startup`.
+"""
+
+import re
+import sys
+import argparse
+import subprocess
+
+
+# Modules that must only be imported when they are first used
+HEAVY_MODULES = ('requests', 'html5lib', 'html5_parser', 'lxml', 'keyring',
+                 'markdown2', 'html2text')
+
+IMPORTTIME = re.compile(
+    r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| ' +
+    r'(?P<indent>\s*)(?P<module>\S+)$')
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of `python -X importtime`.
+    Returns a list of (module, self_us, cumulative_us, depth).
+
+    >>> parse_importtime(
+    ...     'import time: self [us] | cumulative | imported package\\n'
+    ...     'import time:       120 |        120 |   _io\\n'
+    ...     'import time:      3000 |       3120 | blackboard\\n')
+    [('_io', 120, 120, 1), ('blackboard', 3000, 3120, 0)]
+    """
+    result = []
+    for line in stderr.splitlines():
+        mo = IMPORTTIME.match(line)
+        if mo is None:
+            continue
+        result.append((mo.group('module'), int(mo.group('self')),
+                       int(mo.group('cumulative')),
+                       len(mo.group('indent')) // 2))
+    return result
+
+
+def measure(module, python=sys.executable):
+    p = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import %s' % module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if p.returncode != 0:
+        raise SystemExit("Could not import %s:\n%s" % (module, p.stderr))
+    return parse_importtime(p.stderr)
+
+
+def total_us(timings, module):
+    for name, self_us, cumulative_us, depth in timings:
+        if name == module and depth == 0:
+            return cumulative_us
+    return sum(c for name, s, c, depth in timings if depth == 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='blackboard.grading')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15,
+                        help='Number of slowest imports to show')
+    parser.add_argument('--max-ms', type=float,
+                        help='Fail if the import takes longer than this')
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for i in range(args.runs)]
+    best = min(runs, key=lambda timings: total_us(timings, args.module))
+    total = total_us(best, args.module) / 1000
+    print("import %s: %.1f ms (best of %d)" % (args.module, total, args.runs))
+    print("Slowest imports (cumulative ms):")
+    slowest = sorted(best, key=lambda t: t[2], reverse=True)[:args.top]
+    for name, self_us, cumulative_us, depth in slowest:
+        print("%8.1f %s" % (cumulative_us / 1000, name))
+
+    imported = {name.split('.')[0] for name, s, c, d in best}
+    heavy = [m for m in HEAVY_MODULES if m in imported]
+    failed = False
+    if heavy:
+        print("Imported at startup: %s" % ', '.join(heavy))
+        failed = True
+    if args.max_ms is not None and total > args.max_ms:
+        print("Import took longer than %.1f ms" % args.max_ms)
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+Parse the gradebook_BB*.zip files produced by "Download assignment"
+in the Blackboard Grade Centre.
+
+Each attempt in the bundle is represented by a metadata file named
+``<handin>_<group or username>_attempt_<timestamp>.txt``
+and one member per uploaded file named
+``<handin>_<group or username>_attempt_<timestamp>_<filename>``.
+The Danish Blackboard interface uses "forsøg" instead of "attempt".
+"""
+
+import os
+import re
+import shutil
+import zipfile
+import threading
+import collections
+import concurrent.futures
+
+
+FILENAME = re.compile(
+    r'(?P<handin>[^_/]+)_(?P<group>[^_/]+)_' +
+    r'(?:forsøg|attempt)_(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-' +
+    r'(?P<day>[0-9]{2})-(?P<hour>[0-9]{2})-(?P<minute>[0-9]{2})-' +
+    r'(?P<second>[0-9]{2})' +
+    r'(?P<suffix>.*)')
+
+
+METADATA = re.compile(
+    br'(?:Navn|Name): (?P<group>[^\n]+)\n' +
+    br'(?:Opgave|Assignment): (?P<handin>[^\n]+)\n' +
+    br'(?:Dato for svar|Date Submitted): (?P<time>[^\n]+)\n' +
+    br'(?:Aktuel karakter|Current Grade): (?:(?P<nograde>' +
+    br'Endnu ikke karaktergivet|Needs Grading)|(?P<grade>\d+\.?\d*))\n\n' +
+    br'(?:Svarfelt|Submission Field):\n(?P<answer>.*)\n\n' +
+    br'(?:Kommentarer|Comments):\n(?P<comments>.*)\n\n' +
+    br'(?:Filer|Files):\n(?P<files>.*)\n',
+    re.S)
+
+
+NO_FILES = (
+    b'Der blev ikke vedh\xc3\xa6ftet filer til dette svar.',
+    b'No files were attached to this submission.',
+)
+FILES_FIELD = re.compile(
+    br'\t(?:Oprindeligt filnavn|Original filename): (?P<original>.+)\n' +
+    br'\t(?:Filnavn|Filename): (?P<filename>.+)\n')
+
+# Placeholders written in the metadata file when the student left
+# the submission text or the comments field empty.
+NO_ANSWER = (
+    'Der er ingen tekstdata for den studerendes besvarelse af denne opgave.',
+    'There is no student submission text data for this assignment.',
+)
+NO_COMMENTS = (
+    'Der er ingen kommentarer fra den studerende til denne opgave.',
+    'There are no student comments for this assignment.',
+)
+
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+BundleAttempt = collections.namedtuple(
+    'BundleAttempt', 'group handin date timestamp metadata members')
+
+
+def parse_member_name(filename):
+    """
+    >>> d = parse_member_name(
+    ...     'Aflevering 3_Gruppe DA2 - 01_attempt_2016-04-28-10-12-13_a3.pdf')
+    >>> d['handin'], d['group'], d['date'], d['suffix']
+    ('Aflevering 3', 'Gruppe DA2 - 01', '28/04/16', '_a3.pdf')
+    >>> parse_member_name('README.txt') is None
+    True
+    """
+    o = FILENAME.fullmatch(filename)
+    if o is None:
+        return
+    d = o.groupdict()
+    d['timestamp'] = (
+        '%(year)s-%(month)s-%(day)s-%(hour)s-%(minute)s-%(second)s' % d)
+    # Same format as the 'date' field of attempts returned by DWR
+    d['date'] = '%s/%s/%s' % (d['day'], d['month'], d['year'][2:])
+    return d
+
+
+def parse_metadata(data):
+    """
+    Parse the metadata .txt file describing an attempt in the bundle.
+    Returns None if the contents cannot be parsed.
+
+    >>> m = parse_metadata(
+    ...     b'Name: Gruppe DA2 - 01\\nAssignment: Aflevering 3\\n' +
+    ...     b'Date Submitted: 28. april 2016 10:12\\n' +
+    ...     b'Current Grade: Needs Grading\\n\\n' +
+    ...     b'Submission Field:\\nThere is no student submission text ' +
+    ...     b'data for this assignment.\\n\\n' +
+    ...     b'Comments:\\nHello\\n\\n' +
+    ...     b'Files:\\n\\tOriginal filename: a3.pdf\\n' +
+    ...     b'\\tFilename: Aflevering 3_Gruppe DA2 - 01_attempt_' +
+    ...     b'2016-04-28-10-12-13_a3.pdf\\n\\n')
+    >>> m['answer'], m['comments'], m['grade']
+    (None, 'Hello', None)
+    >>> m['files']  # doctest: +NORMALIZE_WHITESPACE
+    [('a3.pdf',
+      'Aflevering 3_Gruppe DA2 - 01_attempt_2016-04-28-10-12-13_a3.pdf')]
+    """
+    o = METADATA.fullmatch(data)
+    if o is None:
+        return
+    d = {k: v.decode('utf8') if v is not None else None
+         for k, v in o.groupdict().items() if k != 'files'}
+    if d['answer'] in NO_ANSWER:
+        d['answer'] = None
+    if d['comments'] in NO_COMMENTS:
+        d['comments'] = None
+    if d['grade'] is not None:
+        d['grade'] = float(d['grade'])
+    files_field = o.group('files').strip(b'\n')
+    if files_field in NO_FILES:
+        d['files'] = []
+    else:
+        d['files'] = [
+            (f.group('original').decode('utf8'),
+             f.group('filename').decode('utf8'))
+            for f in FILES_FIELD.finditer(files_field + b'\n')]
+    return d
+
+
+def index_bundle(zf):
+    """
+    Group the members of the ZipFile zf by attempt.
+
+    Returns a list of BundleAttempt tuples, where metadata is the
+    parsed metadata file (or None) and members is a list of
+    (filename, ZipInfo) pairs naming each uploaded file.
+    Members that do not follow the naming scheme are skipped.
+    """
+    attempts = collections.OrderedDict()
+    for zinfo in zf.infolist():
+        d = parse_member_name(zinfo.filename)
+        if d is None:
+            continue
+        key = (d['handin'], d['group'], d['timestamp'])
+        try:
+            a = attempts[key]
+        except KeyError:
+            a = attempts[key] = dict(
+                group=d['group'], handin=d['handin'], date=d['date'],
+                timestamp=d['timestamp'], metadata=None, members=[])
+        if d['suffix'] == '.txt':
+            a['metadata'] = parse_metadata(zf.read(zinfo))
+        else:
+            a['members'].append((d['suffix'].lstrip('_'), zinfo))
+    result = []
+    for (handin, group, timestamp), a in attempts.items():
+        members = a['members']
+        if a['metadata'] is not None:
+            # Use the original filenames recorded in the metadata file.
+            original = {filename: orig
+                        for orig, filename in a['metadata']['files']}
+            members = [(original.get(zinfo.filename, name), zinfo)
+                       for name, zinfo in members]
+        result.append(BundleAttempt(
+            group, handin, a['date'], timestamp, a['metadata'], members))
+    return result
+
+
+def match_bundle_attempts(bundle_attempts, attempts):
+    """
+    Match the BundleAttempts of an assignment to attempts in the gradebook.
+
+    attempts maps each (group or username, date) pair to the list of all
+    attempts with that name and date, in the order they were made.
+    The gradebook only records the day of an attempt, so attempts made on
+    the same day are matched in the order of their full timestamps in the
+    bundle. Pairs where the bundle and the gradebook disagree on the
+    number of attempts are skipped.
+    Returns a list of (BundleAttempt, attempt) pairs.
+
+    >>> def b(group, timestamp):
+    ...     return BundleAttempt(group, 'A', '28/04/16', timestamp, {}, [])
+    >>> bundle_attempts = [b('G1', '2016-04-28-15-00-00'),
+    ...                    b('G1', '2016-04-28-09-00-00'),
+    ...                    b('G2', '2016-04-28-10-00-00'),
+    ...                    b('G3', '2016-04-28-10-00-00')]
+    >>> attempts = {('G1', '28/04/16'): ['first', 'second'],
+    ...             ('G2', '28/04/16'): ['first', 'second'],
+    ...             ('G3', '28/04/16'): ['only']}
+    >>> [(b.group, b.timestamp[11:13], a)
+    ...  for b, a in match_bundle_attempts(bundle_attempts, attempts)]
+    [('G1', '09', 'first'), ('G1', '15', 'second'), ('G3', '10', 'only')]
+    """
+    by_key = collections.OrderedDict()
+    for b in bundle_attempts:
+        by_key.setdefault((b.group, b.date), []).append(b)
+    result = []
+    for key, bs in by_key.items():
+        known = attempts.get(key, ())
+        if len(known) != len(bs):
+            continue
+        bs.sort(key=lambda b: b.timestamp)
+        result.extend(zip(bs, known))
+    return result
+
+
+def _extract_member(zf, member, outfile):
+    """
+    Extract member of the ZipFile zf to outfile, going through a
+    temporary file that only gets the name outfile when it is complete,
+    so that an interrupted extraction is done again the next time.
+    Returns the size, or None if outfile already exists.
+    """
+    if os.path.exists(outfile):
+        return None
+    # Other threads and processes may be extracting the same member
+    part = '%s.%d-%d.part' % (outfile, os.getpid(), threading.get_ident())
+    try:
+        with open(part, 'wb') as dst:
+            with zf.open(member) as src:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            size = dst.tell()
+        try:
+            # Unlike os.replace, this fails if outfile has been
+            # extracted in the meantime
+            os.link(part, outfile)
+        except FileExistsError:
+            return None
+        return size
+    finally:
+        try:
+            os.remove(part)
+        except FileNotFoundError:
+            pass
+
+
+def _extract_chunk(zipname, jobs):
+    # Runs in a worker process with its own ZipFile handle.
+    with zipfile.ZipFile(zipname) as zf:
+        return [(outfile, _extract_member(zf, member, outfile))
+                for member, outfile in jobs]
+
+
+def extract_members(zipname, jobs, max_workers=None):
+    """
+    Extract members of the ZIP file zipname in parallel.
+
+    jobs is a list of (member name, output filename) pairs.
+    Existing output files are not overwritten.
+    Members are streamed to disk rather than read into memory,
+    and each worker process opens its own handle to the ZIP file.
+    Yields (output filename, size) pairs as members are extracted,
+    where size is None if the output file already existed.
+    Output files appear only when they are complete.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     zipname = os.path.join(d, 'bundle.zip')
+    ...     with zipfile.ZipFile(zipname, 'w') as zf:
+    ...         zf.writestr('a.pdf', b'x' * 1000)
+    ...     outfile = os.path.join(d, 'a.pdf')
+    ...     # Left behind by a worker that was killed
+    ...     with open(outfile + '.123-456.part', 'wb') as fp:
+    ...         _ = fp.write(b'x' * 10)
+    ...     first = list(extract_members(zipname, [('a.pdf', outfile)]))
+    ...     again = list(extract_members(zipname, [('a.pdf', outfile)]))
+    ...     size = os.path.getsize(outfile)
+    >>> [s for f, s in first], [s for f, s in again], size
+    ([1000], [None], 1000)
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    # Deal the jobs out round-robin so large members are spread across
+    # workers, and use a few chunks per worker to balance the load.
+    n = min(len(jobs), 4 * max_workers)
+    if n <= 1 or max_workers == 1:
+        yield from _extract_chunk(zipname, jobs)
+        return
+    chunks = [jobs[i::n] for i in range(n)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(_extract_chunk, zipname, chunk)
+                   for chunk in chunks]
+        for f in concurrent.futures.as_completed(futures):
+            yield from f.result()
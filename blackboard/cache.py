@@ -0,0 +1,184 @@
+"""
+Decide when cached Blackboard data must be fetched again.
+
+Grading keeps the gradebook, attempt lists, group memberships, rubrics
+and whether the course id is valid in grading.json. Each kind of data
+has a time to live and a stale period in Grading.cache_ttls. Until its
+time to live has passed, data is fresh and is used as it is. After
+that, it is fetched before it is used, except during the stale period
+in the daemon (blackboard.daemon), which keeps using stale data while
+it is fetched again in the background; the new data replaces the old
+the next time CacheManager.apply_pending is called, which happens on
+the main thread so that nothing else sees the data change under it.
+
+Data cached before its fetch time was recorded is considered stale,
+and data that has been invalidated (e.g. with `grading -g`) expired.
+"""
+
+import time
+import threading
+import concurrent.futures
+
+from blackboard import logger
+
+
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+
+
+class CachePolicy:
+    """
+    The fetch times of each kind of data, and its state according to
+    ttls, which maps each kind to (time to live, stale period) in
+    seconds. times maps each kind to a dictionary of fetch times by key
+    (the empty string for kinds that are fetched as a whole); it is
+    stored in grading.json, so its keys must be strings.
+
+    >>> policy = CachePolicy({'groups': (60, 600)}, {})
+    >>> policy.state('groups')
+    'stale'
+    >>> policy.touch('groups', when=1000)
+    >>> [policy.state('groups', now=t) for t in (1030, 1100, 1700)]
+    ['fresh', 'stale', 'expired']
+    >>> policy.invalidate('groups')
+    >>> policy.state('groups', now=1030)
+    'expired'
+    """
+
+    def __init__(self, ttls, times):
+        self.ttls = ttls
+        self.times = times
+
+    def state(self, kind, key='', now=None):
+        try:
+            fetch_time = self.times[kind][key]
+        except KeyError:
+            return STALE
+        if now is None:
+            now = time.time()
+        ttl, stale = self.ttls[kind]
+        age = now - fetch_time
+        if age < ttl:
+            return FRESH
+        if age < ttl + stale:
+            return STALE
+        return EXPIRED
+
+    def touch(self, kind, key='', when=None):
+        if when is None:
+            when = time.time()
+        self.times.setdefault(kind, {})[key] = when
+
+    def invalidate(self, kind, key=None):
+        """Make the data of the given kind (and key) expire."""
+        keys = self.times.setdefault(kind, {})
+        if key is None:
+            for k in keys:
+                keys[k] = 0
+            keys[''] = 0
+        else:
+            keys[key] = 0
+
+
+class CacheManager:
+    """
+    Refresh data according to a CachePolicy.
+
+    The data is fetched by calling a fetch function, which must not
+    modify anything, and stored by calling an apply function with the
+    result; only fetch functions are called in the background. If the
+    session must be prepared for fetch (e.g. by switching to edit
+    mode), pass a prepare function, which is called on the calling
+    thread before fetch. Stale data is only fetched in the background
+    if background is true; otherwise it is fetched right away.
+    """
+
+    def __init__(self, policy, max_workers=2, background=False):
+        self.policy = policy
+        self.max_workers = max_workers
+        self.background = background
+        self.executor = None
+        # (kind, key) -> (future, apply) of background fetches
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def needs_fetch(self, kind, key=''):
+        """Return True if ensure would fetch the data right away."""
+        state = self.policy.state(kind, key)
+        return state == EXPIRED or (state == STALE and not self.background)
+
+    def ensure(self, kind, fetch, apply, key='', prepare=None):
+        """
+        Make sure the data of the given kind is fresh: fetch it right
+        away if it is not, or in the background if it is stale and
+        self.background is true. Returns the state the data was in.
+        """
+        state = self.policy.state(kind, key)
+        if state == STALE and self.background:
+            self.submit(kind, fetch, apply, key, prepare)
+        elif state != FRESH:
+            self.refresh(kind, fetch, apply, key, prepare)
+        return state
+
+    def refresh(self, kind, fetch, apply, key='', prepare=None):
+        """Fetch and apply the data of the given kind right away."""
+        if prepare is not None:
+            prepare()
+        fetch_time = time.time()
+        apply(fetch())
+        self.policy.touch(kind, key, fetch_time)
+        with self.lock:
+            # A background fetch that is still running would be older
+            self.pending.pop((kind, key), None)
+
+    def submit(self, kind, fetch, apply, key='', prepare=None):
+        def timed_fetch():
+            fetch_time = time.time()
+            return fetch_time, fetch()
+
+        with self.lock:
+            if (kind, key) in self.pending:
+                return
+        if prepare is not None:
+            prepare()
+        with self.lock:
+            if (kind, key) in self.pending:
+                return
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers)
+            logger.debug("Refreshing %s %s in the background", kind, key)
+            self.pending[kind, key] = (self.executor.submit(timed_fetch),
+                                       apply)
+
+    def apply_pending(self, wait=False):
+        """
+        Apply the data fetched in the background, waiting for fetches
+        that have not finished if wait is true.
+        """
+        with self.lock:
+            pending = list(self.pending.items())
+        for (kind, key), (future, apply) in pending:
+            if not wait and not future.done():
+                continue
+            with self.lock:
+                if self.pending.get((kind, key), (None,))[0] is not future:
+                    # Refreshed in the meantime
+                    continue
+                del self.pending[kind, key]
+            try:
+                fetch_time, result = future.result()
+            except Exception:
+                # Try again when the data is next needed
+                logger.warning("Background refresh of %s %s failed",
+                               kind, key, exc_info=True)
+                continue
+            apply(result)
+            self.policy.touch(kind, key, fetch_time)
+
+    def close(self):
+        self.apply_pending(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,228 @@
+"""
+Keep a Grading object in memory in a long-running process
+and let the command line program talk to it over a Unix socket.
+
+The daemon keeps the logged-in BlackboardSession, the parsed gradebook
+and the attempt state in memory and refreshes the gradebook in the
+background, so a command such as `grading -n` only has to send its
+arguments over the socket and print the reply.
+
+This module only uses the standard library at import time,
+so that the client is cheap to start.
+"""
+
+import os
+import io
+import sys
+import json
+import socket
+import logging
+import threading
+import contextlib
+import socketserver
+
+
+SOCKET = '.bbfetch.sock'
+
+# Options that configure the session, which the daemon set up when it
+# was started; commands that use them must run without the daemon.
+SESSION_OPTIONS = ('base_url', 'record', 'replay')
+
+
+def request(argv, socket_path=SOCKET):
+    """
+    Run the command line argv in the daemon listening on socket_path.
+    Returns the reply (a dict with 'output' and 'status'),
+    or None if no daemon is running.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        s.close()
+        return None
+    with s:
+        s.sendall(json.dumps(dict(argv=argv)).encode('utf8'))
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(64*1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf8'))
+
+
+class ThreadOutput:
+    """
+    Replacement for sys.stdout or sys.stderr that sends what each thread
+    writes to the stream given to redirect() in that thread, and
+    everything else to the original stream.
+
+    >>> out = ThreadOutput(io.StringIO())
+    >>> captured = io.StringIO()
+    >>> with out.redirect(captured):
+    ...     _ = out.write('command ')
+    ...     t = threading.Thread(target=out.write, args=('background',))
+    ...     t.start()
+    ...     t.join()
+    >>> captured.getvalue(), out.stream.getvalue()
+    ('command ', 'background')
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.stream
+
+    def write(self, s):
+        return self.target().write(s)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        self.local.stream = stream
+        try:
+            yield
+        finally:
+            self.local.stream = None
+
+
+def run_client(argv, socket_path=SOCKET):
+    """
+    Send argv to the daemon and print its output.
+    Returns False if no daemon is running.
+    """
+    reply = request(argv, socket_path)
+    if reply is None:
+        return False
+    sys.stdout.write(reply['output'])
+    sys.stdout.flush()
+    if reply['status']:
+        raise SystemExit(reply['status'])
+    return True
+
+
+class Daemon:
+    def __init__(self, grading, parser, socket_path=SOCKET,
+                 refresh_interval=300):
+        self.grading = grading
+        # Keep answering from stale data while it is fetched again
+        # (see blackboard.cache)
+        grading.refresh_in_background = True
+        self.parser = parser
+        self.socket_path = socket_path
+        self.refresh_interval = refresh_interval
+        # Requests and background refreshes take turns using self.grading
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run_command(self, argv):
+        output = io.StringIO()
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(
+            logging.Formatter('[%(asctime)s %(levelname)s] %(message)s'))
+        logger = logging.getLogger('blackboard')
+        status = 0
+        with self.lock:
+            try:
+                # Only the output of this thread goes to the client
+                with self.stdout.redirect(output), \
+                        self.stderr.redirect(output):
+                    try:
+                        args = self.parser.parse_args(argv)
+                        self.check_args(args)
+                        if not args.quiet:
+                            logger.addHandler(handler)
+                        # Report --stats and --trace for this command only
+                        self.grading.session.tracer.reset()
+                        self.grading.execute(args)
+                    except SystemExit as exn:
+                        status = exn.code
+            finally:
+                logger.removeHandler(handler)
+        return dict(output=output.getvalue(), status=status)
+
+    def disable_prompts(self):
+        """
+        Get the username and password now, on the terminal that started
+        the daemon, and make the session fail instead of asking for them
+        later: a prompt in the daemon would make the client hang.
+        """
+        session = self.grading.session
+        if not session.replaying:
+            session.get_auth()
+
+        def get_auth():
+            if session.username is None or session.password is None:
+                from blackboard import NoCredentials
+                raise NoCredentials(
+                    "The daemon has no Blackboard password. Stop the "
+                    "daemon and run grading without it to log in.")
+            return dict(username=session.username,
+                        password=session.password)
+
+        session.get_auth = get_auth
+
+    def check_args(self, args):
+        for option in SESSION_OPTIONS:
+            if getattr(args, option, None):
+                self.parser.error(
+                    "--%s cannot be used while a daemon is running" %
+                    option.replace('_', '-'))
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.refresh_interval):
+            with self.lock:
+                try:
+                    self.grading.refresh()
+                    self.grading.save()
+                    self.grading.session.save_cookies()
+                except Exception:
+                    logging.getLogger('blackboard').exception(
+                        "Background refresh failed")
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                o = json.loads(self.rfile.read().decode('utf8'))
+                reply = daemon.run_command(o['argv'])
+                self.wfile.write(json.dumps(reply).encode('utf8'))
+
+        if os.path.exists(self.socket_path):
+            try:
+                # Remove the socket left behind by a daemon that died
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                probe.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+            else:
+                probe.close()
+                raise SystemExit("A daemon is already listening on %s" %
+                                 self.socket_path)
+        self.disable_prompts()
+        self.stdout = sys.stdout = ThreadOutput(sys.stdout)
+        self.stderr = sys.stderr = ThreadOutput(sys.stderr)
+        server = socketserver.UnixStreamServer(self.socket_path, Handler)
+        refresher = threading.Thread(target=self.refresh_loop, daemon=True)
+        refresher.start()
+        logging.getLogger('blackboard').info(
+            "Listening on %s; refreshing every %s s",
+            self.socket_path, self.refresh_interval)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            server.server_close()
+            os.remove(self.socket_path)
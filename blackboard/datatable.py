@@ -1,83 +1,246 @@
 import re
-import csv
-import html5lib
-from requests.compat import urljoin
+import itertools
+import collections
+import concurrent.futures
+from six.moves.urllib.parse import urljoin
 
 import blackboard
-from blackboard.elementtext import element_text_content
+from blackboard.elementtext import element_text_content, row_text_content
+from blackboard.htmlparser import parse_html, parse_response
+from blackboard.export import DatatableExport, TSVSink
+from blackboard.fragments import (
+    RAW_TEXT, Unsupported, ascii_compatible, element_attributes,
+    find_start_tag, inside_raw_text, parse_attributes,
+)
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
+NEXT_PAGE_ID = 'listContainer_nextpage_top'
+START_INDEX = re.compile(r'([?&]startIndex=)(\d+)')
+NUM_RESULTS = re.compile(r'[?&]numResults=(\d+)')
+
+# Number of datatable pages fetched at the same time
+MAX_WORKERS = 4
+
+# Number of rows parsed at a time by parse_datatable_rows
+ROWS_PER_PARSE = 100
+
+# Like fragments.TOKEN, but only captures the names of table tags.
+# Other start tags are matched so that their attributes are skipped.
+TABLE_TOKEN = re.compile(
+    RAW_TEXT.pattern + b'|' +
+    br'<(/?)(table|caption|colgroup|thead|tbody|tfoot|tr|td|th)\b' +
+    br'(?:[^>"\']|"[^"]*"|\'[^\']*\')*>|' +
+    br'<[a-zA-Z](?:[^>"\']|"[^"]*"|\'[^\']*\')*>',
+    re.S | re.I)
+LINK = re.compile(br'<a\b([^>]*)>', re.I)
+DOCTYPE = re.compile(br'<!doctype[^>]*>', re.I)
+
 
 def fetch_datatable(session, url, filename=None, **kwargs):
-    if filename is not None:
-        with open(filename, 'w') as fp:
-            data = list(dump_iter_datatable(session, url, fp, **kwargs))
-    else:
-        data = list(iter_datatable(session, url, **kwargs))
-    keys = data[0]
-    rows = data[1:-1]
-    response = data[-1]
-    return response, keys, rows
+    stream = stream_datatable(session, url, filename, **kwargs)
+    rows = list(stream)
+    return stream.response, stream.keys, rows
+
+
+class DatatableStream:
+    """
+    The rows of a datatable, fetched and parsed while they are iterated.
+
+    keys is available right away. response is the response of the last
+    page once all rows have been iterated (with the earlier pages in its
+    history if keep_history=True is passed). The rows are also written
+    to the given sinks (see blackboard.export) as they are iterated, and
+    if filename is given, to that file as tab-separated values.
+    """
+
+    def __init__(self, session, url, filename=None, sinks=(),
+                 flush_rows=None, **kwargs):
+        self.response = None
+        sinks = list(sinks)
+        if filename is not None:
+            sinks.append(TSVSink(filename))
+        if sinks:
+            export = DatatableExport(sinks, flush_rows)
+            self._items = export_iter_datatable(session, url, export,
+                                                **kwargs)
+        else:
+            self._items = iter_datatable(session, url, **kwargs)
+        try:
+            self.keys = next(self._items)
+        except BaseException:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            for r in self._items:
+                if isinstance(r, list):
+                    yield r
+                else:
+                    self.response = r
+        finally:
+            self.close()
+
+    def close(self):
+        self._items.close()
+
+
+def stream_datatable(session, url, filename=None, **kwargs):
+    return DatatableStream(session, url, filename, **kwargs)
+
+
+def export_iter_datatable(session, url, export, **kwargs):
+    """
+    iter_datatable, also writing the keys and rows to the
+    DatatableExport export, which is flushed at the end of each page
+    and closed when the iteration ends.
+    """
+    kwargs['end_page'] = export.end_page
+    items = iter_datatable(session, url, **kwargs)
+    try:
+        keys = next(items)
+        export.open(keys)
+        yield keys
+        for r in items:
+            if isinstance(r, list):
+                export.write_row(r)
+            yield r
+    finally:
+        items.close()
+        export.close()
 
 
 def dump_iter_datatable(session, url, fp, **kwargs):
-    c = csv.writer(fp, dialect='excel-tab')
-    for r in iter_datatable(session, url, **kwargs):
-        if isinstance(r, list):
-            c.writerow(r)
-            fp.flush()
-        yield r
+    export = DatatableExport([TSVSink(fp)])
+    return export_iter_datatable(session, url, export, **kwargs)
+
+
+def fetch_page(session, url):
+    with session.tracer.operation('iter_datatable'):
+        return session.get(url)
+
+
+def following_pages(response, start_index):
+    """
+    Return the URLs of the pages after the page of the response,
+    which starts at row start_index, as far as they can be told from the
+    page: the "next page" link, and the links to later pages (numbered
+    pages, "last page") with the same path and a startIndex parameter.
+    """
+    next_o = element_attributes(response, NEXT_PAGE_ID)
+    if next_o is None:
+        return []
+    next_url = urljoin(response.url, next_o.get('href'))
+    mo = START_INDEX.search(next_url)
+    if mo is None:
+        return [next_url]
+    first = last = int(mo.group(2))
+    mo = NUM_RESULTS.search(next_url)
+    step = int(mo.group(1)) if mo else first - start_index
+    if step <= 0:
+        return [next_url]
+    path = next_url.split('?')[0]
+    content = response.content
+    for mo in LINK.finditer(content):
+        if inside_raw_text(content, mo.start()):
+            continue
+        href = parse_attributes(mo.group(1)).get('href', '')
+        href = urljoin(response.url, href)
+        mo = START_INDEX.search(href)
+        if mo and href.split('?')[0] == path:
+            last = max(last, int(mo.group(2)))
+    return [START_INDEX.sub(r'\g<1>%d' % i, next_url, count=1)
+            for i in range(first, last + 1, step)]
 
 
 def iter_datatable(session, url, **kwargs):
+    """
+    Yield the keys of the datatable at url, then each row, and finally
+    the response of the last page. With keep_history=True, the
+    responses of the earlier pages are kept in its history; otherwise
+    they are released once their rows have been yielded.
+
+    Pages that are known from the links on a page (see following_pages)
+    are fetched by up to max_workers threads, which are at most
+    max_workers pages ahead of the rows being yielded. The rows of each
+    page are parsed a batch at a time as they are consumed (see
+    parse_datatable_rows) and yielded in order. If end_page is given,
+    it is called after the last row of each page.
+    """
     url += '&numResults=1000&startIndex=0'
-    l = blackboard.slowlog()
-    response = session.get(url)
-    if kwargs.pop('edit_mode', False):
-        response = session.ensure_edit_mode(response)
-    history = list(response.history) + [response]
-    document = html5lib.parse(response.content, encoding=response.encoding)
-    keys, rows = parse_datatable(response, document, **kwargs)
+    edit_mode = kwargs.pop('edit_mode', False)
+    max_workers = kwargs.pop('max_workers', MAX_WORKERS)
+    end_page = kwargs.pop('end_page', None)
+    keep_history = kwargs.pop('keep_history', False)
+
+    def rows(batches):
+        # Rows are yielded outside of the traced operation,
+        # so that the caller's work is not counted as parse time.
+        while True:
+            with session.tracer.operation('iter_datatable'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            yield from batch
+
+    with session.tracer.operation('iter_datatable'):
+        response = session.get(url)
+        if edit_mode:
+            response = session.ensure_edit_mode(response)
+        history = list(response.history) + [response]
+        batches = parse_datatable_rows(response, **kwargs)
+        keys = next(batches)
     yield keys
-    yield from rows
-    next_id = 'listContainer_nextpage_top'
-    next_o = document.find('.//h:a[@id="%s"]' % next_id, NS)
-    if next_o is None:
-        l("Fetching datatable took %.1f s")
-    else:
-        l("Fetching datatable page 1 took %.1f s")
+    yield from rows(batches)
+    if end_page is not None:
+        end_page()
+    urls = following_pages(response, 0)
     page_number = 1
-    while next_o:
-        page_number += 1
-        url = urljoin(response.url, next_o.get('href'))
-        l = blackboard.slowlog()
-        response = session.get(url)
-        l("Fetching datatable page %d took %.4f s", page_number)
-        history += list(response.history) + [response]
-        document = html5lib.parse(response.content, encoding=response.encoding)
-        keys_, rows = parse_datatable(response, document, **kwargs)
-        if keys != keys_:
-            raise ValueError(
-                "Page %d keys (%r) do not match page 1 keys (%r)" %
-                (page_number, keys_, keys))
-        next_o = document.find('.//h:a[@id="%s"]' % next_id, NS)
-        yield from rows
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        while urls:
+            urls = iter(urls)
+            # The pages being fetched, in order
+            pending = collections.deque(
+                (u, executor.submit(fetch_page, session, u))
+                for u in itertools.islice(urls, max_workers))
+            try:
+                while pending:
+                    u, f = pending.popleft()
+                    page_number += 1
+                    response = f.result()
+                    next_url = next(urls, None)
+                    if next_url is not None:
+                        pending.append((next_url, executor.submit(
+                            fetch_page, session, next_url)))
+                    if keep_history:
+                        history += list(response.history) + [response]
+                    else:
+                        history = list(response.history) + [response]
+                    with session.tracer.operation('iter_datatable'):
+                        batches = parse_datatable_rows(response, **kwargs)
+                        keys_ = next(batches)
+                    if keys != keys_:
+                        raise ValueError(
+                            "Page %d keys (%r) do not match " % (
+                                page_number, keys_) +
+                            "page 1 keys (%r)" % (keys,))
+                    yield from rows(batches)
+                    if end_page is not None:
+                        end_page()
+            finally:
+                for u_, f in pending:
+                    f.cancel()
+            mo = START_INDEX.search(u)
+            urls = following_pages(response, int(mo.group(2)) if mo else 0)
     response.history = history[:-1]
     yield response
 
 
-def parse_datatable(response, document, extract=None, table_id=None):
-    if table_id is None:
-        table_id = 'listContainer_datatable'
-    table = document.find('.//h:table[@id="%s"]' % table_id, NS)
-    if table is None:
-        raise blackboard.ParserError(
-            "No table with id %r" % (table_id,), response)
-    header = table.find('./h:thead', NS)
+def header_keys(header_row):
     keys = []
-    for h in header[0]:
+    for h in header_row:
         text = element_text_content(h)
         sortheader = h.find('./h:a[@class="sortheader"]', NS)
         if sortheader:
@@ -85,14 +248,156 @@ def parse_datatable(response, document, extract=None, table_id=None):
             if mo:
                 text = mo.group(1)
         keys.append(text)
+    return keys
+
+
+def row_values(keys, row, extract=None):
+    r = []
+    for key, cell, v in zip(keys, row, row_text_content(row)):
+        if extract is not None:
+            v = extract(key, cell, v)
+        r.append(v)
+    return r
+
+
+def parse_datatable(response, document, extract=None, table_id=None):
+    if table_id is None:
+        table_id = 'listContainer_datatable'
+    table = document.find('.//h:table[@id="%s"]' % table_id, NS)
+    if table is None:
+        raise blackboard.ParserError(
+            "No table with id %r" % (table_id,), response)
+    header = table.find('./h:thead', NS)
+    keys = header_keys(header[0])
     rows = table.findall('./h:tbody/h:tr', NS)
-    res = []
-    for row in rows:
-        r = []
-        res.append(r)
-        for key, cell in zip(keys, row):
-            v = element_text_content(cell)
-            if extract is not None:
-                v = extract(key, cell, v)
-            r.append(v)
-    return keys, res
+    return keys, [row_values(keys, row, extract) for row in rows]
+
+
+def locate_rows(content, table_id):
+    """
+    Find the rows of the table with the given id in the raw page.
+    Returns the (start, end) of the first row of the <thead>, and a list
+    of the (start, end) of the rows of the table body.
+    Raises Unsupported if the rows cannot be located reliably.
+
+    >>> s = (b'<table id="t"><thead><tr><th>a</thead><tbody>' +
+    ...      b'<tr><td><table><tr><td>x</table></td></tr>\\n<tr><td>2' +
+    ...      b'</table>')
+    >>> header, rows = locate_rows(s, 't')
+    >>> s[header[0]:header[1]]
+    b'<tr><th>a'
+    >>> [s[a:b] for a, b in rows]
+    [b'<tr><td><table><tr><td>x</table></td></tr>', b'<tr><td>2']
+    """
+    found = find_start_tag(content, table_id)
+    if found is None or found[0] != b'table':
+        raise Unsupported("No table with id %r" % (table_id,))
+    section = None  # the open thead, tbody or tfoot
+    depth = 0  # of tables inside the cells of the table
+    header = None
+    rows = []
+    row_start = None
+    in_cell = False
+    for mo in TABLE_TOKEN.finditer(content, found[3]):
+        name = mo.group(3)
+        if name is None:
+            # A comment, the contents of a script or another tag
+            continue
+        name = name.lower()
+        end_tag = bool(mo.group(2))
+        if depth:
+            if name == b'table':
+                depth += -1 if end_tag else 1
+            continue
+        if name in (b'td', b'th'):
+            if row_start is None and not end_tag:
+                # The parser would insert a row
+                raise Unsupported("Cell outside of a row")
+            in_cell = not end_tag
+            continue
+        if name == b'table' and not end_tag:
+            if not in_cell:
+                # The parser would end the table
+                raise Unsupported("Table inside a table")
+            depth += 1
+            continue
+        if end_tag and name not in (b'tr', b'table', section):
+            # The parser would ignore it, but not where the row is parsed
+            raise Unsupported("End tag of a section that is not open")
+        if row_start is not None:
+            # Any other table tag ends the current row
+            row_end = mo.end() if name == b'tr' and end_tag else mo.start()
+            if section == b'thead':
+                header = header or (row_start, row_end)
+            elif section != b'tfoot':
+                rows.append((row_start, row_end))
+            row_start = None
+            in_cell = False
+        if name == b'tr':
+            if not end_tag:
+                row_start = mo.start()
+        elif name == b'table':
+            # The end of the table
+            if header is None:
+                raise Unsupported("No header row")
+            return header, rows
+        elif end_tag:
+            section = None
+        elif name in (b'caption', b'colgroup'):
+            # These close the open section
+            section = None
+        else:
+            section = name
+    raise Unsupported("No end of table %r" % (table_id,))
+
+
+def parse_rows(content, encoding, spans):
+    """Parse the rows of the page at the given spans."""
+    # Use the doctype of the page, since it decides how tables are parsed
+    mo = DOCTYPE.search(content, 0, 1024)
+    parts = [mo.group(0) if mo else b'', b'<table><tbody>']
+    parts.extend(content[a:b] for a, b in spans)
+    parts.append(b'</tbody></table>')
+    document = parse_html(b''.join(parts), encoding)
+    return document.findall('./h:body/h:table/h:tbody/h:tr', NS)
+
+
+def parse_datatable_rows(response, extract=None, table_id=None,
+                         batch_size=ROWS_PER_PARSE):
+    """
+    Yield the keys of the datatable in the response, and then its rows
+    in lists of up to batch_size rows.
+
+    Instead of parsing the whole page, which is mostly rows, the rows
+    are located in the raw page (see locate_rows) and parsed a batch
+    at a time, so only one batch of rows is in memory as elements.
+    The page is parsed in full if the rows cannot be located reliably.
+    """
+    if table_id is None:
+        table_id = 'listContainer_datatable'
+    content = response.content
+    encoding = response.encoding
+    keys = None
+    done = 0
+    try:
+        if encoding is None or not ascii_compatible(content, encoding):
+            raise Unsupported("Unknown or unsupported encoding")
+        header, spans = locate_rows(content, table_id)
+        header_rows = parse_rows(content, encoding, [header])
+        if len(header_rows) != 1:
+            raise Unsupported("Header row was not parsed as located")
+        keys = header_keys(header_rows[0])
+        yield keys
+        for i in range(0, len(spans), batch_size):
+            batch = spans[i:i + batch_size]
+            rows = parse_rows(content, encoding, batch)
+            if len(rows) != len(batch):
+                raise Unsupported("Rows were not parsed as located")
+            yield [row_values(keys, row, extract) for row in rows]
+            done += len(rows)
+    except Unsupported:
+        document = parse_response(response)
+        keys_, rows = parse_datatable(response, document, extract, table_id)
+        if keys is None:
+            yield keys_
+        yield rows[done:]
@@ -0,0 +1,95 @@
+import os
+import time
+import hashlib
+
+from blackboard import logger
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def hash_file(filename, h=None):
+    if h is None:
+        h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        while True:
+            chunk = fp.read(64*1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h
+
+
+def download_file(session, url, filename):
+    """
+    Download url to filename, going through filename + '.part'.
+
+    If a previous download was interrupted, the partial file is resumed
+    with an HTTP Range request when the server supports it.
+    The file is renamed to filename only when the number of bytes
+    matches the Content-Length reported by the server.
+    Returns a dict with the size and SHA-256 digest of the file.
+    """
+    part = filename + '.part'
+    try:
+        offset = os.path.getsize(part)
+    except FileNotFoundError:
+        offset = 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    started = time.time()
+    response = session.session.get(url, stream=True, headers=headers)
+    if response.status_code == 416:
+        # Range not satisfiable; the partial file is stale.
+        offset = 0
+        response = session.session.get(url, stream=True)
+    response.raise_for_status()
+    if offset and response.status_code == 206:
+        logger.debug("Resume download of %s at %d bytes", filename, offset)
+        h = hash_file(part)
+        mode = 'ab'
+    else:
+        offset = 0
+        h = hashlib.sha256()
+        mode = 'wb'
+    try:
+        expected = offset + int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        expected = None
+    size = offset
+    with open(part, mode) as fp:
+        for chunk in response.iter_content(chunk_size=64*1024):
+            if chunk:
+                h.update(chunk)
+                fp.write(chunk)
+                size += len(chunk)
+    session.tracer.add_request('GET', url, response, started,
+                               time.time() - started, size=size - offset)
+    if response.headers.get('Content-Encoding') not in (None, 'identity'):
+        # Content-Length counts compressed bytes
+        expected = None
+    if expected is not None and size != expected:
+        raise IncompleteDownload(
+            "%s: got %d bytes, expected %d" % (filename, size, expected))
+    os.replace(part, filename)
+    return dict(size=size, sha256=h.hexdigest())
+
+
+def file_matches(filename, metadata, check_digest=False):
+    """
+    Return True if filename exists and agrees with the size (and
+    optionally the SHA-256 digest) recorded in metadata.
+    """
+    try:
+        size = os.path.getsize(filename)
+    except FileNotFoundError:
+        return False
+    if metadata is None:
+        return True
+    if size != metadata['size']:
+        return False
+    if check_digest:
+        return hash_file(filename).hexdigest() == metadata['sha256']
+    return True
@@ -3,8 +3,8 @@ import ast
 import sys
 import collections
 
-import blackboard
 from blackboard import logger, ParserError
+from blackboard.trace import traced
 
 
 class JsObjectParser(ast.NodeVisitor):
@@ -75,7 +75,7 @@ def get_script_session_id(session):
         return session._script_session_id
     except AttributeError:
         pass
-    url = 'https://bb.au.dk/javascript/dwr/engine.js'
+    url = session.url('dwr_engine')
     # Bypass BlackboardSession.get and go straight to requests.Session instead
     dwr_engine = session.session.get(url).text
     mo = re.search('dwr.engine._origScriptSessionId = "(.*)";', dwr_engine)
@@ -231,12 +231,13 @@ def parse_js(code):
     return {call_id: data for batch_id, call_id, data in results}
 
 
+@traced
 def dwr_get_attempts_info_single_request(session, attempts):
     session_id = session.get_cookie('JSESSIONID', '/webapps/gradebook')
     payload = dict(
         callCount=len(attempts),
-        page='/webapps/gradebook/do/instructor/enterGradeCenter' +
-             '?course_id=%s&cvid=fullGC' % session.course_id,
+        page=session.endpoints.path('grade_center',
+                                    course_id=session.course_id),
         httpSessionId=session_id,
         scriptSessionId=get_script_session_id(session),
         batchId=42)
@@ -252,8 +253,8 @@ def dwr_get_attempts_info_single_request(session, attempts):
             param2='string:%s' % handin_id)
         payload.update(('c%d-%s' % (i, k), v) for k, v in call_data.items())
 
-    url = ('https://bb.au.dk/webapps/gradebook/dwr/call/plaincall/' +
-           'GradebookDWRFacade.getAttemptsInfo.dwr')
+    url = session.url('dwr_call', script='GradebookDWRFacade',
+                      method='getAttemptsInfo')
     response = session.post(url, payload)
     try:
         results = parse_js(response.text)
@@ -266,19 +267,18 @@ def dwr_get_attempts_info(session, attempts, batch_size=20):
     results = []
     for i in range(0, len(attempts), batch_size):
         j = min(len(attempts), i + batch_size)
-        l = blackboard.slowlog()
         results.extend(
             dwr_get_attempts_info_single_request(session, attempts[i:j]))
-        l("Fetching %d attempt lists took %%.1f s" % (j - i))
     return results
 
 
+@traced
 def dwr_get_groups(session):
     session_id = session.get_cookie('JSESSIONID', '/webapps/gradebook')
     payload = dict(
         callCount=1,
-        page='/webapps/gradebook/do/instructor/enterGradeCenter' +
-             '?course_id=%s&cvid=fullGC' % session.course_id,
+        page=session.endpoints.path('grade_center',
+                                    course_id=session.course_id),
         httpSessionId=session_id,
         scriptSessionId=get_script_session_id(session),
         batchId=42)
@@ -290,8 +290,8 @@ def dwr_get_groups(session):
         id=i,
         param0='string:%s' % course_id_raw)
     payload.update(('c%d-%s' % (i, k), v) for k, v in call_data.items())
-    url = ('https://bb.au.dk/webapps/gradebook/dwr/call/plaincall/' +
-           'GradebookDWRFacade.getGroups.dwr')
+    url = session.url('dwr_call', script='GradebookDWRFacade',
+                      method='getGroups')
     response = session.post(url, payload)
     try:
         results = parse_js(response.text)
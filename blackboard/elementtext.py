@@ -1,18 +1,66 @@
+import re
+import functools
 from xml.etree.ElementTree import ElementTree
 from six import BytesIO
-from html2text import html2text as html_to_markdown
+
+
+# Elements with one of these classes are not shown
+HIDDEN_CLASSES = frozenset(('hideoff', 'author_highlight'))
+
+
+@functools.lru_cache(maxsize=1024)
+def class_hidden(class_attribute):
+    """Return True if the class attribute contains a hidden class."""
+    return not HIDDEN_CLASSES.isdisjoint(class_attribute.split())
 
 
 def element_hidden(element):
-    class_list = element.get('class', '').split()
-    if 'hideoff' in class_list:
-        return True
-    if 'author_highlight' in class_list:
+    if class_hidden(element.get('class', '')):
         return True
     if 'display: none' in element.get('style', ''):
         return True
 
 
+_default_element_hidden = element_hidden
+
+
+def append_text_content(element, parts, element_hidden=None):
+    """
+    Append the text of the visible parts of element (and its tail)
+    to the list parts.
+
+    element_hidden is a function as above, or None to use the default
+    rules, which are checked inline since this is called for every cell
+    of every datatable.
+    """
+    append = parts.append
+    stack = [element]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        e = pop()
+        if isinstance(e, str):
+            # The tail of an element that has been visited
+            append(e)
+            continue
+        # A hidden element is skipped together with its tail
+        if element_hidden is None:
+            class_attribute = e.get('class')
+            if class_attribute and class_hidden(class_attribute):
+                continue
+            style = e.get('style')
+            if style and 'display: none' in style:
+                continue
+        elif element_hidden(e):
+            continue
+        if e.text:
+            append(e.text)
+        if e.tail:
+            push(e.tail)
+        if len(e):
+            stack.extend(reversed(e))
+
+
 def element_text_content(element, element_hidden=element_hidden):
     """
     >>> s = '''
@@ -31,14 +79,32 @@ def element_text_content(element, element_hidden=element_hidden):
     'au1234567'
     """
 
-    def visit(e):
-        if not element_hidden(e):
-            yield e.text or ''
-            for c in e:
-                yield ''.join(visit(c))
-            yield e.tail or ''
+    if element_hidden is _default_element_hidden:
+        element_hidden = None
+    parts = []
+    append_text_content(element, parts, element_hidden)
+    return ' '.join(''.join(parts).split())
+
+
+def row_text_content(row, element_hidden=element_hidden):
+    """
+    Return the text content of each cell of a table row,
+    like [element_text_content(cell) for cell in row], but faster.
 
-    return ' '.join(''.join(visit(element)).split())
+    >>> from xml.etree.ElementTree import fromstring
+    >>> row_text_content(fromstring(
+    ...     '<tr><td> a <b>b</b></td><td><i class="hideoff">c</i>d</td></tr>'))
+    ['a b', '']
+    """
+    if element_hidden is _default_element_hidden:
+        element_hidden = None
+    result = []
+    parts = []
+    for cell in row:
+        append_text_content(cell, parts, element_hidden)
+        result.append(' '.join(''.join(parts).split()))
+        del parts[:]
+    return result
 
 
 def element_to_html(element):
@@ -59,8 +125,358 @@ def element_to_html(element):
     return body
 
 
-def element_to_markdown(element):
-    return html_to_markdown(element_to_html(element))
+def html_to_markdown(html):
+    # html2text is slow to import, so only import it when needed.
+    from html2text import html2text
+    return html2text(html)
+
+
+WHITESPACE = re.compile(r'\s+')
+
+# Inline elements and the markup around their contents
+EMPHASIS = {'b': '**', 'strong': '**', 'i': '_', 'em': '_', 'code': '`',
+            'tt': '`'}
+# Elements whose contents are not shown
+SKIPPED = frozenset(('script', 'style', 'head', 'title', 'select'))
+# Elements that start and end a block; other elements are inline
+BLOCKS = frozenset((
+    'p', 'div', 'section', 'article', 'header', 'footer', 'nav', 'aside',
+    'address', 'center', 'figure', 'figcaption', 'form', 'fieldset',
+    'dl', 'dt', 'dd', 'caption', 'html', 'body',
+    'ul', 'ol', 'li', 'blockquote', 'pre', 'table', 'tr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+))
+
+
+class MarkdownWriter:
+    """
+    Convert the visible parts of elements to Markdown.
+
+    The element tree is walked with an explicit stack, as in
+    append_text_content. Inline text is collected in self.inline,
+    with whitespace collapsed, until a block ends; the block is then
+    turned into lines in self.lines, prefixed by the markers of the
+    enclosing blockquotes and lists.
+    """
+
+    def __init__(self, element_hidden=None):
+        if element_hidden is _default_element_hidden:
+            element_hidden = None
+        self.element_hidden = element_hidden
+        self.lines = []
+        self.inline = []
+        # [ordered, number of items] of each open list
+        self.lists = []
+        self.quote = 0
+        self.pre = 0
+        # Lists and tables are numbered, and the blocks of the same
+        # outermost list or table are not separated by blank lines
+        self.containers = 0
+        self.outermost = None
+        self.last_outermost = None
+        self.last_quote = 0
+        # '#' markers of the current heading
+        self.heading = ''
+        # List item marker (e.g. '  * ') of the next block
+        self.marker = None
+        # Number of cells so far in each open table row
+        self.cells = []
+        # Number of rows so far in each open table
+        self.rows = []
+
+    def hidden(self, element):
+        if self.element_hidden is not None:
+            return self.element_hidden(element)
+        class_attribute = element.get('class')
+        if class_attribute and class_hidden(class_attribute):
+            return True
+        style = element.get('style')
+        return bool(style and 'display: none' in style)
+
+    def write(self, element):
+        stack = [element]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            e = pop()
+            if isinstance(e, str):
+                # The tail of an element that has been visited
+                self.text(e)
+                continue
+            if isinstance(e, tuple):
+                end, e = e
+                end(e)
+                continue
+            if e.tail:
+                push(e.tail)
+            if not isinstance(e.tag, str):
+                # A comment or processing instruction
+                continue
+            tag = e.tag.rpartition('}')[2].lower()
+            if tag in SKIPPED or self.hidden(e):
+                continue
+            end = self.start(tag, e)
+            if end is not None:
+                push((end, e))
+            if len(e):
+                stack.extend(reversed(e))
+            if e.text:
+                push(e.text)
+
+    def getvalue(self):
+        self.end_block()
+        return '\n'.join(self.lines)
+
+    def text(self, s):
+        if self.pre:
+            self.inline.append(s)
+        else:
+            self.inline.append(WHITESPACE.sub(' ', s))
+
+    def start(self, tag, e):
+        """Handle the start of e and return the function ending it."""
+        if tag in EMPHASIS:
+            if self.pre:
+                return None
+            marker = EMPHASIS[tag]
+            self.inline.append(marker)
+            return lambda e: self.end_inline(marker)
+        if tag == 'a':
+            self.inline.append('[')
+            return self.end_link
+        if tag == 'img':
+            alt = WHITESPACE.sub(' ', e.get('alt') or '').strip()
+            src = e.get('src')
+            self.inline.append('![%s](%s)' % (alt, src) if src else alt)
+            return None
+        if tag == 'br':
+            self.inline.append('\n')
+            return None
+        if tag == 'hr':
+            self.end_block()
+            self.add_lines(['* * *'])
+            return None
+        if tag in ('td', 'th'):
+            if self.cells:
+                if self.cells[-1]:
+                    self.inline.append(' | ')
+                self.cells[-1] += 1
+            return None
+        if tag not in BLOCKS:
+            return None
+        self.end_block()
+        if tag in ('ul', 'ol'):
+            self.lists.append([tag == 'ol', 0])
+            self.open_container()
+            return self.end_list
+        if tag == 'li':
+            if self.marker is not None:
+                # The previous item has no text of its own
+                self.add_lines([''])
+            if self.lists:
+                ordered, n = self.lists[-1]
+                self.lists[-1][1] = n = n + 1
+            else:
+                ordered, n = False, 1
+            self.marker = (self.indent(self.lists[:-1]) +
+                           ('%d. ' % n if ordered else '* '))
+            return self.end_block_element
+        if tag == 'blockquote':
+            self.quote += 1
+            return self.end_quote
+        if tag == 'pre':
+            self.pre += 1
+            return self.end_pre
+        if tag[0] == 'h' and tag[1:].isdigit():
+            self.heading = '#' * int(tag[1])
+            return self.end_block_element
+        if tag == 'table':
+            self.rows.append(0)
+            self.open_container()
+            return self.end_table
+        if tag == 'tr':
+            self.cells.append(0)
+            return self.end_row
+        return self.end_block_element
+
+    def end_inline(self, marker):
+        inline = self.inline
+        if inline and inline[-1] == marker:
+            # Nothing between the markers
+            inline.pop()
+        elif inline and inline[-1].endswith(' '):
+            # Keep the whitespace outside of the markup
+            inline[-1] = inline[-1].rstrip(' ')
+            inline.append(marker + ' ')
+        else:
+            inline.append(marker)
+
+    def end_link(self, e):
+        href = e.get('href')
+        inline = self.inline
+        i = len(inline) - 1 - inline[::-1].index('[')
+        text = ''.join(inline[i + 1:]).strip()
+        del inline[i:]
+        if not href or href.startswith('javascript:'):
+            inline.append(text)
+        elif not text or text == href:
+            inline.append('<%s>' % href)
+        else:
+            inline.append('[%s](%s)' % (text, href))
+
+    def end_block_element(self, e):
+        self.end_block()
+
+    def end_list(self, e):
+        self.end_block()
+        if self.marker is not None:
+            self.add_lines([''])
+        self.lists.pop()
+        self.close_container()
+
+    def end_quote(self, e):
+        self.end_block()
+        self.quote -= 1
+
+    def end_table(self, e):
+        self.end_block()
+        self.rows.pop()
+        self.close_container()
+
+    def open_container(self):
+        self.containers += 1
+        if self.outermost is None:
+            self.outermost = (self.containers, 1)
+        else:
+            number, depth = self.outermost
+            self.outermost = (number, depth + 1)
+
+    def close_container(self):
+        number, depth = self.outermost
+        self.outermost = (number, depth - 1) if depth > 1 else None
+
+    def end_row(self, e):
+        self.end_block()
+        cells = self.cells.pop()
+        if self.rows:
+            self.rows[-1] += 1
+            if self.rows[-1] == 1 and cells:
+                # The first row is the header of a Markdown table
+                self.add_lines(['|'.join(['---'] * cells)])
+
+    def end_pre(self, e):
+        text = ''.join(self.inline).strip('\n')
+        del self.inline[:]
+        self.pre -= 1
+        if text:
+            self.add_lines(['```'] + text.split('\n') + ['```'])
+
+    @staticmethod
+    def indent(lists):
+        return ''.join('   ' if ordered else '  ' for ordered, n in lists)
+
+    def end_block(self):
+        """Turn the collected inline text into lines."""
+        if self.pre:
+            # A block inside <pre> is just a line break
+            self.inline.append('\n')
+            return
+        text = ''.join(self.inline)
+        del self.inline[:]
+        lines = [' '.join(line.split()) for line in text.split('\n')]
+        while lines and not lines[-1]:
+            lines.pop()
+        while lines and not lines[0]:
+            del lines[0]
+        if not lines:
+            return
+        if self.heading:
+            lines[0] = '%s %s' % (self.heading, lines[0])
+            self.heading = ''
+        # Lines that end with <br> end with a hard line break
+        lines[:-1] = [line + '  ' for line in lines[:-1]]
+        self.add_lines(lines)
+
+    def add_lines(self, lines):
+        prefix = '> ' * self.quote
+        indent = self.indent(self.lists)
+        first = self.marker if self.marker is not None else indent
+        self.marker = None
+        outermost = self.outermost and self.outermost[0]
+        if self.lines and not (outermost and
+                               outermost == self.last_outermost):
+            # Inside the blockquotes that both blocks are in
+            self.lines.append(('> ' * min(self.quote, self.last_quote))
+                              .rstrip())
+        self.last_outermost = outermost
+        self.last_quote = self.quote
+        self.lines.append(self.join(prefix + first, lines[0]))
+        self.lines.extend(self.join(prefix + indent, line)
+                          for line in lines[1:])
+
+    @staticmethod
+    def join(prefix, line):
+        # Keep trailing spaces in line, which may be a hard line break
+        return prefix + line if line.strip() else (prefix + line).rstrip()
+
+
+def element_to_markdown(element, element_hidden=element_hidden):
+    """
+    Convert the visible parts of element to Markdown.
+
+    >>> from xml.etree.ElementTree import fromstring
+    >>> print(element_to_markdown(fromstring(
+    ...     '<div><h2>Opgave <i>1</i></h2><p>Se <a href="http://x.dk/a">'
+    ...     'denne  side</a>\\n og <b>svar </b><span>kort</span>.</p>'
+    ...     '<p>Tak</p><p class="hideoff">skjult</p><hr/>'
+    ...     '<blockquote><p>citat</p><p>mere</p></blockquote></div>')))
+    ## Opgave _1_
+    <BLANKLINE>
+    Se [denne side](http://x.dk/a) og **svar** kort.
+    <BLANKLINE>
+    Tak
+    <BLANKLINE>
+    * * *
+    <BLANKLINE>
+    > citat
+    >
+    > mere
+
+    Line breaks are hard line breaks (two spaces before the newline):
+
+    >>> element_to_markdown(fromstring('<p>Hej<br/>Tak<br/></p>'))
+    'Hej  \\nTak'
+
+    Lists may be nested, list items and table rows are not separated
+    by blank lines, and the first row of a table is its header:
+
+    >>> print(element_to_markdown(fromstring(
+    ...     '<div><ol><li>en</li><li>to<ul><li>a</li><li><p>b</p>'
+    ...     '<p>c</p></li></ul></li></ol>'
+    ...     '<table><tr><th>Navn</th><th>Point</th></tr>'
+    ...     '<tr><td>Bo</td><td>7</td></tr></table>'
+    ...     '<pre>def f():\\n    return 1\\n</pre>'
+    ...     '<script>x = 1</script>Slut<!-- ignored --></div>')))
+    1. en
+    2. to
+       * a
+       * b
+         c
+    <BLANKLINE>
+    Navn | Point
+    ---|---
+    Bo | 7
+    <BLANKLINE>
+    ```
+    def f():
+        return 1
+    ```
+    <BLANKLINE>
+    Slut
+    """
+    writer = MarkdownWriter(element_hidden)
+    writer.write(element)
+    return writer.getvalue()
 
 
 def form_field_value(element):
@@ -0,0 +1,125 @@
+"""
+The URLs of the Blackboard pages and services that bbfetch uses.
+
+Each BlackboardSession has an Endpoints object in session.endpoints,
+and backend code builds URLs with session.url(name, **params)
+instead of spelling out https://bb.au.dk/... inline.
+To use another Blackboard installation, a mirror, a caching proxy or
+a mock server (blackboard.mockserver), change base_url, or override
+individual templates by passing them to Endpoints.
+"""
+
+import collections
+
+from six.moves.urllib.parse import urlparse
+
+
+TEMPLATES = collections.OrderedDict([
+    # Login
+    ('login', '/webapps/bb-auth-provider-shibboleth-BBLEARN/execute/' +
+              'shibbolethLogin?authProviderId={auth_provider_id}'),
+    ('shibboleth_login', '/webapps/bb-auth-provider-shibboleth-BBLEARN/' +
+                         'execute/shibbolethLogin'),
+    ('login_page', '/webapps/login/'),
+    ('logged_out', '/webapps/portal/execute/tabs/tabAction' +
+                   '?tab_tab_group_id=_21_1'),
+    # Course
+    ('course_main', '/webapps/blackboard/execute/courseMain' +
+                    '?course_id={course_id}'),
+    ('edit_mode', '/webapps/blackboard/execute/doCourseMenuAction' +
+                  '?cmd=setDesignerParticipantViewMode' +
+                  '&courseId={course_id}&mode=designer'),
+    ('dashboard', '/webapps/blackboard/content/manageDashboard.jsp' +
+                  '?course_id={course_id}&sortCol=LastLoginCol&sortDir=D'),
+    ('user_manager', '/webapps/blackboard/execute/userManager' +
+                     '?course_id={course_id}'),
+    ('group_list', '/webapps/bb-group-mgmt-LEARN/execute/' +
+                   'groupInventoryList?course_id={course_id}' +
+                   '&toggleType=users&chkAllRoles=on'),
+    # Grade Centre
+    ('gradebook', '/webapps/gradebook/do/instructor/getJSONData' +
+                  '?course_id={course_id}'),
+    ('attempt_counts', '/webapps/gradebook/do/instructor/' +
+                       'getJSONUniqueAttemptData?course_id={course_id}' +
+                       '&itemId={item_id}'),
+    ('grade_center', '/webapps/gradebook/do/instructor/enterGradeCenter' +
+                     '?course_id={course_id}&cvid=fullGC'),
+    ('download_assignment', '/webapps/gradebook/do/instructor/' +
+                            'downloadAssignment' +
+                            '?outcome_definition_id={assignment_id}' +
+                            '&showAll=true&course_id={course_id}' +
+                            '&startIndex=0'),
+    ('dwr_engine', '/javascript/dwr/engine.js'),
+    ('dwr_call', '/webapps/gradebook/dwr/call/plaincall/' +
+                 '{script}.{method}.dwr'),
+    # Assignments
+    ('attempt', '/webapps/assignment/gradeAssignmentRedirector' +
+                '?course_id={course_id}&attempt_id={attempt_id}'),
+    ('group_attempt', '/webapps/assignment/gradeAssignmentRedirector' +
+                      '?course_id={course_id}&groupAttemptId={attempt_id}'),
+    ('submit_grade', '/webapps/assignment//gradeAssignment/submit'),
+    ('submit_group_grade', '/webapps/assignment//gradeGroupAssignment/submit'),
+    ('rubric', '/webapps/rubric/do/course/gradeRubric' +
+               '?mode=grid&isPopup=true&rubricCount=1&prefix={prefix}' +
+               '&course_id={course_id}&maxValue=1.0&rubricId={rubric_id}' +
+               '&viewOnly=false&displayGrades=true&type=grading' +
+               '&rubricAssoId={assoc_id}'),
+    # Discussion board
+    ('forums', '/webapps/discussionboard/do/conference' +
+               '?action=list_forums&course_id={course_id}' +
+               '&nav=discussion_board'),
+    ('forum_threads', '/webapps/discussionboard/do/forum' +
+                      '?action=list_threads&nav=discussion_board' +
+                      '&course_id={course_id}&conf_id={conf_id}' +
+                      '&forum_id={forum_id}&showAll=true'),
+    ('forum_messages', '/webapps/discussionboard/do/message' +
+                       '?conf_id={conf_id}&forum_id={forum_id}' +
+                       '&action=collect' +
+                       '&blackboard.platform.security.NonceUtil.nonce=' +
+                       '{nonce}&requestType=thread&course_id={course_id}'),
+])
+
+
+class Endpoints:
+    """
+    >>> e = Endpoints()
+    >>> e.url('attempt', course_id='_1234_1', attempt_id='_42_1')
+    ... # doctest: +ELLIPSIS
+    'https://bb.au.dk/webapps/...?course_id=_1234_1&attempt_id=_42_1'
+    >>> e.path('login')  # doctest: +ELLIPSIS
+    '/webapps/.../shibbolethLogin?authProviderId=_102_1'
+    >>> e = Endpoints('http://127.0.0.1:8080/', dict(login_page='/login'))
+    >>> e.url('login_page'), e.host
+    ('http://127.0.0.1:8080/login', '127.0.0.1')
+    """
+
+    def __init__(self, base_url='https://bb.au.dk', templates=None,
+                 auth_provider_id='_102_1', login_host='wayf.au.dk'):
+        self.base_url = base_url
+        self.templates = collections.OrderedDict(TEMPLATES)
+        self.templates.update(templates or {})
+        # The Shibboleth authentication provider that logs in through WAYF
+        self.auth_provider_id = auth_provider_id
+        # Login forms served from this host are filled out by wayf_login
+        self.login_host = login_host
+
+    @property
+    def base_url(self):
+        return self._base_url
+
+    @base_url.setter
+    def base_url(self, base_url):
+        self._base_url = base_url.rstrip('/')
+
+    @property
+    def host(self):
+        """The host name used as the domain of the session cookies."""
+        return urlparse(self.base_url).hostname
+
+    def path(self, name, **params):
+        """Return the path (and query) of the endpoint name."""
+        params.setdefault('auth_provider_id', self.auth_provider_id)
+        return self.templates[name].format(**params)
+
+    def url(self, name, **params):
+        return self.base_url + self.path(name, **params)
@@ -1,6 +1,6 @@
 import blackboard
 
-from blackboard.datatable import fetch_datatable
+from blackboard.datatable import stream_datatable
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
@@ -8,18 +8,22 @@ NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
 def get_all_users(session):
     url = (
-        'https://bb.au.dk/webapps/blackboard/execute/userManager' +
+        session.endpoints.base_url +
+        '/webapps/blackboard/execute/userManager' +
         '?context=userPicker&course_id=_13158_1&enrollTypeString=UnEnrolled' +
         '&sortCol=userFirstName&sortDir=ASCENDING' +
         '&userInfoSearchKeyString=UserName' +
         '&userInfoSearchOperatorString=Contains&userInfoSearchText=a')
-    response, keys, rows = fetch_datatable(session, url, 'get_all_users.csv')
+    rows = stream_datatable(session, url, 'get_all_users.csv',
+                            keep_history=True)
+    users = parse_all_users(rows.keys, rows)
+    response = rows.response
     with open('all_users.html', 'wb') as fp:
         fp.write(url.encode('ascii') + b'\n')
         for r in list(response.history) + [response]:
             fp.write(('%s %s\n' % (r.status_code, r.url)).encode('ascii'))
         fp.write(response.content)
-    return parse_all_users(keys, rows)
+    return users
 
 
 def parse_all_users(keys, rows):
@@ -6,8 +6,7 @@ from blackboard.backend import fetch_groups
 
 
 def fetch_users(session):
-    url = ('https://bb.au.dk/webapps/blackboard/execute/userManager' +
-           '?course_id=%s' % session.course_id)
+    url = session.url('user_manager')
     response, keys, rows = fetch_datatable(session, url)
     try:
         return parse_users(keys, rows)
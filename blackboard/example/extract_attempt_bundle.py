@@ -5,33 +5,18 @@ import json
 import zipfile
 import argparse
 import subprocess
+import concurrent.futures
 
-
-FILENAME = re.compile(
-    r'(?P<handin>[A-Za-z0-9 -]+)_(?P<group>[A-Za-z0-9 -]+)_' +
-    r'forsøg_(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})-' +
-    r'(?P<hour>[0-9]{2})-(?P<minute>[0-9]{2})-(?P<second>[0-9]{2})' +
-    r'(?P<suffix>.*)')
-
-
-METADATA = re.compile(
-    br'Navn: (?P<group>[A-Za-z0-9 -]+)\n' +
-    br'Opgave: (?P<handin>[A-Za-z0-9 -]+)\n' +
-    br'Dato for svar: (?P<time>[0-9a-zA-Z:. ]+)\n' +
-    br'Aktuel karakter: (?:(?P<nograde>Endnu ikke karaktergivet)|(?P<grade>\d+\.?\d*))\n\n' +
-    br'Svarfelt:\n(?P<answer>.*)\n\n' +
-    br'Kommentarer:\n(?P<comments>.*)\n\n' +
-    br'Filer:\n(?P<files>.*)\n',
-    re.S)
-
-
-NO_FILES = b'Der blev ikke vedh\xc3\xa6ftet filer til dette svar.'
-FILES_FIELD = re.compile(
-    br'\tOprindeligt filnavn: (?P<original>.+)\n\tFilnavn: (?P<filename>.+)\n')
+from blackboard.bundle import FILENAME, parse_metadata, extract_members
+from blackboard.prefetch import Prefetcher
 
 
 EXTENSIONS = ['.pdf']
 
+# Number of handins to extract ahead of the one being graded
+# (before the bulk extraction gets to them)
+PREFETCH = 3
+
 
 def downloads_dir():
     d = None
@@ -91,7 +76,9 @@ def previous_handin(group, data):
             return annotated
 
 
-def handin_loop(i, handin):
+def handin_loop(i, handin, prefetcher):
+    # Wait for this handin to be extracted and extract the next ones
+    prefetcher.get(i)
     group, data = handin
     previous = previous_handin(group, data)
     print('')
@@ -114,14 +101,16 @@ def handin_loop(i, handin):
             break
 
 
-def grade_loop(handins):
+def grade_loop(handins, prefetcher):
+    if handins:
+        prefetcher.schedule(-1)
     while True:
         for i, (group, data) in enumerate(handins):
             print_handin_info(i, group, data)
         try:
             i = int(input()) - 1
             if 0 <= i < len(handins):
-                handin_loop(i, handins[i])
+                handin_loop(i, handins[i], prefetcher)
         except (KeyboardInterrupt, EOFError):
             print('')
             break
@@ -137,6 +126,49 @@ def print_comments(handins):
             print("no comments\n")
 
 
+def index_handins(zf, attempt, reject_invalid):
+    """
+    Compute the output filename of each handin in the ZipFile zf
+    without writing anything.
+    Returns a dict of handins by group and a list of extraction jobs.
+    """
+
+    handins = {}
+    jobs = []
+    for zinfo in zf.infolist():
+        filename = zinfo.filename
+        o = re.fullmatch(FILENAME, filename)
+
+        if not o:
+            print("Could not match filename: %r" % (filename,))
+            continue
+
+        d = o.groupdict()
+
+        d['handin'] = re.sub('^Aflevering ', '', d['handin'])
+        d['handin'] += '_%d' % attempt
+        d['group'] = re.sub('^Gruppe ([A-Z]*\d+) - ', r'\1-',
+                            d['group']).replace(' ', '0')
+        # d['suffix'] = re.sub('[^0-9A-Za-z_.-]+', '_', d['suffix'])
+        d['extension'] = os.path.splitext(d['suffix'])[1]
+
+        output_folder = d['handin']
+        output_base = os.path.join(output_folder, d['group'])
+
+        handin = handins.setdefault(d['group'], {})
+        handin.setdefault('comments_file', output_base + '_comments.txt')
+
+        if o.group('suffix') == '.txt':
+            handin['metadata'] = parse_metadata(zf.read(zinfo))
+        else:
+            if reject_invalid and d['extension'] not in EXTENSIONS:
+                print("Rejecting %r" % d['suffix'])
+            else:
+                handin['file'] = output_base + '_handin' + d['extension']
+                jobs.append((filename, handin['file']))
+    return handins, jobs
+
+
 def main():
     args = sys.argv[1:]
     if len(args) == 0:
@@ -153,70 +185,39 @@ def main():
 
     reject_invalid = True
 
-    handins = {}
-
     with zipfile.ZipFile(zipname, 'r') as zf:
-        for zinfo in zf.infolist():
-            filename = zinfo.filename
-            o = re.fullmatch(FILENAME, filename)
-
-            if not o:
-                print("Could not match filename: %r" % (filename,))
-                continue
-
-            d = o.groupdict()
-
-            d['handin'] = re.sub('^Aflevering ', '', d['handin'])
-            d['handin'] += '_%d' % attempt
-            d['group'] = re.sub('^Gruppe ([A-Z]*\d+) - ', r'\1-',
-                                d['group']).replace(' ', '0')
-            # d['suffix'] = re.sub('[^0-9A-Za-z_.-]+', '_', d['suffix'])
-            d['extension'] = os.path.splitext(d['suffix'])[1]
-
-            output_folder = d['handin']
-            if not os.path.exists(output_folder):
-                os.mkdir(output_folder)
-
-            output_base = os.path.join(output_folder, d['group'])
-
-            handin = handins.setdefault(d['group'], {})
-            handin.setdefault('comments_file', output_base + '_comments.txt')
-
-            if o.group('suffix') == '.txt':
-                data = zf.read(zinfo)
-                # print(data)
-                # o2 = re.fullmatch(METADATA, data)
-                # if not o2:
-                #     print("Could not match metadata: %r" % data)
-                # else:
-                #     files_field = o2.group('files')
-                #     if files_field == NO_FILES:
-                #         print("No files")
-                #     else:
-                #         o3 = re.fullmatch(FILES_FIELD, files_field)
-                #         original =
-                #         print(o3)
-
-                #     for k, v in o2.groupdict().items():
-                #         if v:
-                #             print("%s:\n%s" % (k, v.decode()))
-                #     print('')
-            else:
-                if reject_invalid and d['extension'] not in EXTENSIONS:
-                    print("Rejecting %r" % d['suffix'])
-                else:
-                    handin['file'] = output_base + '_handin' + d['extension']
-                    try:
-                        with open(handin['file'], 'xb') as fp:
-                            fp.write(zf.read(zinfo))
-                            print("extracting %r (%d bytes)"
-                                  % (handin['file'], fp.tell()))
-                    except FileExistsError:
-                        print("skipping %r" % handin['file'])
+        handins, jobs = index_handins(zf, attempt, reject_invalid)
+
+    for output_folder in sorted(set(os.path.dirname(f) for m, f in jobs)):
+        os.makedirs(output_folder, exist_ok=True)
 
     handins = sorted(handins.items(), key=lambda x: x[0])
     handins = [(group, data) for group, data in handins if 'file' in data]
-    grade_loop(handins)
+    member = {outfile: m for m, outfile in jobs}
+
+    # Extract all handins in parallel in the background while grading
+    bulk = concurrent.futures.ThreadPoolExecutor(1)
+    extracted = bulk.submit(lambda: list(extract_members(zipname, jobs)))
+
+    def extract(handin):
+        # Extract the handins the grader gets to next right away rather
+        # than waiting for the bulk extraction to get to them.
+        # Extracted files only appear when they are complete.
+        group, data = handin
+        if not os.path.exists(data['file']):
+            list(extract_members(
+                zipname, [(member[data['file']], data['file'])], 1))
+
+    prefetcher = Prefetcher(handins, extract, ahead=PREFETCH)
+    try:
+        grade_loop(handins, prefetcher)
+    finally:
+        prefetcher.close()
+        if not extracted.done():
+            print("Waiting for the remaining handins to be extracted")
+        bulk.shutdown(wait=True)
+    # Raise any error from the bulk extraction
+    extracted.result()
     print_comments(handins)
 
 
@@ -1,10 +1,8 @@
 import re
-import html5lib
-from xml.etree.ElementTree import ElementTree
-from six import BytesIO
 import blackboard
 from blackboard.datatable import fetch_datatable
 from blackboard.elementtext import element_to_markdown, element_text_content
+from blackboard.htmlparser import parse_response
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
@@ -38,14 +36,13 @@ def get_thread_posts(session, forum_id, nonce, threads):
     # the previously displayed list of posts.
     # Therefore we use action=collect instead, which by default
     # sorts by date in descending order.
+    conf_id, forum_id = forum_id
     url = (
-        'https://bb.au.dk/webapps/discussionboard/do/message' +
-        '?conf_id=%s&forum_id=%s&action=collect' % forum_id +
-        '&blackboard.platform.security.NonceUtil.nonce=%s' % nonce +
-        ''.join('&formCBs=%s' % t for t in ids) +
-        '&requestType=thread&course_id=%s' % session.course_id)
+        session.url('forum_messages', conf_id=conf_id, forum_id=forum_id,
+                    nonce=nonce) +
+        ''.join('&formCBs=%s' % t for t in ids))
     r = session.get(url)
-    document = html5lib.parse(r.content, encoding=r.encoding)
+    document = parse_response(r)
     return parse_thread_posts(document)
 
 
@@ -92,25 +89,17 @@ def get_forum_ids(session):
             raise ValueError("Could not match %s" % link.get('href'))
         return (mo.group(1), mo.group(2)), v
 
-    url = (
-        'https://bb.au.dk/webapps/discussionboard/do/conference' +
-        '?action=list_forums&course_id=%s' % session.course_id +
-        '&nav=discussion_board')
+    url = session.url('forums')
     response, keys, rows = fetch_datatable(session, url, extract=extract)
     title_col = keys.index('title')
     return [row[title_col] for row in rows]
 
 
 def get_thread_ids(session, forum_id):
-    url = (
-        'https://bb.au.dk/webapps/discussionboard/do/forum' +
-        '?action=list_threads&nav=discussion_board' +
-        '&course_id=%s' % session.course_id +
-        '&conf_id=%s&forum_id=%s' % forum_id +
-        '&showAll=true'
-    )
+    conf_id, forum_id = forum_id
+    url = session.url('forum_threads', conf_id=conf_id, forum_id=forum_id)
     r = session.get(url)
-    document = html5lib.parse(r.content, encoding=r.encoding)
+    document = parse_response(r)
     return parse_thread_ids(document)
 
 
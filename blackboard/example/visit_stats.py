@@ -1,16 +1,13 @@
 import blackboard
-from blackboard.datatable import fetch_datatable
+from blackboard.datatable import stream_datatable
 
 
 def get_visit_stats(session):
-    url = (
-        'https://bb.au.dk/webapps/blackboard/content/manageDashboard.jsp' +
-        '?course_id=%s' % session.course_id +
-        '&sortCol=LastLoginCol&sortDir=D')
-    response, keys, rows = fetch_datatable(session, url)
-    # for r in list(response.history) + [response]:
+    url = session.url('dashboard')
+    rows = stream_datatable(session, url, keep_history=True)
+    # for r in list(rows.response.history) + [rows.response]:
     #     print("%s %s" % (r.status_code, r.url))
-    return parse_visit_stats(keys, rows)
+    return parse_visit_stats(rows.keys, rows)
 
 
 def parse_visit_stats(keys, rows):
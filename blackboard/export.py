@@ -0,0 +1,256 @@
+"""
+Write the rows of a datatable to files while they are fetched.
+
+A DatatableExport writes the keys and rows of a datatable to any number
+of sinks: tab-separated or comma-separated values (TSVSink, CSVSink),
+JSON Lines (JSONLinesSink) or a table in an SQLite database
+(SQLiteSink). stream_datatable uses it as a tee, writing each row as it
+is passed on to the caller:
+
+    rows = stream_datatable(session, url, sinks=[
+        TSVSink('users.tsv'), SQLiteSink('users.db', 'users')])
+    for row in rows:
+        ...
+
+Sinks buffer what they write, and are flushed at the end of each page
+of the datatable, or every flush_rows rows, so that an interrupted
+export still leaves the rows of the pages that were fetched.
+"""
+
+import csv
+import json
+import sqlite3
+
+
+# Size of the write buffer of the file sinks
+BUFFER_SIZE = 1 << 16
+
+# Number of rows handed to the sinks at a time
+ROWS_PER_WRITE = 100
+
+
+class Sink:
+    """
+    Base class of the sinks. open is called with the keys of the
+    datatable, write_rows with lists of rows, flush when the rows
+    written so far must reach the file, and close at the end.
+    """
+
+    def open(self, keys):
+        self.keys = keys
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    """A sink that writes text to a filename or an open text file."""
+
+    def __init__(self, file):
+        self.file = file
+        self.fp = None
+
+    def open(self, keys):
+        super().open(keys)
+        if isinstance(self.file, str):
+            self.fp = open(self.file, 'w', newline='', encoding='utf-8',
+                           buffering=BUFFER_SIZE)
+            self._close_fp = True
+        else:
+            self.fp = self.file
+            self._close_fp = False
+
+    def flush(self):
+        if self.fp is not None:
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None and self._close_fp:
+            self.fp.close()
+        self.fp = None
+
+
+class CSVSink(FileSink):
+    """Rows as comma-separated values, with the keys as the first row."""
+
+    dialect = 'excel'
+
+    def open(self, keys):
+        super().open(keys)
+        self.writer = csv.writer(self.fp, dialect=self.dialect)
+        self.writer.writerow(keys)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+
+class TSVSink(CSVSink):
+    """Rows as tab-separated values, with the keys as the first row."""
+
+    dialect = 'excel-tab'
+
+
+class JSONLinesSink(FileSink):
+    """
+    One JSON object per row, mapping the keys to the values.
+    Values that JSON cannot represent are written as strings.
+
+    >>> import io
+    >>> fp = io.StringIO()
+    >>> sink = JSONLinesSink(fp)
+    >>> sink.open(['a', 'b'])
+    >>> sink.write_rows([['x', 1], ['y', (2, 3)]])
+    >>> print(fp.getvalue(), end='')
+    {"a": "x", "b": 1}
+    {"a": "y", "b": [2, 3]}
+    """
+
+    def write_rows(self, rows):
+        keys = self.keys
+        self.fp.write(''.join(
+            json.dumps(dict(zip(keys, row)), default=str) + '\n'
+            for row in rows))
+
+
+def column_names(keys):
+    """
+    Return names for SQL columns holding the given keys, which may be
+    empty or repeated.
+
+    >>> column_names(['a', '', 'b', 'a', 'A'])
+    ['a', 'column2', 'b', 'a_4', 'A_5']
+    """
+    names = []
+    seen = set()
+    for i, key in enumerate(keys, 1):
+        name = key or 'column%d' % i
+        if name.lower() in seen:
+            name = '%s_%d' % (name, i)
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def sql_value(value):
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    return json.dumps(value, default=str)
+
+
+class SQLiteSink(Sink):
+    """
+    Rows in a table of an SQLite database, which is replaced if it
+    exists. Every column has the text of a key as its name (see
+    column_names). Values that are not numbers or strings are stored
+    as JSON. Each flush commits the rows written since the last one.
+
+    >>> sink = SQLiteSink(':memory:', 'users')
+    >>> sink.open(['username', 'groups'])
+    >>> sink.write_rows([['au1', ['G1', 'G2']], ['au2', []]])
+    >>> sink.flush()
+    >>> sink.connection.execute('SELECT * FROM users').fetchall()
+    [('au1', '["G1", "G2"]'), ('au2', '[]')]
+    """
+
+    def __init__(self, filename, table):
+        self.filename = filename
+        self.table = table
+        self.connection = None
+
+    def open(self, keys):
+        super().open(keys)
+        self.connection = sqlite3.connect(self.filename)
+        table = quote_identifier(self.table)
+        columns = [quote_identifier(c) for c in column_names(keys)]
+        with self.connection:
+            self.connection.execute('DROP TABLE IF EXISTS %s' % table)
+            self.connection.execute('CREATE TABLE %s (%s)' % (
+                table, ', '.join(columns)))
+        self.insert = 'INSERT INTO %s VALUES (%s)' % (
+            table, ', '.join('?' * len(columns)))
+
+    def write_rows(self, rows):
+        n = len(self.keys)
+        values = []
+        for row in rows:
+            v = [sql_value(v) for v in row[:n]]
+            # Rows may have fewer cells than there are keys
+            v += [None] * (n - len(v))
+            values.append(v)
+        self.connection.executemany(self.insert, values)
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+def quote_identifier(name):
+    """
+    >>> quote_identifier('a"b')
+    '"a""b"'
+    """
+    return '"%s"' % name.replace('"', '""')
+
+
+class DatatableExport:
+    """
+    Write the keys and rows of a datatable to the given sinks.
+
+    Rows are handed to the sinks ROWS_PER_WRITE at a time, so they must
+    not be modified after they are passed to write_row. The sinks are
+    flushed every flush_rows rows if flush_rows is given, at the end of
+    each page (see end_page) if flush_pages is true, and when the export
+    is closed.
+    """
+
+    def __init__(self, sinks, flush_rows=None, flush_pages=True):
+        self.sinks = list(sinks)
+        self.flush_rows = flush_rows
+        self.flush_pages = flush_pages
+        self.rows = []
+        self.unflushed = 0
+
+    def open(self, keys):
+        for sink in self.sinks:
+            sink.open(keys)
+
+    def write_row(self, row):
+        self.rows.append(row)
+        self.unflushed += 1
+        if self.flush_rows is not None and self.unflushed >= self.flush_rows:
+            self.flush()
+        elif len(self.rows) >= ROWS_PER_WRITE:
+            self.write_pending()
+
+    def end_page(self):
+        if self.flush_pages:
+            self.flush()
+
+    def flush(self):
+        self.write_pending()
+        for sink in self.sinks:
+            sink.flush()
+        self.unflushed = 0
+
+    def write_pending(self):
+        if self.rows:
+            for sink in self.sinks:
+                sink.write_rows(self.rows)
+            self.rows = []
+
+    def close(self):
+        self.write_pending()
+        for sink in self.sinks:
+            sink.close()
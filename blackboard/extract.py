@@ -0,0 +1,436 @@
+"""
+Extraction of archives that students hand in.
+
+Archives are extracted in a process pool so that extraction overlaps with
+downloading. The pool uses the spawn start method, since the process
+that starts it runs other threads. Each archive is checked against a
+limit on its total uncompressed size and number of files before anything
+is extracted (by listing it first, for formats handled by an external
+program), and
+a manifest in each directory records which archives have been extracted
+so that they are skipped on subsequent runs.
+"""
+
+import os
+import bz2
+import gzip
+import lzma
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import concurrent.futures
+
+from blackboard import logger
+
+
+MANIFEST = '.bbfetch-extracted.json'
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveLimitExceeded(ArchiveError):
+    pass
+
+
+def check_limits(filename, sizes, max_size, max_files):
+    sizes = list(sizes)
+    if max_files is not None and len(sizes) > max_files:
+        raise ArchiveLimitExceeded(
+            "%s contains %d files (limit is %d)" %
+            (filename, len(sizes), max_files))
+    total = sum(sizes)
+    if max_size is not None and total > max_size:
+        raise ArchiveLimitExceeded(
+            "%s expands to %d bytes (limit is %d)" %
+            (filename, total, max_size))
+
+
+def safe_path(path, name):
+    """
+    Join path and the archive member name, rejecting names that would
+    escape the destination directory.
+    """
+    root = os.path.realpath(path)
+    target = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([target, root]) != root:
+        raise ArchiveError("Refusing to extract %r outside %r" % (name, path))
+    return target
+
+
+def write_member(src, target):
+    """
+    Copy the file object src to target through target + '.part'.
+
+    The files of attempt directories are hardlinks to read-only objects
+    of the download store (see blackboard.store), so target is replaced
+    rather than opened for writing, which would write through the link.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + '.part', 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+    os.replace(target + '.part', target)
+
+
+def extract_zip(filename, path, max_size, max_files):
+    """
+    Extract a ZIP file. A member with the name of an existing file,
+    e.g. a hardlink into the download store, replaces it:
+
+    >>> d = tempfile.mkdtemp()
+    >>> with open(os.path.join(d, 'object'), 'wb') as fp:
+    ...     _ = fp.write(b'stored')
+    >>> os.chmod(os.path.join(d, 'object'), 0o444)
+    >>> os.link(os.path.join(d, 'object'), os.path.join(d, 'report.pdf'))
+    >>> with zipfile.ZipFile(os.path.join(d, 'code.zip'), 'w') as zf:
+    ...     zf.writestr('report.pdf', b'from the archive')
+    >>> extract_zip(os.path.join(d, 'code.zip'), d, None, None)
+    1
+    >>> for name in ('object', 'report.pdf'):
+    ...     with open(os.path.join(d, name), 'rb') as fp:
+    ...         print(name, fp.read())
+    object b'stored'
+    report.pdf b'from the archive'
+    >>> shutil.rmtree(d)
+    """
+    with zipfile.ZipFile(filename) as zf:
+        members = [m for m in zf.infolist() if not m.filename.endswith('/')]
+        check_limits(filename, (m.file_size for m in members),
+                     max_size, max_files)
+        for m in members:
+            safe_path(path, m.filename)
+        for m in members:
+            with zf.open(m) as src:
+                write_member(src, safe_path(path, m.filename))
+    return len(members)
+
+
+def extract_tar(filename, path, max_size, max_files):
+    with tarfile.open(filename) as tf:
+        members = []
+        for m in tf.getmembers():
+            if m.isdir():
+                continue
+            if not m.isfile():
+                # Skip links, devices and fifos
+                logger.debug("Skip %s in %s", m.name, filename)
+                continue
+            safe_path(path, m.name)
+            members.append(m)
+        check_limits(filename, (m.size for m in members),
+                     max_size, max_files)
+        for m in members:
+            with tf.extractfile(m) as src:
+                write_member(src, safe_path(path, m.name))
+    return len(members)
+
+
+def extract_compressed(opener):
+    """
+    Create a handler for a single compressed file such as foo.txt.gz,
+    which is decompressed to foo.txt.
+    The uncompressed size is not stored reliably in these formats,
+    so the limit is enforced while decompressing.
+    """
+
+    def extract(filename, path, max_size, max_files):
+        base = os.path.splitext(os.path.basename(filename))[0]
+        target = safe_path(path, base)
+        written = 0
+        with opener(filename) as src, open(target + '.part', 'wb') as dst:
+            while True:
+                chunk = src.read(COPY_BUFSIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if max_size is not None and written > max_size:
+                    dst.close()
+                    os.remove(target + '.part')
+                    raise ArchiveLimitExceeded(
+                        "%s expands to more than %d bytes" %
+                        (filename, max_size))
+                dst.write(chunk)
+        os.replace(target + '.part', target)
+        return 1
+
+    return extract
+
+
+def parse_7z_listing(text):
+    r"""
+    Return the sizes of the files in the output of `7z l -slt`.
+
+    >>> parse_7z_listing(
+    ...     'Path = a.7z\nType = 7z\n\n----------\n'
+    ...     'Path = d\nSize = 0\nAttributes = D....\n\n'
+    ...     'Path = d/x.txt\nSize = 12\nAttributes = A....\n\n'
+    ...     'Path = y.txt\nSize = 3\nAttributes = A....\n')
+    [12, 3]
+    """
+    # The entries follow a line of dashes; before it is the archive itself
+    _, sep, text = text.partition('\n----------\n')
+    sizes = []
+    for block in text.split('\n\n'):
+        entry = dict(line.split(' = ', 1) for line in block.splitlines()
+                     if ' = ' in line)
+        if 'Path' not in entry:
+            continue
+        if entry.get('Folder') == '+' or \
+                entry.get('Attributes', '').startswith('D'):
+            continue
+        sizes.append(int(entry.get('Size') or 0))
+    return sizes
+
+
+def parse_unrar_listing(text):
+    r"""
+    Return the sizes of the files in the output of `unrar lt`.
+
+    >>> parse_unrar_listing(
+    ...     'Archive: a.rar\nDetails: RAR 5\n\n'
+    ...     '        Name: d\n        Type: Directory\n\n'
+    ...     '        Name: d/x.txt\n        Type: File\n'
+    ...     '        Size: 12\n Packed size: 10\n')
+    [12]
+    """
+    sizes = []
+    for block in text.split('\n\n'):
+        entry = dict(line.strip().split(': ', 1)
+                     for line in block.splitlines() if ': ' in line)
+        if 'Name' in entry and entry.get('Type') == 'File':
+            sizes.append(int(entry.get('Size') or 0))
+    return sizes
+
+
+def run_external(command, filename, cwd=None, **params):
+    args = [a.format(filename=os.path.abspath(filename), **params)
+            for a in command]
+    try:
+        return subprocess.check_output(args, cwd=cwd,
+                                       stdin=subprocess.DEVNULL,
+                                       universal_newlines=True,
+                                       errors='replace')
+    except FileNotFoundError:
+        raise ArchiveError("%s is not installed" % command[0])
+    except subprocess.CalledProcessError as exn:
+        raise ArchiveError("%s failed on %s (exit code %s)" %
+                           (command[0], filename, exn.returncode))
+
+
+def extract_external(command, list_command, parse_listing):
+    """
+    Create a handler that runs an external program such as unrar or 7z.
+    The archive is listed with list_command, whose output parse_listing
+    turns into the sizes of the files, and checked against the limits
+    before anything is extracted. The program then extracts into a
+    temporary directory, which is checked again (in case the listing
+    was wrong) before its contents are moved into place.
+    """
+
+    def extract(filename, path, max_size, max_files):
+        check_limits(filename,
+                     parse_listing(run_external(list_command, filename)),
+                     max_size, max_files)
+        with tempfile.TemporaryDirectory(dir=path) as tmp:
+            run_external(command, filename, cwd=tmp, path=tmp)
+            files = []
+            for dirpath, dirnames, filenames in os.walk(tmp):
+                for f in filenames:
+                    p = os.path.join(dirpath, f)
+                    if not os.path.islink(p):
+                        files.append(p)
+            check_limits(filename, (os.path.getsize(p) for p in files),
+                         max_size, max_files)
+            for p in files:
+                target = os.path.join(path, os.path.relpath(p, tmp))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(p, target)
+        return len(files)
+
+    return extract
+
+
+HANDLERS = [
+    ('.tar.gz', extract_tar),
+    ('.tgz', extract_tar),
+    ('.tar.bz2', extract_tar),
+    ('.tbz2', extract_tar),
+    ('.tar.xz', extract_tar),
+    ('.txz', extract_tar),
+    ('.tar', extract_tar),
+    ('.zip', extract_zip),
+    ('.gz', extract_compressed(gzip.open)),
+    ('.bz2', extract_compressed(bz2.open)),
+    ('.xz', extract_compressed(lzma.open)),
+    ('.7z', extract_external(('7z', 'x', '-y', '-o{path}', '{filename}'),
+                             ('7z', 'l', '-slt', '{filename}'),
+                             parse_7z_listing)),
+    ('.rar', extract_external(('unrar', 'x', '-y', '{filename}', '{path}/'),
+                              ('unrar', 'lt', '{filename}'),
+                              parse_unrar_listing)),
+]
+
+
+def get_handler(filename):
+    """
+    >>> get_handler('foo.tar.gz') is extract_tar
+    True
+    >>> get_handler('FOO.ZIP') is extract_zip
+    True
+    >>> get_handler('foo.pdf') is None
+    True
+    """
+    name = filename.lower()
+    for suffix, handler in HANDLERS:
+        if name.endswith(suffix):
+            return handler
+
+
+def extract_archive(filename, path=None, max_size=None, max_files=None):
+    """
+    Extract the archive filename into path (by default, the directory
+    containing the archive). Returns the number of files extracted.
+    """
+    handler = get_handler(filename)
+    if handler is None:
+        raise ArchiveError("Unknown archive type: %s" % filename)
+    if path is None:
+        path = os.path.dirname(os.path.abspath(filename))
+    return handler(filename, path, max_size, max_files)
+
+
+def manifest_key(filename):
+    st = os.stat(filename)
+    return dict(size=st.st_size, mtime=st.st_mtime)
+
+
+def load_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(path, manifest):
+    filename = os.path.join(path, MANIFEST)
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def is_extracted(filename, path=None):
+    if path is None:
+        path = os.path.dirname(os.path.abspath(filename))
+    entry = load_manifest(path).get(os.path.basename(filename))
+    if entry is None:
+        return False
+    try:
+        key = manifest_key(filename)
+    except FileNotFoundError:
+        return False
+    return all(entry.get(k) == v for k, v in key.items())
+
+
+class Extractor:
+    """
+    Extract archives in a pool of worker processes.
+
+    Call submit() for each downloaded file and wait() once all files have
+    been submitted, or wait(path) for the archives in one directory.
+    Archives that are recorded in the manifest of their directory are
+    skipped, and archives exceeding max_size bytes or max_files files
+    are not extracted.
+
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     for name in 'ab':
+    ...         os.mkdir(os.path.join(d, name))
+    ...         filename = os.path.join(d, name, 'x.zip')
+    ...         with zipfile.ZipFile(filename, 'w') as zf:
+    ...             zf.writestr('x.txt', name)
+    ...     extractor = Extractor(max_workers=1)
+    ...     _ = extractor.submit(os.path.join(d, 'a', 'x.zip'))
+    ...     _ = extractor.submit(os.path.join(d, 'b', 'x.zip'))
+    ...     extractor.wait(os.path.join(d, 'a'))
+    ...     done = [is_extracted(os.path.join(d, name, 'x.zip'))
+    ...             for name in 'ab']
+    ...     extractor.close()
+    ...     done.append(is_extracted(os.path.join(d, 'b', 'x.zip')))
+    >>> done
+    [True, False, True]
+    """
+
+    def __init__(self, max_workers=None, max_size=None, max_files=None):
+        self.max_workers = max_workers
+        self.max_size = max_size
+        self.max_files = max_files
+        self._executor = None
+        self._pending = []
+        # submit() and wait() may be called from different threads
+        self._lock = threading.Lock()
+
+    def submit(self, filename, path=None):
+        if get_handler(filename) is None:
+            return
+        if path is None:
+            path = os.path.dirname(filename)
+        path = os.path.abspath(path)
+        if is_extracted(filename, path):
+            logger.debug("Skip extracting %s (already extracted)", filename)
+            return
+        logger.debug("Extract archive %s", filename)
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs other threads may copy
+                # locks that are held, so start fresh interpreters.
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            future = self._executor.submit(
+                extract_archive, filename, path,
+                self.max_size, self.max_files)
+            self._pending.append((filename, path, future))
+        return future
+
+    def wait(self, path=None):
+        """
+        Wait for submitted archives and record them in the manifests.
+        If path is given, only wait for the archives in that directory.
+        """
+        with self._lock:
+            if path is None:
+                pending, self._pending = self._pending, []
+            else:
+                path = os.path.abspath(path)
+                pending = [p for p in self._pending if p[1] == path]
+                self._pending = [p for p in self._pending if p[1] != path]
+        for filename, path, future in pending:
+            try:
+                n = future.result()
+            except ArchiveError as exn:
+                logger.warning("Could not extract %s: %s", filename, exn)
+                continue
+            except Exception:
+                logger.exception("Could not extract %s", filename)
+                continue
+            logger.info("Extracted %s (%d file%s)",
+                        filename, n, '' if n == 1 else 's')
+            manifest = load_manifest(path)
+            entry = manifest_key(filename)
+            entry['files'] = n
+            manifest[os.path.basename(filename)] = entry
+            save_manifest(path, manifest)
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
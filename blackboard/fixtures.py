@@ -0,0 +1,407 @@
+"""
+Record the HTTP traffic of a BlackboardSession into a fixture archive
+and replay it later without network access.
+
+The archive is a ZIP file with one JSON entry per HTTP exchange
+(including each step of a redirect) under `entries/`, and the response
+bodies stored by their SHA-256 digest under `bodies/`.
+
+Before anything is written, credentials and personal data are scrubbed:
+cookies and all but a few response headers are dropped, login form
+fields are replaced by REDACTED, and any extra strings given in `scrub`
+are replaced by REDACTED. AU ids, email addresses, and the names and
+student numbers of students are replaced consistently by made-up ones.
+Names and student numbers are those given in `personal` (e.g. from the
+gradebook in grading.json) and those found in the name fields of JSON
+responses (see NAME_CELLS and NAME_KEYS), such as the gradebook.
+
+When replaying, each request is looked up by its method, URL and form
+data (ignoring the DWR session ids, which change between runs).
+A request made several times gets the recorded responses in order.
+Recorded responses can be delayed to simulate the latency of the
+real server.
+
+Use `session.record_fixtures(filename)` and
+`session.replay_fixtures(filename)`, or `grading --record FILE` and
+`grading --replay FILE`.
+"""
+
+import io
+import re
+import json
+import time
+import zipfile
+import hashlib
+import datetime
+import threading
+import collections
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+from six.moves.urllib.parse import parse_qsl, urlencode
+
+from blackboard.base import logger
+
+
+# Response headers that are kept in the archive
+KEEP_HEADERS = ('content-type', 'location', 'content-disposition')
+
+# Form fields that contain credentials
+SECRET_FIELDS = ('username', 'password', 'j_username', 'j_password')
+
+# Cells of gradebook rows (getJSONData) and keys of other JSON
+# responses that contain the names and student numbers of students
+NAME_CELLS = ('FN', 'LN', 'SI')
+NAME_KEYS = ('firstName', 'lastName', 'studentId', 'fullName',
+             'givenName', 'familyName', 'sortableName')
+
+# Form fields that change between runs and are ignored when replaying
+VOLATILE_FIELDS = ('scriptSessionId', 'httpSessionId')
+
+REDACTED = 'REDACTED'
+
+
+class FixtureMissing(requests.ConnectionError):
+    pass
+
+
+class Scrubber:
+    """
+    Replace credentials and personal data in recorded requests
+    and responses. AU ids, email addresses and personal strings
+    (names and student numbers) are replaced consistently,
+    so the same student gets the same made-up id and name everywhere.
+
+    >>> s = Scrubber(['hunter2'], personal=['Jane'])
+    >>> s.scrub_text(b'hunter2 Jane au123456 jd@post.au.dk au654321 au123456')
+    b'REDACTED Person1 au900001 user1@example.com au900002 au900001'
+    >>> s.scrub_form('password=hunter2&c0-id=au654321')
+    'password=REDACTED&c0-id=au900002'
+
+    Names in JSON responses are found and replaced everywhere,
+    including in later responses:
+
+    >>> s.scrub_text(b'{"rows": [[{"c": "FN", "v": "Bo"}, '
+    ...              b'{"c": "LN", "v": "Jane"}, {"c": "SI", "v": "201"}]]}')
+    b'{"rows": [[{"c": "FN", "v": "Person2"}, {"c": "LN", "v": "Person1"}, {"c": "SI", "v": "Person3"}]]}'
+    >>> s.scrub_text(b'<td>Bo Jane</td><td>Bob</td>')
+    b'<td>Person2 Person1</td><td>Bob</td>'
+    """
+
+    AU_ID = re.compile(br'\bau\d{6,7}\b')
+    EMAIL = re.compile(br'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+    def __init__(self, scrub=(), personal=()):
+        self.strings = [s.encode('utf8') for s in scrub if s]
+        self.ids = {}
+        self.emails = {}
+        # Made-up replacements of personal strings
+        self.personal = {}
+        self.personal_re = None
+        self._lock = threading.Lock()
+        self.add_personal(personal)
+
+    def add_personal(self, strings):
+        with self._lock:
+            new = False
+            for s in strings:
+                s = s.strip().encode('utf8') if s else b''
+                if s and s not in self.personal:
+                    self.personal[s] = (
+                        b'Person%d' % (1 + len(self.personal)))
+                    new = True
+            if new:
+                # Longest first, so that a name is replaced before
+                # a shorter name contained in it
+                alternatives = sorted(self.personal, key=len, reverse=True)
+                self.personal_re = re.compile(
+                    br'(?<!\w)(?:' + b'|'.join(map(re.escape, alternatives)) +
+                    br')(?!\w)')
+
+    def find_personal(self, data):
+        """Add the names in data to self.personal if it is JSON."""
+        if data.lstrip()[:1] not in (b'{', b'['):
+            return
+        try:
+            o = json.loads(data.decode('utf8'))
+        except ValueError:
+            return
+        found = []
+        stack = [o]
+        while stack:
+            o = stack.pop()
+            if isinstance(o, list):
+                stack.extend(reversed(o))
+            elif isinstance(o, dict):
+                if o.get('c') in NAME_CELLS and isinstance(o.get('v'), str):
+                    found.append(o['v'])
+                found.extend(o[k] for k in NAME_KEYS
+                             if isinstance(o.get(k), str))
+                stack.extend(reversed(list(o.values())))
+        self.add_personal(found)
+
+    def _personal(self, mo):
+        return self.personal[mo.group()]
+
+    def _au_id(self, mo):
+        return self.ids.setdefault(
+            mo.group(), b'au%d' % (900001 + len(self.ids)))
+
+    def _email(self, mo):
+        return self.emails.setdefault(
+            mo.group(), b'user%d@example.com' % (1 + len(self.emails)))
+
+    def scrub_text(self, data):
+        for s in self.strings:
+            data = data.replace(s, REDACTED.encode())
+        self.find_personal(data)
+        if self.personal_re is not None:
+            data = self.personal_re.sub(self._personal, data)
+        data = self.AU_ID.sub(self._au_id, data)
+        data = self.EMAIL.sub(self._email, data)
+        return data
+
+    def scrub_str(self, s):
+        return self.scrub_text(s.encode('utf8')).decode('utf8')
+
+    def scrub_form(self, body):
+        fields = [(k, REDACTED if k in SECRET_FIELDS else v)
+                  for k, v in parse_qsl(body, keep_blank_values=True)]
+        return self.scrub_str(urlencode(fields))
+
+
+def request_key(method, url, body, content_type):
+    """
+    Return the key used to look up a request in the archive.
+
+    >>> request_key('POST', 'https://bb.au.dk/dwr?a=1',
+    ...             'c0-id=3&scriptSessionId=X42&password=x',
+    ...             'application/x-www-form-urlencoded')
+    'POST https://bb.au.dk/dwr?a=1 c0-id=3&password=REDACTED'
+    """
+    if body and 'x-www-form-urlencoded' in (content_type or ''):
+        fields = sorted((k, REDACTED if k in SECRET_FIELDS else v)
+                        for k, v in parse_qsl(body, keep_blank_values=True)
+                        if k not in VOLATILE_FIELDS)
+        return '%s %s %s' % (method, url, urlencode(fields))
+    # Multipart bodies contain a random boundary, so only use the URL
+    return '%s %s' % (method, url)
+
+
+def _body_text(request):
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode('utf8', 'replace')
+    return body or ''
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Record the requests of a session, scrubbed by a Scrubber,
+    into the fixture archive filename.
+
+    A recorded gradebook contains no names or student numbers:
+
+    >>> import os, tempfile, threading
+    >>> from blackboard import BlackboardSession
+    >>> from blackboard.backend import fetch_overview
+    >>> from blackboard.mockserver import SyntheticCourse, make_server
+    >>> course = SyntheticCourse(students=20, assignments=1)
+    >>> server = make_server(course, port=0)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     session = BlackboardSession(os.path.join(d, 'cookies.txt'),
+    ...                                 'au100000', '_1234_1')
+    ...     session.endpoints.base_url = 'http://%s:%d' % (
+    ...         server.server_address[:2])
+    ...     session.record_fixtures(os.path.join(d, 'fixtures.zip'))
+    ...     _, students = fetch_overview(session)
+    ...     session.close()
+    ...     with zipfile.ZipFile(os.path.join(d, 'fixtures.zip')) as zf:
+    ...         data = b''.join(zf.read(n) for n in zf.namelist())
+    >>> server.shutdown()
+    >>> server.server_close()
+    >>> len(students), data.count(b'"c": "FN"')
+    (20, 20)
+    >>> [s[k] for s in students.values()
+    ...  for k in ('first_name', 'last_name', 'student_number')
+    ...  if s[k].encode() in data]
+    []
+    """
+
+    def __init__(self, filename, scrub=(), personal=()):
+        super().__init__()
+        self.filename = filename
+        self.scrubber = Scrubber(scrub, personal)
+        self.zipfile = zipfile.ZipFile(filename, 'a', zipfile.ZIP_DEFLATED)
+        self.bodies = set(n for n in self.zipfile.namelist()
+                          if n.startswith('bodies/'))
+        self.count = sum(1 for n in self.zipfile.namelist()
+                         if n.startswith('entries/'))
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # Read the body so that it can be recorded;
+        # response.iter_content() still works afterwards.
+        content = response.content
+        self.record(request, response, content)
+        return response
+
+    def record(self, request, response, content):
+        s = self.scrubber
+        content_type = request.headers.get('Content-Type')
+        url = s.scrub_str(request.url)
+        body = _body_text(request)
+        if 'x-www-form-urlencoded' in (content_type or ''):
+            body = s.scrub_form(body)
+        else:
+            body = ''
+        data = s.scrub_text(content)
+        digest = hashlib.sha256(data).hexdigest()
+        headers = {k: s.scrub_str(v) for k, v in response.headers.items()
+                   if k.lower() in KEEP_HEADERS}
+        entry = collections.OrderedDict([
+            ('key', request_key(request.method, url, body, content_type)),
+            ('method', request.method),
+            ('url', url),
+            ('status', response.status_code),
+            ('reason', response.reason),
+            ('headers', headers),
+            ('body', digest),
+            ('elapsed', response.elapsed.total_seconds()),
+            ('cookies', [[c.domain, c.path, c.name]
+                         for c in response.cookies]),
+        ])
+        with self._lock:
+            if 'bodies/' + digest not in self.bodies:
+                self.zipfile.writestr('bodies/' + digest, data)
+                self.bodies.add('bodies/' + digest)
+            self.count += 1
+            self.zipfile.writestr('entries/%06d.json' % self.count,
+                                  json.dumps(entry, indent=1))
+
+    def close(self):
+        super().close()
+        with self._lock:
+            if self.zipfile is not None:
+                self.zipfile.close()
+                self.zipfile = None
+                logger.info("Recorded %d requests to %s",
+                            self.count, self.filename)
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Answer requests from a fixture archive.
+
+    Each response is delayed by latency + scale * (the recorded time),
+    so scale=1 replays at the speed of the recording.
+
+    Record an attempt page, the group list (in pages of 5 rows) and
+    the DWR groups from the mock server, then replay them without it:
+
+    >>> import os, tempfile, threading
+    >>> from blackboard import BlackboardSession
+    >>> from blackboard.backend import (
+    ...     fetch_overview, fetch_attempt, fetch_groups, fetch_groups_dwr)
+    >>> from blackboard.datatable import iter_datatable
+    >>> from blackboard.mockserver import SyntheticCourse, make_server
+    >>> course = SyntheticCourse(students=12, assignments=2)
+    >>> attempt_id = next(k for k, a in course.attempts.items() if a['group'])
+    >>> def fetch_all(session):
+    ...     _, students = fetch_overview(session)
+    ...     attempt = fetch_attempt(session, attempt_id, True)
+    ...     groups = fetch_groups(session)
+    ...     dwr = fetch_groups_dwr(session, students, groups)
+    ...     *rows, response = iter_datatable(
+    ...         session, session.url('group_list'),
+    ...         table_id='userGroupList_datatable')
+    ...     return attempt, groups, dwr, rows
+    >>> server = make_server(course, port=0, page_size=5)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> d = tempfile.TemporaryDirectory()
+    >>> def new_session():
+    ...     session = BlackboardSession(os.path.join(d.name, 'cookies.txt'),
+    ...                                 'au100000', '_1234_1')
+    ...     session.endpoints.base_url = 'http://%s:%d' % (
+    ...         server.server_address[:2])
+    ...     return session
+    >>> session = new_session()
+    >>> session.record_fixtures(os.path.join(d.name, 'fixtures.zip'))
+    >>> recorded = fetch_all(session)
+    >>> session.close()
+    >>> server.shutdown()
+    >>> server.server_close()
+    >>> session = new_session()
+    >>> session.replay_fixtures(os.path.join(d.name, 'fixtures.zip'))
+    >>> attempt, groups, dwr, rows = fetch_all(session)
+    >>> d.cleanup()
+
+    The attempt is the same, and so are the groups and the rows of the
+    group list, except that names and usernames are scrubbed:
+
+    >>> attempt == recorded[0], attempt['files'][0]['filename']
+    (True, 'handin0.pdf')
+    >>> def memberships(users):
+    ...     return sorted(tuple(map(tuple, u['groups']))
+    ...                   for u in users.values())
+    >>> memberships(groups) == memberships(dwr) == memberships(recorded[1])
+    True
+    >>> len(rows), rows[0], rows[1]
+    (13, ['userorgroupname', 'firstname', 'lastname', 'Role', 'Groups'], \
+['au900001', 'Person1', 'Person2', 'Student', 'Hand In Group 1'])
+    >>> [r[3:] for r in rows] == [r[3:] for r in recorded[3]]
+    True
+    """
+
+    def __init__(self, filename, session=None, latency=0.0, scale=0.0):
+        super().__init__()
+        self.session = session
+        self.latency = latency
+        self.scale = scale
+        self.zipfile = zipfile.ZipFile(filename)
+        self.entries = collections.defaultdict(collections.deque)
+        names = sorted(n for n in self.zipfile.namelist()
+                       if n.startswith('entries/'))
+        for name in names:
+            entry = json.loads(self.zipfile.read(name).decode('utf8'))
+            self.entries[entry['key']].append(entry)
+        self._lock = threading.Lock()
+
+    def lookup(self, request):
+        key = request_key(request.method, request.url, _body_text(request),
+                          request.headers.get('Content-Type'))
+        with self._lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise FixtureMissing("No recorded response for %s" % key,
+                                     request=request)
+            # Repeat the last response if the request is made more often
+            # than when it was recorded.
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def send(self, request, **kwargs):
+        entry = self.lookup(request)
+        delay = self.latency + self.scale * entry['elapsed']
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            body = self.zipfile.read('bodies/' + entry['body'])
+        headers = dict(entry['headers'])
+        headers['Content-Length'] = str(len(body))
+        raw = HTTPResponse(body=io.BytesIO(body), headers=headers,
+                           status=entry['status'], reason=entry['reason'],
+                           preload_content=False, decode_content=False)
+        response = self.build_response(request, raw)
+        response.elapsed = datetime.timedelta(seconds=delay)
+        if self.session is not None:
+            for domain, path, name in entry['cookies']:
+                self.session.cookies.set(name, 'replay',
+                                         domain=domain, path=path)
+        return response
+
+    def close(self):
+        super().close()
+        self.zipfile.close()
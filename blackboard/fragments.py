@@ -0,0 +1,247 @@
+"""
+Parse only the interesting parts of a Blackboard page.
+
+Most of a Blackboard page is navigation, menus and scripts, but e.g.
+fetch_attempt only reads a handful of elements with known ids.
+parse_fragments locates those elements in the raw bytes of the
+response, parses just them, and returns a small document that answers
+the same find/findall queries as the full page.
+
+Locating an element by scanning bytes is only reliable for markup that
+is written the way Blackboard writes it, so whenever something looks
+unusual (the id occurs in the page, but not in a start tag we can
+match, the end tag cannot be found, the page is not in an ASCII-based
+encoding...) the full page is parsed instead with parse_response.
+"""
+
+import re
+import html
+import bisect
+import codecs
+import functools
+
+from blackboard.htmlparser import parse_html, parse_response, NS
+
+
+VOID_TAGS = frozenset(
+    b'area base br col embed hr img input link meta source track wbr'.split())
+
+RAW_TEXT_TAGS = frozenset(b'script style textarea title'.split())
+
+# Elements that are only allowed inside a table, together with
+# the markup that must enclose them when they are parsed on their own.
+TABLE_CONTEXT = {
+    b'tbody': b'<table>', b'thead': b'<table>', b'tfoot': b'<table>',
+    b'tr': b'<table><tbody>', b'td': b'<table><tbody><tr>',
+    b'th': b'<table><tbody><tr>',
+}
+
+START_TAG = re.compile(
+    br'<([a-zA-Z][a-zA-Z0-9]*)((?:\s+[^\s"\'>/=]+' +
+    br'(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'>]+))?)*)\s*/?>')
+
+ATTRIBUTE = re.compile(
+    br'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+)))?')
+
+# Comments and elements whose contents are not markup
+RAW_TEXT = re.compile(
+    br'<!--.*?(?:-->|$)|' +
+    br'<(script|style|textarea|title)\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>' +
+    br'.*?(?:</\1\s*>|$)',
+    re.S | re.I)
+
+# Tokens that matter when looking for the end tag of an element:
+# comments and raw text elements (as above), and start and end tags.
+TOKEN = re.compile(
+    RAW_TEXT.pattern + b'|' +
+    br'<(/?)([a-zA-Z][a-zA-Z0-9]*)\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>',
+    re.S | re.I)
+
+
+class Unsupported(Exception):
+    """The page must be parsed in full."""
+
+
+def parse_attributes(s):
+    """
+    >>> parse_attributes(b' id="x" class=\\'a b\\' checked value=1&amp;2')
+    {'id': 'x', 'class': 'a b', 'checked': '', 'value': '1&2'}
+    """
+    attributes = {}
+    for mo in ATTRIBUTE.finditer(s):
+        name = mo.group(1).decode('ascii', 'replace').lower()
+        value = next((v for v in mo.group(2, 3, 4) if v is not None), b'')
+        attributes.setdefault(name, html.unescape(value.decode('utf8',
+                                                               'replace')))
+    return attributes
+
+
+@functools.lru_cache(maxsize=8)
+def _raw_text_ranges(content):
+    """
+    Return the (start, end) positions of the comments and raw text
+    elements (scripts etc.) in content, as two sorted lists.
+    """
+    starts = []
+    ends = []
+    for mo in RAW_TEXT.finditer(content):
+        starts.append(mo.start())
+        ends.append(mo.end())
+    return starts, ends
+
+
+def inside_raw_text(content, position):
+    """Return True if position is inside a comment or a script."""
+    starts, ends = _raw_text_ranges(content)
+    i = bisect.bisect_left(starts, position) - 1
+    return i >= 0 and position < ends[i]
+
+
+def find_start_tag(content, element_id):
+    """
+    Find the start tag of the element with the given id.
+    Returns (tag, attributes, start, end), or None if there is no such
+    element. Raises Unsupported if the id occurs in a place that
+    cannot be classified as either inside or outside of a start tag.
+
+    >>> find_start_tag(b'<p>x</p><div class="a" id="b">', 'b')
+    (b'div', {'class': 'a', 'id': 'b'}, 8, 30)
+    >>> find_start_tag(b'<p>b</p><a href="#b"><!-- <i id="b"> -->', 'b')
+    >>> find_start_tag(b'<p>1 < 2 b</p>', 'b')
+    Traceback (most recent call last):
+      ...
+    blackboard.fragments.Unsupported: Could not classify 'b' at 9
+    """
+    needle = element_id.encode('ascii')
+    position = content.find(needle)
+    while position != -1:
+        start = content.rfind(b'<', 0, position)
+        mo = START_TAG.match(content, start) if start != -1 else None
+        if mo is None and not inside_raw_text(content, position):
+            # The id follows something that is not a proper start tag.
+            raise Unsupported("Could not classify %r at %d" %
+                              (element_id, position))
+        if (mo is not None and mo.end() > position and
+                not inside_raw_text(content, start)):
+            attributes = parse_attributes(mo.group(2))
+            if attributes.get('id') == element_id:
+                return mo.group(1).lower(), attributes, mo.start(), mo.end()
+        position = content.find(needle, position + 1)
+
+
+def find_element(content, element_id):
+    """
+    Find the element with the given id.
+    Returns (tag, start, end) such that content[start:end] is the markup
+    of the element, or None if the element does not exist.
+
+    >>> s = b'<div id="a"><div>x</div><textarea></div></textarea></div>!'
+    >>> tag, start, end = find_element(s, 'a')
+    >>> s[start:end] == s[:-1]
+    True
+    """
+    found = find_start_tag(content, element_id)
+    if found is None:
+        return None
+    tag, attributes, start, end = found
+    if tag in VOID_TAGS:
+        return tag, start, end
+    if tag in RAW_TEXT_TAGS:
+        mo = re.compile(br'</%s\s*>' % tag, re.I).search(content, end)
+        if mo is None:
+            raise Unsupported("No end tag for %r" % element_id)
+        return tag, start, mo.end()
+    depth = 1
+    for mo in TOKEN.finditer(content, end):
+        if mo.group(3) is None or mo.group(3).lower() != tag:
+            continue
+        # Like the HTML parser, treat <div/> as a start tag.
+        if not mo.group(2):
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            return tag, start, mo.end()
+    raise Unsupported("No end tag for %r" % element_id)
+
+
+def ascii_compatible(content, encoding):
+    if content[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return False
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    return not name.startswith(('utf-16', 'utf-32'))
+
+
+def extract_fragments(content, encoding, element_ids):
+    """
+    Return the markup of a document containing only the elements with
+    the given ids (those that exist). Raises Unsupported if the page
+    must be parsed in full.
+    """
+    if encoding is None or not ascii_compatible(content, encoding):
+        raise Unsupported("Unknown or unsupported encoding %r" % encoding)
+    spans = []
+    for element_id in element_ids:
+        found = find_element(content, element_id)
+        if found is not None:
+            spans.append((found[1], found[2], found[0]))
+    spans.sort()
+    parts = [b'<!DOCTYPE html><html><body>']
+    end = 0
+    for start, stop, tag in spans:
+        if stop <= end:
+            # Contained in the previous fragment
+            continue
+        if start < end:
+            raise Unsupported("Overlapping elements")
+        context = TABLE_CONTEXT.get(tag)
+        if context is None:
+            parts.append(content[start:stop])
+        else:
+            parts.append(context + content[start:stop] + b'</table>')
+        end = stop
+    parts.append(b'</body></html>')
+    return b''.join(parts)
+
+
+def parse_fragments(response, element_ids, required=()):
+    """
+    Parse the elements of the response with the given ids.
+
+    Returns a document on which `find('.//h:div[@id="..."]', NS)` etc.
+    work as on the full page. The full page is parsed instead if one of
+    the required ids is missing, or if the elements cannot be located
+    reliably.
+    """
+    content = response.content
+    try:
+        for element_id in required:
+            if element_id.encode('ascii') not in content:
+                raise Unsupported("No %r" % element_id)
+        markup = extract_fragments(content, response.encoding, element_ids)
+    except Unsupported:
+        return parse_response(response)
+    return parse_html(markup, response.encoding)
+
+
+def element_attributes(response, element_id):
+    """
+    Return the attributes of the element with the given id,
+    or None if there is no such element.
+
+    Unlike parse_fragments, this does not parse anything
+    unless the start tag cannot be located reliably.
+    """
+    content = response.content
+    try:
+        if not ascii_compatible(content, response.encoding or 'ascii'):
+            raise Unsupported("Unsupported encoding")
+        found = find_start_tag(content, element_id)
+    except Unsupported:
+        element = parse_response(response).find(
+            './/*[@id="%s"]' % element_id, NS)
+        return None if element is None else dict(element.attrib)
+    return None if found is None else found[1]
@@ -9,9 +9,7 @@ from blackboard.backend import fetch_overview
 
 
 def get_handin_attempt_counts(session, handin_id):
-    url = ('https://bb.au.dk/webapps/gradebook/do/instructor/' +
-           'getJSONUniqueAttemptData?course_id=%s' % session.course_id +
-           '&itemId=%s' % handin_id)
+    url = session.url('attempt_counts', item_id=handin_id)
     o = session.get(url).json()
     assert set(o.keys()) == {'totalStudentsOrGroups', 'needsGradingCount',
                              'numberOfUniqueAttempts'}
@@ -186,6 +184,14 @@ class Assignment(ItemWrapper):
 
     name = property(lambda self: self['name'])
 
+    @property
+    def due(self):
+        """Deadline as a Unix timestamp, or None if there is no deadline."""
+        due = self._data.get('due')
+        if due:
+            # The gradebook reports milliseconds since the epoch
+            return due / 1000
+
     @property
     def group_assignment(self):
         try:
@@ -331,19 +337,34 @@ class Gradebook(blackboard.Serializable):
 
     def refresh(self, refresh_attempts=False, student_visible=None):
         """Fetch gradebook information from Blackboard website."""
-        new_fetch_time = time.time()
+        self.refresh_overview()
+        self.refresh_attempts(refresh_all=refresh_attempts,
+                              student_visible=student_visible)
+
+    def refresh_overview(self):
+        """Fetch the gradebook without fetching missing attempt lists."""
+        self.set_overview(self.fetch())
+
+    def fetch(self):
+        """
+        Fetch the gradebook and return it for set_overview,
+        without modifying self.
+        """
+        fetch_time = time.time()
+        # The following may raise requests.ConnectionError
+        assignments, students = fetch_overview(self.session)
+        return assignments, students, fetch_time
+
+    def set_overview(self, overview):
+        """Store the gradebook returned by fetch."""
         try:
             prev = self._students
         except AttributeError:
             prev = None
-        # The following may raise requests.ConnectionError
-        self._assignments, self._students = fetch_overview(self.session)
+        self._assignments, self._students, fetch_time = overview
         if prev is not None:
             self.copy_student_data(prev)
-        # No exception raised; store fetch_time
-        self.fetch_time = new_fetch_time
-        self.refresh_attempts(refresh_all=refresh_attempts,
-                              student_visible=student_visible)
+        self.fetch_time = fetch_time
 
     def copy_student_data(self, prev):
         """After updating self._students, copy over old assignment data."""
@@ -370,6 +391,22 @@ class Gradebook(blackboard.Serializable):
 
     def refresh_attempts(self, attempts=None, student_visible=None, refresh_all=False):
         """Bulk-refresh all missing assignment data."""
+        attempt_keys = self.get_attempt_keys(
+            attempts=attempts, student_visible=student_visible,
+            refresh_all=refresh_all)
+        if not attempt_keys:
+            return
+        logger.info("Fetching %d attempt list%s",
+                    len(attempt_keys), '' if len(attempt_keys) == 1 else 's')
+        attempt_data = dwr_get_attempts_info(self.session, attempt_keys)
+        self.store_attempt_lists(attempt_keys, attempt_data)
+
+    def get_attempt_keys(self, attempts=None, student_visible=None,
+                         refresh_all=False):
+        """
+        Compute the (user id, assignment id) pairs
+        whose attempt lists should be fetched.
+        """
         attempt_keys = []
         students = self.students.values()
         if attempts is None:
@@ -386,11 +423,9 @@ class Gradebook(blackboard.Serializable):
                     a = assignment.cached_attempts or []
                     if any(attempt.id in attempt_ids for attempt in a):
                         attempt_keys.append((user.id, assignment_id))
-        if not attempt_keys:
-            return
-        logger.info("Fetching %d attempt list%s",
-                    len(attempt_keys), '' if len(attempt_keys) == 1 else 's')
-        attempt_data = dwr_get_attempts_info(self.session, attempt_keys)
+        return attempt_keys
+
+    def store_attempt_lists(self, attempt_keys, attempt_data):
         for (user_id, aid), attempts in zip(attempt_keys, attempt_data):
             self.students[user_id]['assignments'][aid]['attempts'] = attempts
 
@@ -1,30 +1,48 @@
 import os
 import re
+import sys
 import json
+import time
+import shutil
 import decimal
+import zipfile
+import tempfile
 import numbers
 import argparse
-import requests
 import functools
 import blackboard
 import collections
-import markdown2
-from blackboard import logger, ParserError, BadAuth, BlackboardSession
+import blackboard.daemon as daemon
+from blackboard import (
+    logger, ParserError, BadAuth, NoCredentials, BlackboardSession,
+)
 # from groups import get_groups
 from blackboard.gradebook import (
     Gradebook, Attempt, truncate_name, StudentAssignment, Rubric,
 )
 from blackboard.backend import (
     fetch_attempt, submit_grade, fetch_groups, fetch_rubric,
-    is_course_id_valid,
+    is_course_id_valid, fetch_assignment_bundle, fetch_groups_dwr,
+    compare_groups,
 )
+from blackboard.groupchanges import diff_groups, affected_users
+from blackboard.cache import CacheManager, CachePolicy
+from blackboard.bundle import index_bundle, match_bundle_attempts
+from blackboard.extract import Extractor
+from blackboard.store import DownloadStore
+from blackboard.download import download_file, file_matches, hash_file
+from blackboard.pipeline import Pipeline
+from blackboard.prefetch import Prefetcher
+from blackboard.profiling import Profiler
+from blackboard.dwr import dwr_get_attempts_info
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
 
 class Grading(blackboard.Serializable):
-    FIELDS = ('attempt_state', 'gradebook', 'username', 'groups', 'rubrics')
+    FIELDS = ('attempt_state', 'gradebook', 'username', 'groups', 'rubrics',
+              'groups_version', 'cache_times')
 
     session_class = BlackboardSession
     gradebook_class = Gradebook
@@ -33,46 +51,323 @@ class Grading(blackboard.Serializable):
         self.session = session
         self.gradebook = type(self).gradebook_class(self.session)
         self.username = session.username
+        # student_visible and student_ordering by username
+        self._visible_cache = {}
+        self._ordering_cache = {}
+        self._cache = None
 
     def initialize_fields(self):
         super().initialize_fields()
-        if not is_course_id_valid(self.session):
+        if not self.fetch_course_valid():
             logger.error(
                 "Course ID %s does not seem to be a valid Blackboard course",
                 self.session.course_id)
             raise SystemExit(1)
-
-    def refresh(self, **kwargs):
+        self.cache.policy.touch('course')
+
+    # Time to live and stale period in seconds of each kind of data
+    # (see blackboard.cache). Data that is not fresh is fetched before it
+    # is used, except that stale data is fetched in the background if
+    # refresh_in_background is true, as it is in the daemon. Rubrics are
+    # only fetched again when attempts are downloaded or uploaded
+    # (see get_rubric).
+    refresh_in_background = False
+    cache_ttls = dict(
+        gradebook=(60, 3600),
+        attempts=(86400, 6 * 86400),
+        groups=(86400, 6 * 86400),
+        rubrics=(86400, 30 * 86400),
+        course=(86400, 30 * 86400),
+    )
+
+    @property
+    def cache(self):
+        if self.cache_times is None:
+            self.cache_times = {}
+        if self._cache is None or self._cache.policy.times is not \
+                self.cache_times:
+            # cache_times was replaced by load()
+            self._cache = CacheManager(
+                CachePolicy(self.cache_ttls, self.cache_times))
+        self._cache.background = self.refresh_in_background
+        return self._cache
+
+    def refresh(self, refresh_attempts=False):
+        """
+        Refresh the data that is out of date according to cache_ttls.
+        With refresh_attempts, all attempt lists are fetched again.
+        """
         logger.info("Refresh gradebook")
-        self.gradebook.refresh(
-            student_visible=self.get_student_visible,
-            **kwargs)
+        cache = self.cache
+        cache.apply_pending()
+        cache.ensure('course', self.fetch_course_valid,
+                     self.set_course_valid)
+        if not hasattr(self.gradebook, '_students'):
+            cache.policy.invalidate('gradebook')
+        cache.ensure('gradebook', self.gradebook.fetch,
+                     self.gradebook.set_overview)
         if not self.attempt_state:
             self.attempt_state = {}
-        if self.should_refresh_groups():
-            self.refresh_groups()
+        if refresh_attempts:
+            cache.policy.invalidate('attempts')
+        keys = self.get_cached_attempt_keys()
+        if keys:
+            cache.ensure('attempts',
+                         functools.partial(self.fetch_attempt_lists, keys),
+                         self.set_attempt_lists)
+        # Attempt lists that have never been fetched
+        self.gradebook.refresh_attempts(student_visible=self.student_visible)
+        self.refresh_group_memberships()
         self.autosave()
 
+    def fetch_course_valid(self):
+        return is_course_id_valid(self.session)
+
+    def set_course_valid(self, valid):
+        if not valid:
+            logger.error(
+                "Course ID %s does not seem to be a valid Blackboard course",
+                self.session.course_id)
+
+    def get_cached_attempt_keys(self):
+        """
+        Return the (user id, assignment id) pairs of the visible students
+        whose attempt lists have been fetched before.
+        """
+        return [(student.id, assignment_id)
+                for student in filter(self.student_visible,
+                                      self.gradebook.students.values())
+                for assignment_id, a in student.assignments.items()
+                if a.cached_attempts is not None]
+
+    def fetch_attempt_lists(self, keys):
+        """Fetch the given attempt lists for set_attempt_lists."""
+        logger.info("Refreshing %d attempt list%s",
+                    len(keys), '' if len(keys) == 1 else 's')
+        return keys, dwr_get_attempts_info(self.session, keys)
+
+    def set_attempt_lists(self, attempt_lists):
+        keys, data = attempt_lists
+        students = self.gradebook._students
+        # Students and assignments may have left the gradebook
+        # while the attempt lists were fetched.
+        present = [(key, attempts) for key, attempts in zip(keys, data)
+                   if key[1] in students.get(key[0], {}).get(
+                       'assignments', ())]
+        self.gradebook.store_attempt_lists(
+            [key for key, attempts in present],
+            [attempts for key, attempts in present])
+
+    def refresh_group_memberships(self):
+        """
+        Fetch the group list if it is out of date (see cache_ttls), and
+        otherwise keep self.groups up to date with fetch_groups_dwr.
+        """
+        cache = self.cache
+        if self.should_refresh_groups():
+            cache.policy.invalidate('groups')
+        fetch_now = cache.needs_fetch('groups')
+        cache.ensure('groups', self.fetch_group_list, self.set_group_list,
+                     prepare=self.session.set_edit_mode)
+        if not fetch_now:
+            self.refresh_groups(scrape=False)
+
     def should_refresh_groups(self):
         if not hasattr(self, 'groups') or self.groups is None:
             return True
         if any(k.startswith('Access the profile') for k in self.groups.keys()):
             return True
 
-    def refresh_groups(self):
+    # Update group memberships from GradebookDWRFacade.getGroups
+    # (see fetch_groups_dwr) on every refresh, and check it against
+    # the group list whenever that is fetched.
+    use_dwr_groups = True
+
+    def refresh_groups(self, scrape=True):
+        """
+        Update self.groups, by fetching the group list if scrape is true
+        or the DWR group memberships are not enough, and otherwise with
+        fetch_groups_dwr.
+        """
+        if not scrape and self.use_dwr_groups:
+            groups = self.fetch_groups_dwr()
+            if groups is not None:
+                self.set_groups(groups)
+                return
+        self.cache.refresh('groups', self.fetch_group_list,
+                           self.set_group_list,
+                           prepare=self.session.set_edit_mode)
+
+    def fetch_group_list(self):
+        """
+        Fetch the group list, which is only complete in edit mode.
+        This may run in the background, so the session must already be
+        in edit mode (see BlackboardSession.set_edit_mode).
+        """
         logger.info("Fetching student group memberships")
-        self.groups = fetch_groups(self.session)
-        if any(k.startswith('Access the profile') for k in self.groups.keys()):
+        groups = fetch_groups(self.session, edit_mode=False)
+        if any(k.startswith('Access the profile') for k in groups.keys()):
             raise Exception("fetch_groups returned bad usernames")
+        return groups
+
+    def set_group_list(self, groups):
+        self.set_groups(groups)
+        if self.use_dwr_groups:
+            self.check_groups_dwr()
+
+    def fetch_groups_dwr(self):
+        """
+        Return the group memberships computed by fetch_groups_dwr,
+        or None if the group list must be fetched instead.
+        """
+        try:
+            students = self.gradebook._students
+        except AttributeError:
+            # The gradebook has not been fetched
+            return None
+        try:
+            return fetch_groups_dwr(self.session, students, self.groups)
+        except ParserError as exn:
+            logger.warning("Could not fetch groups with DWR: %s", exn)
+            exn.save()
+            return None
+
+    def check_groups_dwr(self):
+        """Warn if fetch_groups_dwr does not agree with self.groups."""
+        groups = self.fetch_groups_dwr()
+        if groups is None:
+            return
+        differences = compare_groups(self.groups, groups)
+        if differences:
+            logger.warning(
+                "DWR group memberships differ from the group list " +
+                "for %d user%s: %s", len(differences),
+                '' if len(differences) == 1 else 's',
+                ' '.join(differences[:10]))
+
+    def set_groups(self, groups):
+        """
+        Replace self.groups. If any group memberships or group names
+        changed, increase groups_version and call groups_changed with
+        the changes. Returns the changes.
+        """
+        changes = diff_groups(self.groups, groups)
+        self.groups = groups
+        if changes:
+            self.groups_version = (self.groups_version or 0) + 1
+            self.groups_changed(changes)
+        return changes
+
+    def groups_changed(self, changes):
+        """
+        Called with a list of GroupChange events (see
+        blackboard.groupchanges) when the group memberships change.
+        Forgets the cached visibility and ordering of the affected
+        students and updates the directories of their attempts.
+        """
+        counts = collections.Counter(change.kind for change in changes)
+        logger.info("Group memberships version %s: %s", self.groups_version,
+                    ', '.join('%d %s' % (n, kind)
+                              for kind, n in sorted(counts.items())))
+        usernames = affected_users(changes, self.groups)
+        for username in usernames:
+            self._visible_cache.pop(username, None)
+            self._ordering_cache.pop(username, None)
+        self.move_attempt_directories(usernames)
+
+    def move_attempt_directories(self, usernames):
+        """
+        Move the attempt directories of the given students whose name
+        (see get_attempt_directory_name) has changed, and record the new
+        names in the attempt state. A directory is left where it is if
+        the new name is already taken; one that no longer exists is
+        forgotten, so it is created under the new name when needed.
+        """
+        try:
+            students = self.gradebook.students.values()
+        except AttributeError:
+            # The gradebook has not been fetched
+            return
+        moved = False
+        for student in students:
+            if student.username not in usernames:
+                continue
+            for assignment in student.assignments.values():
+                for attempt in assignment.cached_attempts or ():
+                    st = self.get_attempt_state(attempt)
+                    d = st.get('directory')
+                    if d is None:
+                        continue
+                    new_d = self.get_attempt_directory_name(attempt)
+                    if new_d == d:
+                        continue
+                    moved = True
+                    if not os.path.exists(d):
+                        del st['directory']
+                    elif os.path.exists(new_d):
+                        logger.warning("Groups of %s changed, but %s " +
+                                       "exists; attempt %s stays in %s",
+                                       student, new_d, attempt, d)
+                    else:
+                        logger.info("Groups of %s changed; moving %s to %s",
+                                    student, d, new_d)
+                        os.makedirs(os.path.dirname(new_d), exist_ok=True)
+                        os.rename(d, new_d)
+                        st['directory'] = new_d
+        if moved:
+            self.autosave()
+
+    def _cached_by_student(self, cache, compute, student):
+        try:
+            name, value = cache[student.username]
+        except KeyError:
+            pass
+        else:
+            if name == student.name:
+                return value
+        value = compute(student)
+        cache[student.username] = (student.name, value)
+        return value
+
+    def student_visible(self, student):
+        """
+        get_student_visible, cached until the student's groups (see
+        groups_changed) or name change.
+        """
+        return self._cached_by_student(
+            self._visible_cache, self.get_student_visible, student)
 
-    def get_rubric(self, attempt_rubric):
+    def student_ordering(self, student):
+        """
+        get_student_ordering, cached until the student's groups (see
+        groups_changed) or name change.
+        """
+        return self._cached_by_student(
+            self._ordering_cache, self.get_student_ordering, student)
+
+    def get_rubric(self, attempt_rubric, refresh=False):
+        """
+        Return the Rubric of attempt_rubric, fetching the rubric if it
+        has not been fetched before. If refresh is true, the rubric is
+        also fetched again if it is out of date (see cache_ttls), but
+        the cached rubric is used if the connection fails.
+        """
         if not hasattr(self, 'rubrics') or self.rubrics is None:
             self.rubrics = {}
         rubric_id = attempt_rubric['id']
+        fetch = functools.partial(fetch_rubric, self.session,
+                                  attempt_rubric['assocEntityId'],
+                                  attempt_rubric)
+        apply = functools.partial(self.rubrics.__setitem__, rubric_id)
         if rubric_id not in self.rubrics:
-            assoc_id = attempt_rubric['assocEntityId']
-            self.rubrics[rubric_id] = fetch_rubric(
-                self.session, assoc_id, rubric)
+            self.cache.refresh('rubrics', fetch, apply, key=rubric_id)
+        elif refresh:
+            import requests
+            try:
+                self.cache.ensure('rubrics', fetch, apply, key=rubric_id)
+            except requests.ConnectionError:
+                logger.warning("Could not fetch rubric %s; "
+                               "using the cached rubric", rubric_id)
 
         rubric = self.rubrics[rubric_id]
         title = rubric['title']
@@ -98,18 +393,30 @@ class Grading(blackboard.Serializable):
 
         return Rubric(title=title, rows=rows)
 
-    def get_rubrics(self, attempt_id):
+    def get_rubrics(self, attempt_id, refresh=False):
         if isinstance(attempt_id, Attempt):
             attempt_id = attempt_id.id
         attempt = self.attempt_state.get(attempt_id, {})
         rubrics = (attempt.get('rubric_data') or dict(rubrics=()))['rubrics']
-        return [self.get_rubric(attempt_rubric) for attempt_rubric in rubrics]
+        return [self.get_rubric(attempt_rubric, refresh)
+                for attempt_rubric in rubrics]
 
     def deserialize_default(self, key):
         if key in ('groups', 'rubrics'):
             return {}
+        if key == 'groups_version':
+            return 0
+        if key == 'cache_times':
+            return {}
         return super().deserialize_default(key)
 
+    def get_personal_strings(self):
+        """The names and student numbers of the students in the gradebook."""
+        students = getattr(self.gradebook, '_students', None) or {}
+        return [student[k] for student in students.values()
+                for k in ('first_name', 'last_name', 'student_number')
+                if student.get(k)]
+
     def get_student_groups(self, student):
         if self.groups is None:
             return []
@@ -232,9 +539,9 @@ class Grading(blackboard.Serializable):
     def print_gradebook(self):
         """Print a representation of the gradebook state."""
         columns = self.get_gradebook_columns()
-        students = filter(self.get_student_visible,
+        students = filter(self.student_visible,
                           self.gradebook.students.values())
-        students = sorted(students, key=self.get_student_ordering)
+        students = sorted(students, key=self.student_ordering)
         rows = self.get_gradebook_cells(columns, students)
         for row in rows:
             row_fmt = []
@@ -270,9 +577,9 @@ class Grading(blackboard.Serializable):
             columns.append(
                 (name, functools.partial(display, assignment=assignment)))
 
-        students = filter(self.get_student_visible,
+        students = filter(self.student_visible,
                           self.gradebook.students.values())
-        students = sorted(students, key=self.get_student_ordering)
+        students = sorted(students, key=self.student_ordering)
         rows = self.get_gradebook_cells(columns, students)
         for row in rows:
             print('\t'.join(map(str, row)), file=fp)
@@ -283,7 +590,7 @@ class Grading(blackboard.Serializable):
             assignment = str(assignment)
         assert isinstance(assignment, str)
         students = self.gradebook.students.values()
-        students = list(filter(self.get_student_visible, students))
+        students = list(filter(self.student_visible, students))
         group_students = [
             student for student in students
             if self.get_student_group_display(student) == group
@@ -311,7 +618,7 @@ class Grading(blackboard.Serializable):
                      needs_download=None, needs_upload=None):
         students = self.gradebook.students.values()
         if visible is True:
-            students = filter(self.get_student_visible, students)
+            students = filter(self.student_visible, students)
         attempts = (attempt for student in students
                     for assignment in student.assignments.values()
                     for attempt in assignment.attempts)
@@ -325,13 +632,289 @@ class Grading(blackboard.Serializable):
                 lambda a: self.has_feedback(a) and a.needs_grading, attempts)
         return sorted(attempts)
 
+    # Download the "Download assignment" ZIP file instead of fetching each
+    # attempt individually when at least this many attempts of an assignment
+    # need to be downloaded. Set to None to disable.
+    download_bundle_threshold = 5
+
     def download_all_attempt_files(self, **kwargs):
         kwargs.setdefault('needs_grading', True)
         kwargs.setdefault('needs_download', True)
-        for attempt in self.get_attempts(**kwargs):
+        attempts = self.get_attempts(**kwargs)
+        if self.download_bundle_threshold is not None:
+            attempts = self.download_attempt_bundles(attempts)
+        for attempt in attempts:
             self.download_attempt_files(attempt)
             # print("Would download %s to %s" %
             #       (attempt, self.get_attempt_directory_name(attempt)))
+        self.extractor.wait()
+
+    def download_attempt_bundles(self, attempts):
+        """
+        Download attempts using the assignment ZIP file.
+        Returns the attempts that must be downloaded individually.
+        """
+        import requests
+        by_assignment = collections.OrderedDict()
+        for attempt in attempts:
+            by_assignment.setdefault(
+                attempt.assignment.id, []).append(attempt)
+        remaining = []
+        for assignment_id, assignment_attempts in by_assignment.items():
+            if len(assignment_attempts) < self.download_bundle_threshold:
+                remaining.extend(assignment_attempts)
+                continue
+            # The bundle contains no rubric data, so fetch one attempt to
+            # see whether the assignment has a rubric, in which case each
+            # attempt is fetched individually to get its rubric.txt.
+            probe = assignment_attempts[0]
+            self.refresh_attempt_files(probe)
+            remaining.append(probe)
+            if self.get_rubrics(probe):
+                logger.info("Not using assignment bundle for %s, " +
+                            "which has a rubric", probe.assignment)
+                remaining.extend(assignment_attempts[1:])
+                continue
+            assignment_attempts = assignment_attempts[1:]
+            try:
+                remaining.extend(self.download_attempt_bundle(
+                    assignment_id, assignment_attempts))
+            except ParserError as exn:
+                logger.warning("Could not download assignment bundle: %s",
+                               exn)
+                exn.save()
+                remaining.extend(assignment_attempts)
+            except (requests.RequestException, zipfile.BadZipFile) as exn:
+                logger.warning("Could not download assignment bundle: %s",
+                               exn)
+                remaining.extend(assignment_attempts)
+        return sorted(remaining)
+
+    # Refresh the gradebook and download attempts in a pipeline
+    # (see download_pipeline) when running with -d.
+    use_pipeline = True
+    # Maximum number of items waiting between two pipeline stages
+    pipeline_queue_size = 16
+
+    def download_pipeline(self, refresh_attempts=False, visible=True,
+                          needs_grading=True):
+        """
+        Refresh the gradebook and download attempts that need downloading.
+
+        Unlike refresh() followed by download_all_attempt_files(),
+        the gradebook refresh, the DWR attempt lists, fetch_attempt,
+        file downloads and archive extraction run as separate stages,
+        so an attempt is downloaded as soon as its attempt list is known
+        while further attempt lists are still being fetched.
+        """
+        logger.info("Refresh gradebook")
+        student_visible = self.student_visible if visible else None
+        seen = set()
+        bundle_assignments = set()
+        bundles = collections.OrderedDict()
+
+        def refresh_gradebook():
+            self.cache.refresh('gradebook', self.gradebook.fetch,
+                               self.gradebook.set_overview)
+            if not self.attempt_state:
+                self.attempt_state = {}
+            self.refresh_group_memberships()
+            bundle_assignments.update(self.get_bundle_assignment_ids(
+                student_visible, needs_grading))
+            refresh_all = (refresh_attempts or
+                           self.cache.needs_fetch('attempts'))
+            if refresh_all:
+                self.cache.policy.touch('attempts')
+            missing = self.gradebook.get_attempt_keys(
+                student_visible=student_visible,
+                refresh_all=refresh_all)
+            if missing:
+                logger.info("Fetching %d attempt list%s", len(missing),
+                            '' if len(missing) == 1 else 's')
+            missing_set = set(missing)
+            students = self.gradebook.students.values()
+            if student_visible is not None:
+                students = filter(student_visible, students)
+            cached = [(student.id, assignment_id)
+                      for student in students
+                      for assignment_id, a in student.assignments.items()
+                      if (student.id, assignment_id) not in missing_set]
+            yield False, cached
+            batch_size = 20
+            for i in range(0, len(missing), batch_size):
+                yield True, missing[i:i+batch_size]
+
+        def list_attempts(batch):
+            fetch, keys = batch
+            if fetch:
+                attempt_data = dwr_get_attempts_info(self.session, keys)
+                self.gradebook.store_attempt_lists(keys, attempt_data)
+            students = self.gradebook.students
+            for user_id, assignment_id in keys:
+                student_assignment = (
+                    students[user_id].assignments[assignment_id])
+                for attempt in student_assignment.attempts:
+                    if needs_grading and not attempt.needs_grading:
+                        continue
+                    if attempt in seen:
+                        continue
+                    seen.add(attempt)
+                    if not self.has_downloaded(attempt):
+                        yield attempt
+
+        def bundle(attempt):
+            if attempt.assignment.id in bundle_assignments:
+                bundles.setdefault(attempt.assignment.id, []).append(attempt)
+                return ()
+            return (attempt,)
+
+        def bundle_finish():
+            attempts = [a for b in bundles.values() for a in b]
+            return self.download_attempt_bundles(attempts)
+
+        def fetch(attempt):
+            self.get_attempt_files(attempt)
+            yield attempt
+
+        def download(attempt):
+            self.download_attempt_files(attempt)
+            yield attempt
+
+        def extract(attempt):
+            # Only wait for the archives of this attempt; the rest are
+            # waited for once the pipeline is done.
+            d = self.get_attempt_directory(attempt, create=False)
+            if d is not None:
+                self.extractor.wait(d)
+            yield attempt
+
+        pipeline = Pipeline(maxsize=self.pipeline_queue_size)
+        pipeline.add_stage('attempts', list_attempts)
+        pipeline.add_stage('bundle', bundle, finish=bundle_finish)
+        pipeline.add_stage('fetch', fetch)
+        pipeline.add_stage('download', download)
+        pipeline.add_stage('extract', extract)
+        # Attempt state is modified from several threads;
+        # only save it once the pipeline is done.
+        self._defer_autosave = True
+        try:
+            pipeline.run(refresh_gradebook())
+        finally:
+            self._defer_autosave = False
+            pipeline.log_metrics()
+            self.extractor.wait()
+            self.autosave()
+
+    def autosave(self):
+        if getattr(self, '_defer_autosave', False):
+            return
+        super().autosave()
+
+    def get_bundle_assignment_ids(self, student_visible, needs_grading):
+        """
+        Estimate from the gradebook overview which assignments have enough
+        attempts to download that the assignment ZIP file should be used.
+        """
+        if self.download_bundle_threshold is None:
+            return set()
+        counts = collections.Counter()
+        students = self.gradebook.students.values()
+        if student_visible is not None:
+            students = filter(student_visible, students)
+        for student in students:
+            for assignment_id, assignment in student.assignments.items():
+                if assignment.needs_grading or not needs_grading:
+                    counts[assignment_id] += 1
+        return set(assignment_id for assignment_id, n in counts.items()
+                   if n >= self.download_bundle_threshold)
+
+    def get_attempt_bundle_key(self, attempt):
+        """
+        Return the (name, date) pair identifying the attempt
+        in an assignment ZIP file. Several attempts may share a key
+        (see match_bundle_attempts).
+        """
+        if attempt.assignment.group_assignment:
+            return (attempt.group_name, attempt.date)
+        else:
+            return (attempt.student.username, attempt.date)
+
+    def download_attempt_bundle(self, assignment_id, attempts):
+        logger.info("Download assignment bundle for %s (%d attempts)",
+                    attempts[0].assignment, len(attempts))
+        # The bundle contains every attempt of the assignment, so match
+        # against all attempts, including those that are not wanted.
+        known = collections.defaultdict(dict)
+        for attempt in attempts:
+            for a in attempt.assignment.attempts:
+                known[self.get_attempt_bundle_key(a)].setdefault(a.id, a)
+        known = {key: sorted(by_id.values(), key=lambda a: a.attempt_index)
+                 for key, by_id in known.items()}
+        wanted = set(attempt.id for attempt in attempts)
+        found = set()
+        with tempfile.TemporaryFile() as fp:
+            fetch_assignment_bundle(self.session, assignment_id, fp)
+            fp.seek(0)
+            with zipfile.ZipFile(fp) as zf:
+                bundle_attempts = index_bundle(zf)
+                for b, attempt in match_bundle_attempts(bundle_attempts,
+                                                        known):
+                    if attempt.id not in wanted or b.metadata is None:
+                        continue
+                    self.extract_bundle_attempt(attempt, zf, b)
+                    found.add(attempt.id)
+        logger.info("Found %d of %d attempts in assignment bundle",
+                    len(found), len(attempts))
+        return [attempt for attempt in attempts if attempt.id not in found]
+
+    def extract_bundle_attempt(self, attempt, zf, bundle_attempt):
+        st = self.get_attempt_state(attempt, create=True)
+        if 'files' not in st:
+            metadata = bundle_attempt.metadata
+            st.update(
+                submission=metadata['answer'],
+                comments=metadata['comments'],
+                files=[dict(filename=name, download_link=None,
+                            bundle_member=zinfo.filename)
+                       for name, zinfo in bundle_attempt.members],
+                feedback='',
+                feedbackfiles=[],
+                score=attempt.score,
+                # Rubric data is not in the bundle; refresh before upload.
+                # Assignments with a rubric are not downloaded as bundles
+                # (see download_attempt_bundles).
+                bundle=True,
+            )
+        d = self.get_attempt_directory(attempt, create=True)
+        for o in self.get_attempt_files(attempt):
+            if 'bundle_member' not in o:
+                continue
+            outfile = os.path.join(d, o['filename'])
+            if self.is_file_downloaded(attempt, o['filename'], outfile):
+                continue
+            if os.path.exists(outfile):
+                logger.warning("Keep %s %s (size does not match the "
+                               "download; delete it to extract it again)",
+                               attempt, outfile)
+                continue
+            logger.info("Extract %s %s from assignment bundle",
+                        attempt, outfile)
+            with zf.open(o['bundle_member']) as src:
+                if self.store is None:
+                    with open(outfile + '.part', 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 64*1024)
+                    metadata = dict(
+                        size=os.path.getsize(outfile + '.part'),
+                        sha256=hash_file(outfile + '.part').hexdigest())
+                    os.replace(outfile + '.part', outfile)
+                else:
+                    digest = self.store.add_file(src)
+                    self.store.link(digest, outfile)
+                    metadata = self.store.get_metadata(digest)
+            self.set_download_metadata(attempt, o['filename'], metadata)
+            self.extract_archive(outfile)
+        # Store submission text and comments
+        self.download_attempt_files(attempt)
 
     def get_attempt_directory(self, attempt, create):
         assert isinstance(attempt, Attempt)
@@ -383,16 +966,25 @@ class Grading(blackboard.Serializable):
 
     def download_attempt_files(self, attempt):
         assert isinstance(attempt, Attempt)
-        files = self.get_attempt_files(attempt)
+        files = self.get_attempt_files(attempt, refresh_rubrics=True)
         d = self.get_attempt_directory(attempt, create=True)
         for o in files:
             filename = o['filename']
             outfile = os.path.join(d, filename)
-            if os.path.exists(outfile):
+            if self.is_file_downloaded(attempt, filename, outfile):
                 logger.info("Skip downloading %s %s (already exists)",
                             attempt, outfile)
+                continue
 
-            elif 'contents' in o:
+            if os.path.exists(outfile):
+                # The size differs from the downloaded file,
+                # e.g. because the grader has edited it
+                logger.warning("Keep %s %s (size does not match the "
+                               "download; delete it to download it again)",
+                               attempt, outfile)
+                continue
+
+            if 'contents' in o:
                 s = o['contents']
                 if s and not s.endswith('\n'):
                     s += '\n'
@@ -400,34 +992,99 @@ class Grading(blackboard.Serializable):
                     fp.write(s)
                 logger.info("Storing %s %s (text content)", attempt, filename)
 
+            elif o.get('download_link') is None:
+                # The file was listed in an assignment bundle, but it is
+                # not on disk; fetch the attempt to get a download link.
+                self.refresh_attempt_files(attempt)
+                return self.download_attempt_files(attempt)
+
+            elif self.store is not None:
+                download_link = o['download_link']
+                digest = self.store.get(download_link)
+                if digest is None:
+                    logger.info("Download %s %s", attempt, outfile)
+                    digest = self.store.download(self.session, download_link)
+                else:
+                    logger.info("Link %s %s (previously downloaded)",
+                                attempt, outfile)
+                self.store.link(digest, outfile)
+                self.set_download_metadata(
+                    attempt, filename, self.store.get_metadata(digest))
+                self.extract_archive(outfile)
+
             else:
                 download_link = o['download_link']
-                response = self.session.session.get(download_link, stream=True)
                 logger.info("Download %s %s", attempt, outfile)
-                with open(outfile, 'wb') as fp:
-                    for chunk in response.iter_content(chunk_size=64*1024):
-                        if chunk:
-                            fp.write(chunk)
+                metadata = download_file(self.session, download_link, outfile)
+                self.set_download_metadata(attempt, filename, metadata)
                 self.extract_archive(outfile)
 
+    def set_download_metadata(self, attempt, filename, metadata):
+        """Record the size and SHA-256 digest of a downloaded file."""
+        st = self.get_attempt_state(attempt, create=True)
+        st.setdefault('downloads', {})[filename] = metadata
+        self.autosave()
+
+    def is_file_downloaded(self, attempt, filename, outfile,
+                           check_digest=False):
+        """
+        Return True if outfile exists and matches the size recorded
+        when it was downloaded.
+        """
+        downloads = self.get_attempt_state(attempt).get('downloads', {})
+        return file_matches(outfile, downloads.get(filename), check_digest)
+
+    # Directory in which downloaded files are stored by content;
+    # attempt directories contain hardlinks into this directory.
+    # Set to None to store downloads directly in the attempt directories.
+    download_store = '.bbfetch-store'
+
+    @property
+    def store(self):
+        if self.download_store is None:
+            return None
+        try:
+            return self._store
+        except AttributeError:
+            self._store = DownloadStore(self.download_store)
+            return self._store
+
+    # Limits on the size and number of files of each extracted archive
+    extract_max_size = 2 * 1024 ** 3
+    extract_max_files = 10000
+    # Number of processes extracting archives (None: number of CPUs)
+    extract_workers = None
+
+    @property
+    def extractor(self):
+        try:
+            return self._extractor
+        except AttributeError:
+            self._extractor = Extractor(
+                max_workers=self.extract_workers,
+                max_size=self.extract_max_size,
+                max_files=self.extract_max_files)
+            return self._extractor
+
     def extract_archive(self, filename):
+        """
+        Extract the downloaded file if it is an archive.
+        Subclasses may handle an extension by defining a method named
+        extract_<ext>; otherwise the file is passed to self.extractor,
+        which extracts it in the background.
+        """
         base, ext = os.path.splitext(filename)
         if ext.startswith('.'):
             try:
-                method = getattr(self, 'extract_' + ext.strip('.'))
+                method = getattr(self, 'extract_' + ext.strip('.').lower())
             except AttributeError:
                 pass
             else:
                 method(filename)
+                return
+        self.extractor.submit(filename)
 
-    def extract_zip(self, filename):
-        path = os.path.dirname(filename)
-        logger.debug("Unzip archive %s", filename)
-        import zipfile
-        with zipfile.ZipFile(filename) as zf:
-            zf.extractall(path)
-
-    def get_attempt_files(self, attempt):
+    def get_attempt_files(self, attempt, refresh_rubrics=False):
         assert isinstance(attempt, Attempt)
         keys = 'submission comments files'.split()
         st = self.get_attempt_state(attempt)
@@ -460,7 +1117,7 @@ class Grading(blackboard.Serializable):
         if st.get('feedback'):
             used_filenames.remove('comments.txt')
             add_file('comments.txt', contents=st['feedback'])
-        rubrics = self.get_rubrics(attempt)
+        rubrics = self.get_rubrics(attempt, refresh_rubrics)
         if rubrics:
             add_file('rubric.txt',
                      contents='\n'.join(r.get_form_as_text() for r in rubrics))
@@ -486,6 +1143,7 @@ class Grading(blackboard.Serializable):
         new_state = fetch_attempt(
             self.session, attempt.id, attempt.assignment.group_assignment)
         st = self.get_attempt_state(attempt, create=True)
+        st.pop('bundle', None)
         st.update(new_state)
         self.autosave()
 
@@ -499,8 +1157,11 @@ class Grading(blackboard.Serializable):
         if not directory:
             return False
         files = self.get_attempt_files(attempt)
-        filenames = [os.path.join(directory, o['filename']) for o in files]
-        return all(os.path.exists(f) for f in filenames)
+        return all(
+            self.is_file_downloaded(
+                attempt, o['filename'],
+                os.path.join(directory, o['filename']))
+            for o in files)
 
     def has_feedback(self, attempt):
         directory = self.get_attempt_directory(attempt, create=False)
@@ -516,9 +1177,12 @@ class Grading(blackboard.Serializable):
         feedback_file = os.path.join(directory, 'comments.txt')
         try:
             with open(feedback_file) as fp:
-                return markdown2.markdown(fp.read())
+                text = fp.read()
         except FileNotFoundError:
             return
+        # markdown2 is slow to import, so only import it when needed.
+        import markdown2
+        return markdown2.markdown(text)
 
     def get_feedback_attachments(self, attempt):
         directory = self.get_attempt_directory(attempt, create=False)
@@ -536,7 +1200,7 @@ class Grading(blackboard.Serializable):
         directory = self.get_attempt_directory(attempt, create=False)
         if not directory:
             return
-        rubrics = self.get_rubrics(attempt)
+        rubrics = self.get_rubrics(attempt, refresh=True)
         if not rubrics:
             return
         rubric_file = os.path.join(directory, 'rubric.txt')
@@ -564,6 +1228,85 @@ class Grading(blackboard.Serializable):
         elif accept:
             return 1
 
+    # Disk space that attempts downloaded ahead with --prefetch may use
+    prefetch_disk_budget = 1024 ** 3
+
+    def get_grading_order(self):
+        """
+        Return the ungraded attempts without feedback in the order
+        they should be graded: attempts of the assignment with the deadline
+        closest to now come first, and then by get_student_ordering.
+        """
+        now = time.time()
+
+        def key(attempt):
+            due = attempt.assignment.due
+            return (abs(due - now) if due else float('inf'),
+                    self.student_ordering(attempt.student))
+
+        attempts = [attempt
+                    for attempt in self.get_attempts(needs_grading=True)
+                    if not self.has_feedback(attempt)]
+        return sorted(attempts, key=key)
+
+    def get_attempt_disk_usage(self, attempt):
+        directory = self.get_attempt_directory(attempt, create=False)
+        if not directory:
+            return 0
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for f in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, f))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def prefetch(self, attempts, ahead):
+        """
+        Return a Prefetcher that downloads and extracts the attempts
+        following the one currently being graded.
+        """
+        def fetch(attempt):
+            if not self.has_downloaded(attempt):
+                self.download_attempt_files(attempt)
+            self.extractor.wait()
+
+        return Prefetcher(attempts, fetch, ahead=ahead,
+                          disk_budget=self.prefetch_disk_budget,
+                          disk_usage=self.get_attempt_disk_usage)
+
+    def grade_with_prefetch(self, ahead, interval=2):
+        """
+        Present the ungraded attempts one at a time, moving on when
+        comments.txt has been written, while the next attempts are
+        downloaded in the background.
+        """
+        attempts = self.get_grading_order()
+        if not attempts:
+            print("No attempts need grading")
+            return
+        prefetcher = self.prefetch(attempts, ahead)
+        try:
+            for i, attempt in enumerate(attempts):
+                try:
+                    prefetcher.get(i)
+                except Exception:
+                    logger.exception("Could not download %s %s",
+                                     attempt.assignment, attempt)
+                    print("%d/%d: Download of %s %s failed; skipping" % (
+                        i + 1, len(attempts), attempt.assignment, attempt))
+                    continue
+                print("%d/%d: Grade %s %s in %s" % (
+                    i + 1, len(attempts), attempt.assignment, attempt,
+                    self.get_attempt_directory(attempt, create=False)))
+                while not self.has_feedback(attempt):
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            print('')
+        finally:
+            prefetcher.close()
+
     def upload_all_feedback(self, dry_run=False):
         return self.upload_attempts(self.get_attempts(needs_upload=True),
                                     dry_run=dry_run)
@@ -574,8 +1317,17 @@ class Grading(blackboard.Serializable):
     def upload_attempts(self, attempts, dry_run):
         uploads = []
         for attempt in attempts:
-            feedback = self.get_feedback(attempt)
             errors = []
+            if self.get_attempt_state(attempt).get('bundle'):
+                # Attempt details came from an assignment bundle,
+                # which does not contain rubric data.
+                self.refresh_attempt_files(attempt)
+                directory = self.get_attempt_directory(attempt, create=False)
+                if (self.get_rubrics(attempt) and directory and
+                        not os.path.exists(
+                            os.path.join(directory, 'rubric.txt'))):
+                    errors.append("rubric.txt missing; download again")
+            feedback = self.get_feedback(attempt)
             try:
                 score = self.get_feedback_score(feedback)
             except ValueError as exn:
@@ -613,42 +1365,74 @@ class Grading(blackboard.Serializable):
                 attempts=[attempt for attempt, _s, _f, _a, _r in uploads])
             self.autosave()
 
+    # Replaced by execute() when --profile is given
+    profiler = Profiler()
+
     def main(self, args, session, grading):
+        phase = self.profiler.phase
         if args.refresh_groups:
-            self.refresh_groups()
+            with phase('groups'):
+                self.refresh_groups()
+        pipelined = self.use_pipeline and args.refresh and args.download
         if args.refresh:
+            import requests
             try:
-                self.refresh(refresh_attempts=args.refresh_attempts)
+                with phase('refresh'):
+                    if pipelined:
+                        self.download_pipeline(
+                            refresh_attempts=args.refresh_attempts,
+                            visible=True if args.download < 3 else None,
+                            needs_grading=(True if args.download < 2
+                                           else None))
+                    else:
+                        self.refresh(refresh_attempts=args.refresh_attempts)
             except requests.ConnectionError:
                 print("Connection failed; continuing in offline mode (-n)")
                 args.refresh = False
+                pipelined = False
         if args.check:
-            self.check()
+            with phase('check'):
+                self.check()
         if args.download_attempt:
             group, assignment, attempt_index = args.download_attempt
-            self.download_attempt_files(
-                self.get_attempt(group, assignment, attempt_index))
-        if args.download >= 3:
-            self.download_all_attempt_files(
-                visible=None, needs_grading=None)
+            with phase('download'):
+                self.download_attempt_files(
+                    self.get_attempt(group, assignment, attempt_index))
+                self.extractor.wait()
+        if pipelined:
+            # Attempts were downloaded by download_pipeline
+            pass
+        elif args.download >= 3:
+            with phase('download'):
+                self.download_all_attempt_files(
+                    visible=None, needs_grading=None)
         elif args.download >= 2:
-            self.download_all_attempt_files(
-                visible=True, needs_grading=None)
+            with phase('download'):
+                self.download_all_attempt_files(
+                    visible=True, needs_grading=None)
         elif args.download >= 1:
-            self.download_all_attempt_files(
-                visible=True, needs_grading=True)
+            with phase('download'):
+                self.download_all_attempt_files(
+                    visible=True, needs_grading=True)
+        if args.prefetch:
+            self.grade_with_prefetch(args.prefetch)
         if args.upload_check:
-            self.upload_all_feedback(dry_run=True)
+            with phase('upload'):
+                self.upload_all_feedback(dry_run=True)
         if args.upload:
-            self.upload_all_feedback(dry_run=False)
+            with phase('upload'):
+                self.upload_all_feedback(dry_run=False)
             if args.refresh:
                 # Refresh after upload to show that feedback
                 # has been uploaded
-                self.refresh()
-        self.print_gradebook()
-        if args.save is not None:
-            with open(args.save, 'w') as fp:
-                self.dump_gradebook(fp)
+                with phase('refresh'):
+                    self.cache.policy.invalidate('gradebook')
+                    self.refresh()
+        with phase('render'):
+            self.print_gradebook()
+            if args.save is not None:
+                with open(args.save, 'w') as fp:
+                    self.dump_gradebook(fp)
 
     def check(self):
         print("Username: %r" % (self.session.username,))
@@ -706,6 +1490,9 @@ class Grading(blackboard.Serializable):
                                  'attempt index 0', type=attempt_type)
         parser.add_argument('--download', '-d', action='count', default=0,
                             help='Download handins that need grading')
+        parser.add_argument('--prefetch', '-p', metavar='N', type=int,
+                            help='Show ungraded handins one at a time ' +
+                                 'while downloading the next N')
         parser.add_argument('--upload', '-u', action='store_true',
                             help='Upload handins that have been graded')
         parser.add_argument('--upload-check', '-U', action='store_true',
@@ -718,6 +1505,38 @@ class Grading(blackboard.Serializable):
                             help='Refresh list of student attempts')
         parser.add_argument('--save', '-o',
                             help='Output TSV file with gradebook info')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print timing statistics for each ' +
+                                 'kind of request to Blackboard')
+        parser.add_argument('--trace', metavar='FILE',
+                            help='Save a trace of the requests made ' +
+                                 '(HAR if FILE ends with .har, ' +
+                                 'otherwise JSON Lines)')
+        parser.add_argument('--profile', metavar='DIRECTORY',
+                            help='Profile each phase of the run with ' +
+                                 'cProfile and tracemalloc and save ' +
+                                 'the reports in DIRECTORY')
+        parser.add_argument('--base-url', metavar='URL',
+                            help='Talk to the Blackboard server at URL ' +
+                                 'instead of https://bb.au.dk, ' +
+                                 'e.g. a blackboard.mockserver')
+        parser.add_argument('--record', metavar='FILE',
+                            help='Record the requests made to Blackboard ' +
+                                 'in the fixture archive FILE')
+        parser.add_argument('--replay', metavar='FILE',
+                            help='Answer requests from the fixture ' +
+                                 'archive FILE instead of Blackboard')
+        parser.add_argument('--replay-latency', metavar='SECONDS',
+                            type=float, default=0.0,
+                            help='Delay each replayed response')
+        parser.add_argument('--daemon', action='store_true',
+                            help='Keep running in the background, ' +
+                                 'answering later invocations of this ' +
+                                 'program from memory')
+        parser.add_argument('--daemon-interval', metavar='SECONDS',
+                            type=int, default=300,
+                            help='How often the daemon refreshes ' +
+                                 'the gradebook')
 
         return parser
 
@@ -767,6 +1586,12 @@ class Grading(blackboard.Serializable):
     def execute_from_command_line(cls):
         parser = cls.get_argument_parser()
         args = parser.parse_args()
+        session_options = any(getattr(args, option)
+                              for option in daemon.SESSION_OPTIONS)
+        if not (args.daemon or args.prefetch or session_options):
+            # If a daemon is running in this directory, let it do the work.
+            if daemon.run_client(sys.argv[1:]):
+                return
         blackboard.configure_logging(quiet=args.quiet)
 
         not_implemented = []
@@ -788,9 +1613,39 @@ class Grading(blackboard.Serializable):
         session = cls.session_class('cookies.txt', username, course)
         grading = cls(session)
         grading.override_get_password(args)
-        try:
+        if args.base_url:
+            session.endpoints.base_url = args.base_url
+        if args.record:
+            # Scrub the names of the students that are already in
+            # grading.json; names in fetched gradebooks are found by the
+            # recorder (see blackboard.fixtures).
+            try:
+                grading.load('grading.json', refresh=False)
+            except FileNotFoundError:
+                pass
+            session.record_fixtures(args.record,
+                                    personal=grading.get_personal_strings())
+        elif args.replay:
+            session.replay_fixtures(args.replay, latency=args.replay_latency)
+        if args.daemon:
             grading.load('grading.json')
-            grading.main(args, session, grading)
+            daemon.Daemon(grading, parser,
+                          refresh_interval=args.daemon_interval
+                          ).serve_forever()
+        else:
+            grading.execute(args)
+        session.close()
+
+    def execute(self, args, filename='grading.json'):
+        """Load grading.json if necessary, run main() and save the result."""
+        session = self.session
+        if args.profile:
+            self.profiler = Profiler(args.profile)
+        try:
+            if getattr(self, 'filename', None) is None:
+                with self.profiler.phase('load'):
+                    self.load(filename)
+            self.main(args, session, self)
         except ParserError as exn:
             logger.error("Parsing error")
             print(exn)
@@ -798,11 +1653,23 @@ class Grading(blackboard.Serializable):
         except BadAuth:
             logger.error("Bad username or password. Forgetting password.")
             session.forget_password()
+        except NoCredentials as exn:
+            print(exn)
         except Exception:
             logger.exception("Uncaught exception")
         else:
-            grading.save('grading.json')
+            with self.profiler.phase('save'):
+                # Store what was fetched in the background
+                self.cache.apply_pending(wait=True)
+                self.save(filename)
         session.save_cookies()
+        if args.stats:
+            session.tracer.print_stats()
+        if args.trace:
+            session.tracer.save(args.trace)
+        if args.profile:
+            self.profiler.report()
+            del self.profiler
 
     @classmethod
     def init(cls):
@@ -0,0 +1,108 @@
+"""
+Compute what changed between two group membership mappings.
+
+The mappings are those returned by fetch_groups and fetch_groups_dwr:
+usernames mapped to dictionaries whose 'groups' entry is a list of
+(name, group id) pairs. diff_groups returns a list of GroupChange
+events, which Grading.set_groups passes on to Grading.groups_changed.
+"""
+
+import collections
+
+
+JOIN = 'join'
+LEAVE = 'leave'
+RENAME = 'rename'
+REORDER = 'reorder'
+
+# For JOIN and LEAVE, username joined or left the group with the given
+# id and name. For RENAME, username is None and the group was renamed
+# from old_name to name. For REORDER, the groups that username stays in
+# are listed in a different order (e.g. Grading.get_student_group_display
+# uses the first group); group_id, name and old_name are None.
+GroupChange = collections.namedtuple(
+    'GroupChange', 'kind username group_id name old_name')
+
+
+def user_groups(groups):
+    """
+    Map each username to a dictionary of group names by group id,
+    in the order of the user's groups.
+    """
+    return {username: {g[1]: g[0] for g in user['groups']}
+            for username, user in groups.items()}
+
+
+def diff_groups(old, new):
+    """
+    Return the changes from the group memberships old to new.
+
+    >>> old = {'au1': dict(groups=[('G1', '1')]),
+    ...        'au2': dict(groups=[('G1', '1')]),
+    ...        'au4': dict(groups=[('G1', '1'), ('G2', '2')])}
+    >>> new = {'au1': dict(groups=[('Group 1', '1')]),
+    ...        'au2': dict(groups=[['G2', '2']]),
+    ...        'au3': dict(groups=[]),
+    ...        'au4': dict(groups=[('G2', '2'), ('Group 1', '1')])}
+    >>> for change in diff_groups(old, new):
+    ...     print(tuple(change))
+    ('rename', None, '1', 'Group 1', 'G1')
+    ('leave', 'au2', '1', 'G1', None)
+    ('join', 'au2', '2', 'G2', None)
+    ('reorder', 'au4', None, None, None)
+    >>> diff_groups(new, new)
+    []
+    """
+    old_users = user_groups(old or {})
+    new_users = user_groups(new)
+    old_names = {}
+    for groups in old_users.values():
+        old_names.update(groups)
+    new_names = {}
+    for groups in new_users.values():
+        new_names.update(groups)
+    changes = []
+    for group_id in sorted(set(old_names) & set(new_names)):
+        if old_names[group_id] != new_names[group_id]:
+            changes.append(GroupChange(RENAME, None, group_id,
+                                       new_names[group_id],
+                                       old_names[group_id]))
+    for username in sorted(set(old_users) | set(new_users)):
+        before = old_users.get(username, {})
+        after = new_users.get(username, {})
+        for group_id in sorted(set(before) - set(after)):
+            changes.append(GroupChange(LEAVE, username, group_id,
+                                       before[group_id], None))
+        for group_id in sorted(set(after) - set(before)):
+            changes.append(GroupChange(JOIN, username, group_id,
+                                       after[group_id], None))
+        stayed = [g for g in before if g in after]
+        if stayed != [g for g in after if g in before]:
+            changes.append(GroupChange(REORDER, username, None, None, None))
+    return changes
+
+
+def affected_users(changes, groups):
+    """
+    Return the usernames whose groups are different after the changes:
+    those that joined, left or reordered their groups, and the members
+    of renamed groups in the group memberships groups.
+
+    >>> groups = {'au1': dict(groups=[('G1', '1')]), 'au2': dict(groups=[])}
+    >>> sorted(affected_users(
+    ...     [GroupChange(RENAME, None, '1', 'G1', 'Gruppe 1'),
+    ...      GroupChange(LEAVE, 'au3', '2', 'G2', None)], groups))
+    ['au1', 'au3']
+    """
+    renamed = set()
+    usernames = set()
+    for change in changes:
+        if change.kind == RENAME:
+            renamed.add(change.group_id)
+        else:
+            usernames.add(change.username)
+    if renamed:
+        for username, user in groups.items():
+            if any(g[1] in renamed for g in user['groups']):
+                usernames.add(username)
+    return usernames
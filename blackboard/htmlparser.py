@@ -0,0 +1,111 @@
+"""
+Parse HTML pages into ElementTree documents.
+
+All scraping code queries the parsed pages with ElementTree's
+find/findall/itertext and the XHTML namespace in NS, which is what
+html5lib.parse returns. html5lib is written in pure Python and is by far
+the slowest part of scraping, so parse_html uses html5-parser
+(`pip install html5-parser`, a C implementation of the same HTML5
+parsing algorithm) when it is installed, and html5lib otherwise.
+Both produce the same tree, so the rest of bbfetch does not care which
+one is used.
+
+Set the environment variable BBFETCH_HTML_PARSER to one of the names
+in PARSERS to choose a parser explicitly.
+Run `python -m blackboard.benchmark.parsers` to check that the installed
+parsers agree on recorded pages.
+"""
+
+import os
+import collections
+
+from blackboard.base import logger
+
+
+NS = {'h': 'http://www.w3.org/1999/xhtml'}
+
+
+def parse_html5lib(content, encoding=None):
+    import html5lib
+    return html5lib.parse(content, encoding=encoding)
+
+
+def parse_html5_parser(content, encoding=None):
+    import html5_parser
+    return html5_parser.parse(
+        content, transport_encoding=encoding, treebuilder='etree',
+        namespace_elements=True, keep_doctype=False, sanitize_names=False)
+
+
+# Parsers in order of preference, with the module each one needs
+PARSERS = collections.OrderedDict([
+    ('html5-parser', (parse_html5_parser, 'html5_parser')),
+    ('html5lib', (parse_html5lib, 'html5lib')),
+])
+
+_parser = None
+
+
+def available_parsers():
+    result = []
+    for name, (parse, module) in PARSERS.items():
+        try:
+            __import__(module)
+        except (ImportError, RuntimeError):
+            # html5-parser raises RuntimeError if it was built against
+            # another version of libxml2 than the installed lxml.
+            continue
+        result.append(name)
+    return result
+
+
+def get_parser():
+    """Return the name of the parser used by parse_html."""
+    global _parser
+    if _parser is None:
+        name = os.environ.get('BBFETCH_HTML_PARSER')
+        if name:
+            if name not in PARSERS:
+                raise ValueError("BBFETCH_HTML_PARSER must be one of %s" %
+                                 ', '.join(PARSERS))
+        else:
+            # Fall back to html5lib, which will fail to import if
+            # no parser is installed.
+            name = (available_parsers() or ['html5lib'])[0]
+        logger.debug("Parsing HTML with %s", name)
+        _parser = name
+    return _parser
+
+
+def set_parser(name):
+    global _parser
+    if name is not None and name not in PARSERS:
+        raise ValueError("Unknown HTML parser %r" % (name,))
+    _parser = name
+
+
+def parse_html(content, encoding=None):
+    """
+    Parse an HTML document (bytes in the given encoding, or str).
+    Returns the <html> element with tags in the XHTML namespace.
+    """
+    parse, module = PARSERS[get_parser()]
+    return parse(content, encoding)
+
+
+def parse_response(response):
+    """
+    Parse the HTML of a requests.Response.
+
+    The document is cached on the response, since a page is typically
+    inspected several times (for HTML redirects, for the login state,
+    for error messages and finally by the caller).
+    Callers must not modify the returned document.
+    """
+    try:
+        return response._bbfetch_document
+    except AttributeError:
+        pass
+    document = parse_html(response.content, response.encoding)
+    response._bbfetch_document = document
+    return document
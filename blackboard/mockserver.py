@@ -0,0 +1,804 @@
+"""
+A local stand-in for the parts of Blackboard that bbfetch uses,
+serving a synthetic course of configurable size.
+
+Run `python -m blackboard.mockserver --students 900 --assignments 14`
+and point bbfetch at it with `grading --base-url http://127.0.0.1:8080`
+(or by setting session.endpoints.base_url). The server implements:
+
+* courseMain (course id check)
+* getJSONData (the gradebook overview)
+* the DWR calls GradebookDWRFacade.getAttemptsInfo and getGroups
+* gradeAssignmentRedirector (the attempt page) and the grade submit POSTs
+* groupInventoryList (the paged group membership datatable)
+* gradeRubric (the rubric grid)
+* downloadAssignment (the form and the ZIP file of all attempts)
+* file downloads, with HTTP Range support
+
+Every response can be delayed (--latency, --jitter) and a fraction of
+requests can fail with 503 Service Unavailable (--error-rate),
+to exercise the concurrency and retry behavior of bbfetch.
+Login is not simulated: every request is treated as logged in.
+
+run_grading runs the grading command line against a server,
+e.g. to test `grading -d` from a doctest.
+"""
+
+import io
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import zipfile
+import threading
+import email.parser
+import collections
+import http.server
+from html import escape
+from urllib.parse import urlparse, parse_qs, parse_qsl, quote
+
+
+FIRST_NAMES = ('Anna', 'Bo', 'Carl', 'Dorthe', 'Emil', 'Freja', 'Gustav',
+               'Hanne', 'Ida', 'Jens', 'Karen', 'Lars', 'Mette', 'Niels')
+LAST_NAMES = ('Andersen', 'Christensen', 'Hansen', 'Jensen', 'Larsen',
+              'Madsen', 'Nielsen', 'Pedersen', 'Rasmussen', 'Sørensen')
+
+COURSE_ID = '_1234_1'
+
+PAGE = '''<!DOCTYPE html>
+<html><head><title>{title}</title></head>
+<body><a id="topframe.logout.label" href="/webapps/login/?action=logout">
+Log out</a>
+<a id="editModeToggleLink" class="read-on" href="#">Edit mode</a>
+<div id="contentPanel" class="contentPanel">
+{body}
+</div></body></html>'''
+
+
+def page(title, body):
+    return PAGE.format(title=escape(title), body=body).encode('utf8')
+
+
+class SyntheticCourse:
+    """
+    Students, groups, assignments, attempts and rubrics generated
+    deterministically from seed.
+
+    >>> c = SyntheticCourse(students=10, assignments=2, group_size=3)
+    >>> len(c.users), len(c.groups), len(c.assignments)
+    (10, 4, 2)
+    >>> sorted(set(len(m) for m in c.group_members.values()))
+    [1, 3]
+    """
+
+    def __init__(self, students=100, assignments=5, max_attempts=2,
+                 group_size=3, files=2, file_size=10*1024, seed=0):
+        self.rng = random.Random(seed)
+        self.max_attempts = max_attempts
+        self.max_files = files
+        self.file_size = file_size
+        self._next_id = 100000
+        self.lock = threading.Lock()
+
+        self.users = collections.OrderedDict()
+        for i in range(students):
+            uid = self.new_id()
+            self.users[uid] = dict(
+                uid=uid, username='au%06d' % (500000 + i),
+                first_name=self.rng.choice(FIRST_NAMES),
+                last_name=self.rng.choice(LAST_NAMES),
+                student_number='2020%05d' % i,
+                last_access='01-09-2020', role='Student')
+
+        self.groups = collections.OrderedDict()
+        self.group_members = collections.OrderedDict()
+        self.user_group = {}
+        for i, uid in enumerate(self.users):
+            if i % group_size == 0:
+                gid = self.new_id()
+                self.groups[gid] = 'Hand In Group %d' % (len(self.groups) + 1)
+                self.group_members[gid] = []
+            self.group_members[gid].append(uid)
+            self.user_group[uid] = gid
+
+        self.rubrics = {}
+        self.assignments = collections.OrderedDict()
+        due = datetime.datetime(2020, 9, 7, 12)
+        for k in range(assignments):
+            aid = self.new_id()
+            group = k % 2 == 1
+            a = dict(id=aid, name='Aflevering %d' % (k + 1),
+                     src='resource/x-bb-assignment', groupActivity=group,
+                     due=int(due.timestamp() * 1000) + k * 7 * 86400000,
+                     points=1)
+            if group:
+                a['rubric'] = self.new_rubric()
+            self.assignments[aid] = a
+
+        # Attempt lists by (user id, assignment id)
+        self.attempt_lists = {}
+        # Attempt pages by attempt id (group attempt id for groups)
+        self.attempts = {}
+        self.files = {}
+        for aid, a in self.assignments.items():
+            if a['groupActivity']:
+                for gid, members in self.group_members.items():
+                    attempts = self.new_attempts(a, gid)
+                    for uid in members:
+                        self.attempt_lists[uid, aid] = [
+                            dict(at, id=self.new_attempt_id())
+                            for at in attempts]
+            else:
+                for uid in self.users:
+                    self.attempt_lists[uid, aid] = self.new_attempts(
+                        a, None, uid)
+
+    def new_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    def new_attempt_id(self):
+        return '_%s_1' % self.new_id()
+
+    def new_rubric(self):
+        rubric_id = self.new_attempt_id()
+        columns = ['Ikke godkendt', 'Delvist', 'Godkendt']
+        rows = []
+        for r in range(3):
+            cells = [dict(id=self.new_attempt_id(), desc='Level %d' % c,
+                          percentage='%.2f' % (c / (len(columns) - 1)))
+                     for c in range(len(columns))]
+            rows.append(dict(id=self.new_attempt_id(),
+                             title='Opgave %d' % (r + 1), cells=cells))
+        rubric = dict(id=rubric_id, title='Bedømmelse',
+                      assoc_id=self.new_attempt_id(),
+                      columns=columns, rows=rows)
+        self.rubrics[rubric_id] = rubric
+        return rubric_id
+
+    def new_attempts(self, assignment, gid, uid=None):
+        result = []
+        n = self.rng.randint(0, self.max_attempts)
+        for i in range(n):
+            attempt_id = self.new_attempt_id()
+            latest = i == n - 1
+            graded = not latest or self.rng.random() < 0.5
+            score = float(self.rng.randint(0, 1)) if graded else 0.0
+            status = None if graded else 'ng'
+            date = datetime.date(2020, 9, 1) + datetime.timedelta(days=i)
+            info = dict(
+                date=date.strftime('%d/%m/%y'), exempt=False,
+                groupAttemptId=attempt_id if gid else None,
+                groupName=self.groups[gid] if gid else None,
+                groupScore=score, groupStatus=status, id=attempt_id,
+                override=False, score=score, status=status)
+            files = []
+            for j in range(self.rng.randint(1, self.max_files)):
+                file_id = self.new_id()
+                self.files[file_id] = self.file_size
+                files.append(dict(id=file_id, filename='handin%d.pdf' % j))
+            # Handed in at a different minute for each attempt
+            submitted = (datetime.datetime.combine(
+                date, datetime.time(10)) +
+                datetime.timedelta(minutes=len(self.attempts) % 600))
+            self.attempts[attempt_id] = dict(
+                info=info, assignment=assignment['id'], group=gid, user=uid,
+                submitted=submitted, files=files,
+                text='Her er min aflevering.',
+                comment='Hej' if i % 2 else None, feedback='',
+                score=score if graded else None,
+                rubric=assignment.get('rubric'))
+            result.append(info)
+        return result
+
+    def group_list_page(self, start, count, course_id=COURSE_ID):
+        """The page of the group membership datatable starting at start."""
+        keys = [('userorgroupname', 'Username'), ('firstname', 'First Name'),
+                ('lastname', 'Last Name'), ('Role', 'Role'),
+                ('Groups', 'Groups')]
+        parts = ['<table id="userGroupList_datatable"><thead><tr>']
+        for key, title in keys:
+            parts.append(
+                '<th><a class="sortheader" href="groupInventoryList' +
+                '?sortCol=%s&amp;sortDir=ASCENDING">%s' % (key, title) +
+                '<span class="sortarrow"></span></a></th>')
+        parts.append('</tr></thead><tbody>')
+        users = list(self.users.values())
+        for u in users[start:start + count]:
+            gid = self.user_group[u['uid']]
+            # The username follows the profile card link, whose text
+            # (including its tail) is hidden from element_text_content.
+            parts.append(
+                '<tr><td><span><a><span class="hideoff">Access the ' +
+                'profile card for user: {0}</span>'.format(u['username']) +
+                '<img alt="" src="/images/avatar.gif"/></a> ' +
+                '{0}</span></td>'.format(u['username']) +
+                '<td>%s</td><td>%s</td><td>%s</td>' %
+                (escape(u['first_name']), escape(u['last_name']), u['role']) +
+                '<td><a class="userGroupNameListItemRemove" ' +
+                'id="rmv_%s">%s</a></td></tr>' %
+                (gid, escape(self.groups[gid])))
+        parts.append('</tbody></table>')
+        href = ('groupInventoryList?course_id=%s&amp;toggleType=users' %
+                course_id + '&amp;chkAllRoles=on&amp;numResults=%d' % count +
+                '&amp;startIndex=%d')
+        # The pager links to every page, and to the next page
+        parts.append('<div class="pagination">')
+        for i, page_start in enumerate(range(0, len(users), count)):
+            parts.append('<a href="%s">%d</a>' % (href % page_start, i + 1))
+        if start + count < len(users):
+            parts.append(
+                '<a id="listContainer_nextpage_top" href="%s">' %
+                (href % (start + count)) +
+                '<img alt="Next page" src="/images/next.gif"/></a>')
+        parts.append('</div>')
+        return page('Groups', '\n'.join(parts))
+
+    def file_contents(self, file_id):
+        size = self.files[file_id]
+        block = hashlib.sha256(file_id.encode()).hexdigest().encode()
+        return (block * (size // len(block) + 1))[:size]
+
+    def assignment_bundle(self, aid):
+        """
+        The ZIP file of all attempts of an assignment, named as by the
+        "Download assignment" feature (see blackboard.bundle).
+
+        >>> c = SyntheticCourse(students=3, assignments=1, files=1)
+        >>> with zipfile.ZipFile(io.BytesIO(
+        ...         c.assignment_bundle(next(iter(c.assignments))))) as zf:
+        ...     print(zf.namelist()[:2])
+        ... # doctest: +NORMALIZE_WHITESPACE
+        ['Aflevering 1_au500000_attempt_2020-09-01-10-00-00_handin0.pdf',
+         'Aflevering 1_au500000_attempt_2020-09-01-10-00-00.txt']
+        """
+        a = self.assignments[aid]
+        with self.lock:
+            attempts = [dict(at, info=dict(at['info']))
+                        for at in self.attempts.values()
+                        if at['assignment'] == aid]
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for at in attempts:
+                if at['group']:
+                    name = self.groups[at['group']]
+                else:
+                    name = self.users[at['user']]['username']
+                prefix = '%s_%s_attempt_%s' % (
+                    a['name'], name,
+                    at['submitted'].strftime('%Y-%m-%d-%H-%M-%S'))
+                files = []
+                for f in at['files']:
+                    member = '%s_%s' % (prefix, f['filename'])
+                    zf.writestr(member, self.file_contents(f['id']))
+                    files.append('\tOriginal filename: %s\n' % f['filename'] +
+                                 '\tFilename: %s\n' % member)
+                if not files:
+                    files.append(
+                        'No files were attached to this submission.\n')
+                if at['info']['status'] == 'ng':
+                    grade = 'Needs Grading'
+                else:
+                    grade = '%s' % at['info']['score']
+                metadata = (
+                    'Name: %s\nAssignment: %s\n' % (name, a['name']) +
+                    'Date Submitted: %s\n' %
+                    at['submitted'].strftime('%d. %B %Y %H:%M') +
+                    'Current Grade: %s\n\n' % grade +
+                    'Submission Field:\n%s\n\n' % at['text'] +
+                    'Comments:\n%s\n\n' % (
+                        at['comment'] or
+                        'There are no student comments for this assignment.') +
+                    'Files:\n%s\n' % ''.join(files))
+                zf.writestr(prefix + '.txt', metadata.encode('utf8'))
+        return buf.getvalue()
+
+    def needs_grading(self, uid, aid):
+        attempts = self.attempt_lists.get((uid, aid)) or []
+        return bool(attempts) and attempts[-1]['status'] == 'ng'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Set by serve()
+    course = None
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    page_size = 1000
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    routes = [
+        ('GET', r'/webapps/blackboard/execute/courseMain$', 'course_main'),
+        ('GET', r'/webapps/gradebook/do/instructor/getJSONData$',
+         'gradebook_json'),
+        ('GET', r'/javascript/dwr/engine\.js$', 'dwr_engine'),
+        ('POST', r'/webapps/gradebook/dwr/call/plaincall/' +
+         r'GradebookDWRFacade\.getAttemptsInfo\.dwr$', 'dwr_attempts'),
+        ('POST', r'/webapps/gradebook/dwr/call/plaincall/' +
+         r'GradebookDWRFacade\.getGroups\.dwr$', 'dwr_groups'),
+        ('GET', r'/webapps/assignment/gradeAssignmentRedirector$',
+         'attempt_page'),
+        ('POST', r'/webapps/assignment//?grade(Group)?Assignment/submit$',
+         'submit_grade'),
+        ('GET', r'/webapps/bb-group-mgmt-LEARN/execute/groupInventoryList$',
+         'group_list'),
+        ('GET', r'/webapps/rubric/do/course/gradeRubric$', 'rubric_page'),
+        ('GET', r'/webapps/gradebook/do/instructor/downloadAssignment$',
+         'download_assignment_form'),
+        ('POST', r'/webapps/gradebook/do/instructor/downloadAssignment$',
+         'download_assignment'),
+        ('GET', r'/bbcswebdav/gradebook_(\d+)_attempts\.zip$',
+         'assignment_bundle'),
+        ('GET', r'/bbcswebdav/xid-(\d+)_1$', 'download'),
+        ('GET', r'/webapps/blackboard/execute/doCourseMenuAction$',
+         'course_main'),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        o = urlparse(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(o.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        delay = self.latency
+        with self.rng_lock:
+            if self.jitter:
+                delay += self.rng.uniform(0, self.jitter)
+            fail = self.rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            return self.reply(page('Error', '<p>Service unavailable</p>'),
+                              status=503)
+        for m, pattern, name in self.routes:
+            mo = re.match(pattern, o.path)
+            if m == method and mo:
+                try:
+                    return getattr(self, name)(*mo.groups())
+                except KeyError as exn:
+                    return self.reply(
+                        page('Not found', '<p>No such item: %s</p>' %
+                             escape(str(exn))), status=404)
+        self.reply(page('Not found', '<p>Not found</p>'), status=404)
+
+    def reply(self, body, content_type='text/html; charset=utf-8',
+              status=200, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if not self.headers.get('Cookie'):
+            self.send_header('Set-Cookie',
+                             'JSESSIONID=mock; Path=/webapps/gradebook')
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def course_main(self):
+        self.reply(page('Course', '<p>Welcome</p>'))
+
+    def gradebook_json(self):
+        c = self.course
+        col_defs = [dict(id='FN', name='First name'),
+                    dict(id='LN', name='Last name')]
+        col_defs += [dict((k, v) for k, v in a.items() if k != 'rubric')
+                     for a in c.assignments.values()]
+        rows = []
+        for uid, u in c.users.items():
+            row = [dict(uid=uid, avail=True),
+                   dict(c='FN', v=u['first_name']),
+                   dict(c='LN', v=u['last_name']),
+                   dict(c='UN', v=u['username']),
+                   dict(c='SI', v=u['student_number']),
+                   dict(c='LA', v=u['last_access'])]
+            for aid in c.assignments:
+                attempts = c.attempt_lists.get((uid, aid)) or []
+                if not attempts:
+                    continue
+                row.append(dict(c=aid, v=attempts[-1]['score'],
+                                ng=c.needs_grading(uid, aid)))
+            rows.append(row)
+        self.reply(json.dumps(dict(colDefs=col_defs, rows=rows)).encode(),
+                   'application/json')
+
+    def dwr_engine(self):
+        self.reply(b'dwr.engine._origScriptSessionId = "MOCKSESSION";',
+                   'text/javascript')
+
+    def dwr_calls(self):
+        form = dict(parse_qsl(self.body.decode('utf8')))
+        for i in range(int(form['callCount'])):
+            params = []
+            j = 0
+            while 'c%d-param%d' % (i, j) in form:
+                params.append(
+                    form['c%d-param%d' % (i, j)].split(':', 1)[1])
+                j += 1
+            yield i, params
+
+    def dwr_reply(self, statements):
+        js = ("throw 'allowScriptTagRemoting is false.';\n" +
+              "//#DWR-INSERT\n//#DWR-REPLY\n" + '\n'.join(statements))
+        self.reply(js.encode('utf8'), 'text/javascript')
+
+    def dwr_attempts(self):
+        c = self.course
+        statements = []
+        n = 0
+        for i, (course_id, uid, aid) in self.dwr_calls():
+            names = []
+            for info in c.attempt_lists.get((uid, aid)) or []:
+                name = 's%d' % n
+                n += 1
+                names.append(name)
+                statements.append('var %s={};' % name + ''.join(
+                    '%s.%s=%s;' % (name, k, json.dumps(v))
+                    for k, v in sorted(info.items())))
+            statements.append(
+                "dwr.engine._remoteHandleCallback('42','%d',[%s]);" %
+                (i, ','.join(names)))
+        self.dwr_reply(statements)
+
+    def dwr_groups(self):
+        c = self.course
+        statements = []
+        items = []
+        for n, (gid, members) in enumerate(c.group_members.items()):
+            name = 's%d' % n
+            statements.append('var %s=[];' % name + ''.join(
+                '%s[%d]=%s;' % (name, j, uid)
+                for j, uid in enumerate(members)))
+            items.append("'%s':%s" % (gid, name))
+        for i, params in self.dwr_calls():
+            statements.append(
+                "dwr.engine._remoteHandleCallback('42','%d',{%s});" %
+                (i, ','.join(items)))
+        self.dwr_reply(statements)
+
+    def attempt_page(self):
+        c = self.course
+        attempt_id = (self.query.get('groupAttemptId') or
+                      self.query['attempt_id'])
+        with c.lock:
+            a = dict(c.attempts[attempt_id])
+        parts = ['<div id="currentAttempt">']
+        parts.append('<div id="submissionTextView"><p>%s</p></div>' %
+                     escape(a['text']))
+        if a['comment']:
+            parts.append('<div id="currentAttempt_comments">' +
+                         '<div class="vtbegenerated"><p>%s</p></div></div>' %
+                         escape(a['comment']))
+        parts.append('<ul id="currentAttempt_submissionList">')
+        for f in a['files']:
+            parts.append(
+                '<li><span>%s</span>' % escape(f['filename']) +
+                '<a class="dwnldBtn" href="/bbcswebdav/xid-%s_1">' % f['id'] +
+                '<span class="hideoff">Download</span></a></li>')
+        parts.append('</ul></div>')
+        parts.append('<form id="currentAttempt_form" method="post">')
+        parts.append('<input type="hidden" name="attemptId" value="%s"/>' %
+                     attempt_id)
+        parts.append('<input type="hidden" name="nonce" value="mock"/>')
+        score = '' if a['score'] is None else '%s' % a['score']
+        parts.append('<input id="currentAttempt_grade" name="grade" ' +
+                     'value="%s"/>' % score)
+        parts.append('<textarea id="feedbacktext" name="feedbacktext">' +
+                     '%s</textarea>' % escape(a['feedback']))
+        parts.append('<textarea id="gradingNotestext" ' +
+                     'name="gradingNotestext"></textarea>')
+        if a['group'] and a['rubric']:
+            rubric = c.rubrics[a['rubric']]
+            evaluation = dict(
+                evalDataType='blackboard.platform.gradebook2.GroupAttempt',
+                evalEntityId=attempt_id,
+                rubrics=[dict(
+                    id=rubric['id'], title=rubric['title'],
+                    assocEntityId=rubric['assoc_id'],
+                    rows=[dict(row_id=r['id'], cell_id=None)
+                          for r in rubric['rows']])])
+            parts.append(
+                '<input type="hidden" id="%s_rubricEvaluation" ' % attempt_id +
+                'name="%s_rubricEvaluation" value="%s"/>' %
+                (attempt_id, escape(quote(json.dumps(evaluation)))))
+        parts.append('</form>')
+        self.reply(page('Grade attempt', '\n'.join(parts)))
+
+    def submit_grade(self, group):
+        c = self.course
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() +
+            b'\r\n\r\n' + self.body)
+        form = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is None:
+                form[name] = part.get_payload(decode=True).decode('utf8')
+        attempt_id = form.get('attemptId')
+        with c.lock:
+            if attempt_id not in c.attempts:
+                return self.reply(page('Error', '<span id="badMsg1">' +
+                                       'No such attempt</span>'))
+            a = c.attempts[attempt_id]
+            try:
+                a['score'] = float(form.get('grade') or 0)
+            except ValueError:
+                return self.reply(page('Error', '<span id="badMsg1">' +
+                                       'Invalid grade</span>'))
+            a['feedback'] = form.get('feedbacktext', '')
+            # Group members have their own copies of the attempt info
+            infos = [a['info']] + [
+                info for attempts in c.attempt_lists.values()
+                for info in attempts
+                if info['groupAttemptId'] == attempt_id]
+            for info in infos:
+                info['status'] = info['groupStatus'] = None
+                info['score'] = info['groupScore'] = a['score']
+        self.reply(page('Graded', '<span id="goodMsg1">Success: ' +
+                        'grade and feedback saved.</span>'))
+
+    def group_list(self):
+        start = int(self.query.get('startIndex', 0))
+        count = min(int(self.query.get('numResults', self.page_size)),
+                    self.page_size)
+        self.reply(self.course.group_list_page(
+            start, count, self.query.get('course_id', COURSE_ID)))
+
+    def rubric_page(self):
+        c = self.course
+        rubric = c.rubrics[self.query['rubricId']]
+        prefix = self.query.get('prefix', 'BBFETCH')
+        parts = ['<table id="%s_rubricGradingTable"><thead><tr><th></th>' %
+                 prefix]
+        parts += ['<th>%s</th>' % escape(col) for col in rubric['columns']]
+        parts.append('</tr></thead><tbody>')
+        for row in rubric['rows']:
+            parts.append('<tr rubricrowid="%s"><th>%s</th>' %
+                         (row['id'], escape(row['title'])))
+            for cell in row['cells']:
+                parts.append(
+                    '<td rubriccellid="%s">' % cell['id'] +
+                    '<div class="rubricCellContainer">' +
+                    '<div class="u_controlsWrapper radioLabel">' +
+                    '<input type="radio"/></div>' +
+                    '<div class="u_controlsWrapper">%s</div>' %
+                    escape(cell['desc']) +
+                    '<input class="selectedPercentField" type="hidden" ' +
+                    'value="%s"/></div></td>' % cell['percentage'])
+            parts.append('</tr>')
+        parts.append('</tbody></table>')
+        self.reply(page('Rubric', '\n'.join(parts)))
+
+    def download_assignment_form(self):
+        c = self.course
+        aid = self.query['outcome_definition_id']
+        a = c.assignments[aid]
+        parts = ['<form action="downloadAssignment" method="post">']
+        parts.append('<input type="hidden" name="outcome_definition_id" ' +
+                     'value="%s"/>' % aid)
+        parts.append('<input type="hidden" name="course_id" value="%s"/>' %
+                     escape(self.query.get('course_id', COURSE_ID)))
+        parts.append('<table><tbody>')
+        for uid, u in c.users.items():
+            if not c.attempt_lists.get((uid, aid)):
+                continue
+            parts.append(
+                '<tr><td><input type="checkbox" name="students_to_export" ' +
+                'value="%s"/></td><td>%s %s</td></tr>' %
+                (uid, escape(u['first_name']), escape(u['last_name'])))
+        parts.append('</tbody></table>')
+        for option in ('LAST', 'ALL'):
+            parts.append('<input type="radio" name="downloadOption" ' +
+                         'value="%s"/>' % option)
+        parts.append('<input type="submit" name="bottom_Submit" ' +
+                     'value="Submit"/></form>')
+        self.reply(page('Download assignment: %s' % a['name'],
+                        '\n'.join(parts)))
+
+    def download_assignment(self):
+        form = dict(parse_qsl(self.body.decode('utf8')))
+        aid = form.get('outcome_definition_id')
+        if aid not in self.course.assignments:
+            return self.reply(page('Error', '<p>No such assignment</p>'),
+                              status=404)
+        if form.get('downloadOption') != 'ALL':
+            # bbfetch always asks for all attempts
+            return self.reply(page('Error', '<p>Unsupported option</p>'),
+                              status=400)
+        self.reply(page('Download assignment',
+                        '<p><a href="/bbcswebdav/gradebook_%s_attempts.zip">' %
+                        aid + 'Download assignments now</a></p>'))
+
+    def assignment_bundle(self, aid):
+        self.reply(self.course.assignment_bundle(aid), 'application/zip')
+
+    def download(self, file_id):
+        data = self.course.file_contents(file_id)
+        headers = [('Accept-Ranges', 'bytes')]
+        mo = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if mo:
+            offset = int(mo.group(1))
+            if offset >= len(data):
+                return self.reply(b'', 'application/octet-stream', 416)
+            headers.append(('Content-Range', 'bytes %d-%d/%d' %
+                            (offset, len(data) - 1, len(data))))
+            return self.reply(data[offset:], 'application/octet-stream',
+                              206, headers)
+        self.reply(data, 'application/pdf', headers=headers)
+
+
+def make_server(course, host='127.0.0.1', port=8080, latency=0.0,
+                jitter=0.0, error_rate=0.0, page_size=1000, seed=0,
+                verbose=False):
+    """
+    Return a ThreadingHTTPServer serving course.
+    Call serve_forever() on it (in a thread if necessary).
+    """
+    handler = type('Handler', (Handler,), dict(
+        course=course, latency=latency, jitter=jitter,
+        error_rate=error_rate, page_size=page_size,
+        rng=random.Random(seed), rng_lock=threading.Lock()))
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    return server
+
+
+def run_grading(server, directory, *argv):
+    """
+    Run the grading command line with the arguments argv against server
+    for a course directory (grading.json, attempt directories and
+    download store) in directory. Returns the Grading object.
+
+    >>> import tempfile, contextlib
+    >>> course = SyntheticCourse(students=30, assignments=2, files=1)
+    >>> server = make_server(course, port=0)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     with contextlib.redirect_stdout(io.StringIO()):
+    ...         grading = run_grading(server, d, '-d')
+    ...     attempts = grading.get_attempts(needs_grading=True)
+    ...     missing = [a for a in attempts if not grading.has_downloaded(a)]
+    ...     bundled = [a for a in attempts
+    ...                if grading.get_attempt_state(a).get('bundle')]
+    ...     # A file edited by the grader is kept when downloading again
+    ...     st = grading.get_attempt_state(attempts[0])
+    ...     edited = os.path.join(st['directory'], st['files'][0]['filename'])
+    ...     with open(edited) as fp:
+    ...         contents = fp.read()
+    ...     os.remove(edited)  # Most editors save to a new file
+    ...     with open(edited, 'w') as fp:
+    ...         _ = fp.write(contents + 'annotated')
+    ...     with contextlib.redirect_stdout(io.StringIO()):
+    ...         _ = run_grading(server, d, '-d')
+    ...     with open(edited) as fp:
+    ...         kept = fp.read().endswith('annotated')
+    >>> kept
+    True
+    >>> len(attempts) == sum(a['info']['status'] == 'ng'
+    ...                      for a in course.attempts.values()), missing
+    (True, [])
+    >>> ops = {s['operation']: s['count']
+    ...        for s in grading.session.tracer.operation_stats()}
+    >>> ops['fetch_assignment_bundle'], len(bundled) > 0
+    (1, True)
+    >>> ops['fetch_attempt'] == len(attempts) - len(bundled)
+    True
+    >>> server.server_close()
+
+    Offline mode (-n) uses the cached rubrics even after they have
+    expired, and so does -d when the server cannot be reached:
+
+    >>> server = make_server(course, port=0)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     with contextlib.redirect_stdout(io.StringIO()):
+    ...         grading = run_grading(server, d, '-d')
+    ...     rubrics = grading.rubrics
+    ...     server.shutdown()
+    ...     server.server_close()
+    ...     filename = os.path.join(d, 'grading.json')
+    ...     with open(filename) as fp:
+    ...         o = json.load(fp)
+    ...     for times in o['payload']['cache_times'].values():
+    ...         for key in times:
+    ...             times[key] -= 2 * 86400
+    ...     with open(filename, 'w') as fp:
+    ...         json.dump(o, fp)
+    ...     for argv in ('-n', '-d'):
+    ...         with contextlib.redirect_stdout(io.StringIO()) as out:
+    ...             grading = run_grading(server, d, argv)
+    ...         print(argv, len(out.getvalue().splitlines()) > len(attempts),
+    ...               grading.rubrics == rubrics != {})
+    -n True True
+    -d True True
+    """
+    from blackboard import BlackboardSession
+    from blackboard.grading import Grading
+
+    class MockGrading(Grading):
+        username = 'au100000'
+        course = COURSE_ID
+        classes = all
+        positive_list = negative_list = ()
+        student_group_display_regex = (r'Hand In Group (\d+)', r'\1')
+        assignment_name_display_regex = (r'Aflevering (\d+)', r'\1')
+        download_store = os.path.join(directory, '.bbfetch-store')
+
+        def get_group_name_display(self, group_name):
+            return group_name
+
+        def get_attempt_directory_name(self, attempt):
+            return os.path.join(directory, attempt.id)
+
+    session = BlackboardSession(os.path.join(directory, 'cookies.txt'),
+                                MockGrading.username, COURSE_ID)
+    session.endpoints.base_url = 'http://%s:%d' % server.server_address[:2]
+    grading = MockGrading(session)
+    args = MockGrading.get_argument_parser().parse_args(argv)
+    grading.execute(args, os.path.join(directory, 'grading.json'))
+    session.close()
+    return grading
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--assignments', type=int, default=5)
+    parser.add_argument('--attempts', type=int, default=2,
+                        help='Maximum number of attempts per handin')
+    parser.add_argument('--group-size', type=int, default=3)
+    parser.add_argument('--files', type=int, default=2,
+                        help='Maximum number of files per attempt')
+    parser.add_argument('--file-size', type=int, default=10*1024)
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Maximum number of rows per datatable page')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Delay each response by this many seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Add a random delay of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests that fail with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    course = SyntheticCourse(
+        students=args.students, assignments=args.assignments,
+        max_attempts=args.attempts, group_size=args.group_size,
+        files=args.files, file_size=args.file_size, seed=args.seed)
+    server = make_server(
+        course, args.host, args.port, latency=args.latency,
+        jitter=args.jitter, error_rate=args.error_rate,
+        page_size=args.page_size, seed=args.seed, verbose=args.verbose)
+    print("Serving %d students, %d assignments and %d attempts " %
+          (len(course.users), len(course.assignments), len(course.attempts)) +
+          "on http://%s:%d/ (use course id %s)" %
+          (args.host, server.server_port, COURSE_ID))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
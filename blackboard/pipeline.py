@@ -0,0 +1,169 @@
+"""
+Run a sequence of stages in separate threads connected by bounded queues,
+so that an item can be processed by a later stage while the next item is
+still being processed by an earlier stage.
+
+>>> p = Pipeline(maxsize=2)
+>>> p.add_stage('double', lambda x: [2 * x])
+>>> p.add_stage('odd', lambda x: [x + 1] if x % 4 else [])
+>>> p.run(range(5))
+[3, 7]
+>>> [s.items_in for s in p.stages]
+[5, 5]
+"""
+
+import time
+import queue
+import threading
+
+from blackboard import logger
+
+
+_END = object()
+
+
+class Stage:
+    """
+    A pipeline stage. For each input item, fn(item) returns an iterable
+    of items for the next stage. When all input has been processed,
+    finish() (if given) returns an iterable of further items.
+    """
+
+    def __init__(self, name, fn, workers=1, finish=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.finish = finish
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.blocked_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_metrics(self, items_in=0, items_out=0, errors=0,
+                    busy=0.0, wait=0.0, blocked=0.0):
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.errors += errors
+            self.busy_time += busy
+            self.wait_time += wait
+            self.blocked_time += blocked
+
+    def metrics(self):
+        return dict(
+            name=self.name, items_in=self.items_in,
+            items_out=self.items_out, errors=self.errors,
+            busy=self.busy_time, wait=self.wait_time,
+            blocked=self.blocked_time)
+
+
+class Pipeline:
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.stages = []
+        self._failed = threading.Event()
+        self._exception = None
+
+    def add_stage(self, name, fn, workers=1, finish=None):
+        self.stages.append(Stage(name, fn, workers, finish))
+
+    def _put(self, stage, q, item):
+        t = time.time()
+        q.put(item)
+        stage.add_metrics(items_out=1, blocked=time.time() - t)
+
+    def _fail(self, stage, item, exn):
+        stage.add_metrics(errors=1)
+        if self._exception is None:
+            self._exception = exn
+            logger.error("Pipeline stage %s failed on %r", stage.name, item)
+        self._failed.set()
+
+    def _worker(self, stage, inq, outq, done):
+        while True:
+            t = time.time()
+            item = inq.get()
+            waited = time.time() - t
+            if item is _END:
+                inq.put(_END)  # Let the other workers of this stage stop
+                stage.add_metrics(wait=waited)
+                break
+            stage.add_metrics(items_in=1, wait=waited)
+            if self._failed.is_set():
+                # Drain the queue so that upstream stages do not block
+                continue
+            t = time.time()
+            blocked = 0.0
+            try:
+                for result in stage.fn(item) or ():
+                    t2 = time.time()
+                    self._put(stage, outq, result)
+                    blocked += time.time() - t2
+            except Exception as exn:
+                self._fail(stage, item, exn)
+            stage.add_metrics(busy=time.time() - t - blocked)
+        with stage._lock:
+            done[0] += 1
+            last = done[0] == stage.workers
+        if last:
+            if stage.finish is not None and not self._failed.is_set():
+                try:
+                    for result in stage.finish() or ():
+                        self._put(stage, outq, result)
+                except Exception as exn:
+                    self._fail(stage, 'finish', exn)
+            outq.put(_END)
+
+    def run(self, source):
+        """
+        Feed the items of the iterable source through the stages.
+        Returns the list of items produced by the last stage.
+        If a stage raises an exception, the remaining items are discarded
+        and the first exception is re-raised once all threads are done.
+        """
+        queues = [queue.Queue(self.maxsize)
+                  for i in range(len(self.stages) + 1)]
+        # The last queue collects results and is not bounded
+        queues[-1] = queue.Queue()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            done = [0]
+            for j in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, queues[i], queues[i + 1], done),
+                    name='%s-%d' % (stage.name, j),
+                    daemon=True)
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in source:
+                if self._failed.is_set():
+                    break
+                queues[0].put(item)
+        except Exception as exn:
+            self._exception = self._exception or exn
+            self._failed.set()
+        queues[0].put(_END)
+        results = []
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            results.append(item)
+        for thread in threads:
+            thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return results
+
+    def log_metrics(self):
+        for stage in self.stages:
+            logger.info(
+                "Stage %(name)s: %(items_in)d in, %(items_out)d out, "
+                "%(errors)d errors, busy %(busy).1f s, "
+                "waiting for input %(wait).1f s, "
+                "blocked on output %(blocked).1f s", stage.metrics())
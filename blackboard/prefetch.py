@@ -0,0 +1,87 @@
+"""
+Fetch the next few items of a list in the background
+while the user is working on the current item.
+"""
+
+import threading
+import concurrent.futures
+
+from blackboard import logger
+
+
+class Prefetcher:
+    """
+    Call fetch(item) in a background thread for the items following
+    the current one, so that they are ready when the user gets to them.
+
+    At most `ahead` items are fetched ahead of the current item.
+    If disk_usage(item) is given, fetching ahead stops when the items
+    fetched ahead use more than disk_budget bytes.
+
+    >>> fetched = []
+    >>> p = Prefetcher(['a', 'b', 'c', 'd'], fetched.append, ahead=2)
+    >>> p.get(0)
+    >>> p.wait()
+    >>> fetched
+    ['a', 'b', 'c']
+    >>> p.close()
+    """
+
+    def __init__(self, items, fetch, ahead=3, disk_budget=None,
+                 disk_usage=None):
+        self.items = list(items)
+        self.fetch = fetch
+        self.ahead = ahead
+        self.disk_budget = disk_budget
+        self.disk_usage = disk_usage
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def _submit(self, i):
+        with self._lock:
+            try:
+                return self._futures[i]
+            except KeyError:
+                f = self._futures[i] = self._executor.submit(
+                    self.fetch, self.items[i])
+                return f
+
+    def _over_budget(self, current):
+        if self.disk_budget is None or self.disk_usage is None:
+            return False
+        used = 0
+        for j in range(current + 1, len(self.items)):
+            f = self._futures.get(j)
+            if f is None or not f.done():
+                continue
+            used += self.disk_usage(self.items[j])
+        return used >= self.disk_budget
+
+    def schedule(self, current):
+        """Start fetching the items following items[current]."""
+        end = min(len(self.items), current + 1 + self.ahead)
+        for j in range(current + 1, end):
+            if j in self._futures:
+                continue
+            if self._over_budget(current):
+                logger.debug("Prefetch disk budget exhausted")
+                break
+            self._submit(j)
+
+    def get(self, i):
+        """
+        Fetch items[i] (waiting for it if it is being fetched in the
+        background) and start fetching the following items.
+        Returns the result of fetch(items[i]).
+        """
+        f = self._submit(i)
+        self.schedule(i)
+        return f.result()
+
+    def wait(self):
+        for f in list(self._futures.values()):
+            f.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
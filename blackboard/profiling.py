@@ -0,0 +1,106 @@
+"""
+Profile the phases of a grading run (refresh, download, upload, ...)
+with cProfile and tracemalloc.
+
+For each phase, Profiler.phase(name) writes `<name>.prof` (load it with
+pstats or snakeviz), `<name>.txt` with the functions taking the most
+time and the lines allocating the most memory, and Profiler.report()
+prints a summary of all phases followed by the hottest functions overall.
+
+Only the thread running the phase is profiled by cProfile, so work done
+by pipeline and prefetch worker threads shows up as time spent waiting.
+"""
+
+import io
+import os
+import time
+import pstats
+import cProfile
+import contextlib
+import tracemalloc
+
+
+class Profiler:
+    def __init__(self, directory=None, top=20):
+        # With directory=None, phase() does nothing.
+        self.directory = directory
+        self.top = top
+        self.phases = []
+        self._stats = None
+
+    def _unique_name(self, name):
+        names = [p['name'] for p in self.phases]
+        if name not in names:
+            return name
+        i = 2
+        while '%s-%d' % (name, i) in names:
+            i += 1
+        return '%s-%d' % (name, i)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.directory is None:
+            yield
+            return
+        name = self._unique_name(name)
+        os.makedirs(self.directory, exist_ok=True)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        t = time.time()
+        c = time.process_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            wall = time.time() - t
+            cpu = time.process_time() - c
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            self._save_phase(name, profile, wall, cpu, peak,
+                             after.compare_to(before, 'lineno'))
+
+    def _save_phase(self, name, profile, wall, cpu, peak, memory_diff):
+        base = os.path.join(self.directory, name)
+        profile.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as fp:
+            fp.write("Phase %s: %.2f s wall, %.2f s CPU, " % (name, wall, cpu) +
+                     "peak memory %.1f MiB\n\n" % (peak / 1024**2))
+            stats = pstats.Stats(profile, stream=fp)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.sort_stats('tottime').print_stats(self.top)
+            fp.write("Top %d allocations:\n" % self.top)
+            for d in memory_diff[:self.top]:
+                fp.write("%s\n" % (d,))
+        if self._stats is None:
+            self._stats = pstats.Stats(profile)
+        else:
+            self._stats.add(profile)
+        self.phases.append(dict(name=name, wall=wall, cpu=cpu, peak=peak,
+                                allocated=sum(d.size_diff
+                                              for d in memory_diff)))
+
+    def report(self, file=None):
+        if not self.phases:
+            return
+        print("%-12s %8s %8s %10s %10s" %
+              ('Phase', 'Wall', 'CPU', 'Peak MiB', 'Alloc MiB'), file=file)
+        for p in self.phases:
+            print("%-12s %7.2fs %7.2fs %10.1f %10.1f" %
+                  (p['name'], p['wall'], p['cpu'], p['peak'] / 1024**2,
+                   p['allocated'] / 1024**2), file=file)
+        s = io.StringIO()
+        self._stats.stream = s
+        self._stats.sort_stats('tottime').print_stats(self.top)
+        print("Hottest functions in all phases:", file=file)
+        # Skip the preamble of print_stats up to the table header
+        lines = s.getvalue().splitlines()
+        start = next((i for i, l in enumerate(lines) if 'ncalls' in l), 0)
+        print('\n'.join(lines[start:]), file=file)
+        print("Reports saved in %s" % self.directory, file=file)
@@ -1,44 +1,124 @@
 import re
+import time
 import getpass
-import keyring
-import html5lib
-import requests
-import requests.cookies
+import threading
 
 from six.moves.http_cookiejar import LWPCookieJar
 from six.moves.urllib.parse import urlparse, parse_qs, urlencode
 
 from blackboard.base import BadAuth, ParserError, logger
+from blackboard.trace import Tracer
+from blackboard.endpoints import Endpoints
+from blackboard.htmlparser import parse_response
+from blackboard.fragments import element_attributes
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
 
 class BlackboardSession:
+    # Override in a subclass, or assign session.endpoints.base_url,
+    # to talk to another Blackboard server.
+    base_url = 'https://bb.au.dk'
+
     def __init__(self, cookiejar, username, course_id):
         self.cookiejar_filename = cookiejar
         self.username = username
         self.course_id = course_id
 
         self.password = None
+        self.replaying = False
+        self.endpoints = Endpoints(self.base_url)
+        self.tracer = Tracer(self.endpoints)
         self.cookies = LWPCookieJar(cookiejar)
-        self.session = requests.Session()
+        self._session = None
+        # The session is shared by worker threads (e.g. those of
+        # Grading.download_pipeline), which must not log in at once.
+        self._session_lock = threading.Lock()
+        self._login_lock = threading.RLock()
+        self._logins = 0
         self.load_cookies()
 
+    @property
+    def session(self):
+        # requests is slow to import, so only import it
+        # when the first request is made.
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    import requests.cookies
+                    session = requests.Session()
+                    requests.cookies.merge_cookies(session.cookies,
+                                                   self.cookies)
+                    self._session = session
+        return self._session
+
+    def record_fixtures(self, filename, scrub=(), personal=()):
+        """
+        Record all requests and responses into the fixture archive filename
+        (see blackboard.fixtures). The archive is written when close()
+        is called. The strings in scrub are replaced by REDACTED and
+        those in personal (names and student numbers) by made-up ones.
+        """
+        from blackboard.fixtures import RecordingAdapter
+        adapter = RecordingAdapter(
+            filename, scrub=[self.username, self.password] + list(scrub),
+            personal=personal)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def replay_fixtures(self, filename, latency=0.0, scale=0.0):
+        """
+        Answer all requests from the fixture archive filename
+        instead of the network.
+        """
+        from blackboard.fixtures import ReplayAdapter, REDACTED
+        adapter = ReplayAdapter(filename, session=self.session,
+                                latency=latency, scale=scale)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Credentials were scrubbed from the recording
+        self.username = self.username or REDACTED
+        self.password = REDACTED
+        # Start from the cookies of the recording, not those in cookies.txt,
+        # and do not overwrite cookies.txt with them.
+        self.session.cookies.clear()
+        self.replaying = True
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
     def load_cookies(self):
         try:
             self.cookies.load(ignore_discard=True)
         except FileNotFoundError:
             pass
-        requests.cookies.merge_cookies(self.session.cookies, self.cookies)
+        if self._session is not None:
+            import requests.cookies
+            requests.cookies.merge_cookies(self._session.cookies, self.cookies)
 
     def save_cookies(self):
-        requests.cookies.merge_cookies(self.cookies, self.session.cookies)
+        if self.replaying:
+            return
+        if self._session is not None:
+            import requests.cookies
+            requests.cookies.merge_cookies(self.cookies, self._session.cookies)
         self.cookies.save(ignore_discard=True)
 
+    def url(self, name, **params):
+        """
+        Return the URL of the endpoint name (see blackboard.endpoints).
+        course_id defaults to the course of this session.
+        """
+        params.setdefault('course_id', self.course_id)
+        return self.endpoints.url(name, **params)
+
     def get_cookie(self, key, path):
         try:
-            return self.session.cookies._cookies['bb.au.dk'][path][key].value
+            return self.session.cookies._cookies[
+                self.endpoints.host][path][key].value
         except KeyError:
             print(self.session.cookies._cookies)
             raise
@@ -47,6 +127,7 @@ class BlackboardSession:
         return input("WAYF username: ")
 
     def get_password(self):
+        import keyring
         p = keyring.get_password("fetch.py WAYF", self.username)
         if p is None:
             print("Please enter password for %s to store in keyring." %
@@ -65,6 +146,8 @@ class BlackboardSession:
     def forget_password(self):
         if self.username is None:
             raise ValueError("forget_password: username is None")
+        self.password = None
+        import keyring
         keyring.delete_password("fetch.py WAYF", self.username)
 
     def wayf_login(self, response):
@@ -91,10 +174,7 @@ class BlackboardSession:
         return response
 
     def relogin(self):
-        url = (
-            'https://bb.au.dk/webapps/bb-auth-provider-shibboleth-BBLEARN' +
-            '/execute/shibbolethLogin?authProviderId=_102_1')
-        response = self.get(url)
+        response = self.get(self.url('login'))
         if self.detect_login(response) is False:
             logger.error("Seems logged out after re-login. " +
                          "Try deleting your cookiejar.")
@@ -102,15 +182,15 @@ class BlackboardSession:
         return response
 
     def detect_login(self, response):
-        document = html5lib.parse(response.content, encoding=response.encoding)
-        logged_out_url = (
-            '/webapps/portal/execute/tabs/tabAction?tab_tab_group_id=_21_1')
-        o = document.find('.//h:a[@href="%s"]' % logged_out_url, NS)
-        if o is not None:
-            return False
+        logged_out_url = self.endpoints.path('logged_out')
+        # Only parse the page if it may contain the logged out link.
+        if logged_out_url.encode() in response.content:
+            document = parse_response(response)
+            o = document.find('.//h:a[@href="%s"]' % logged_out_url, NS)
+            if o is not None:
+                return False
         log_out_id = 'topframe.logout.label'
-        o = document.find('.//h:a[@id="%s"]' % log_out_id, NS)
-        if o is not None:
+        if element_attributes(response, log_out_id) is not None:
             return True
 
     def post_hidden_form(self, response):
@@ -121,8 +201,7 @@ class BlackboardSession:
         response : requests.Response
             Page containing form with only hidden fields
         """
-
-        document = html5lib.parse(response.content, encoding=response.encoding)
+        document = parse_response(response)
         form = document.find('.//h:form', NS)
         url = form.get('action')
         inputs = form.findall('.//h:input[@name]', NS)
@@ -142,21 +221,20 @@ class BlackboardSession:
         If the given response has no HTML redirect, return it unaltered.
         Otherwise, return a new response by following the redirects.
         """
-
         js_redirect_pattern = (
             r'(?:<!--)?\s*' +
             r'document\.location\.replace\(\'' +
             r'(?P<url>(?:\\.|[^\'])+)' +
             r'\'\);\s*' +
             r'(?:(?://)?-->)?\s*$')
-        real_login_url = (
-            'https://bb.au.dk/webapps/' +
-            'bb-auth-provider-shibboleth-BBLEARN/execute/shibbolethLogin')
+        real_login_url = self.url('shibboleth_login')
+        login_page = urlparse(self.url('login_page'))
         history = list(response.history) + [response]
 
         while True:
-            document = html5lib.parse(
-                response.content, encoding=response.encoding)
+            if b'document.location.replace' not in response.content:
+                break
+            document = parse_response(response)
             scripts = document.findall('.//h:script', NS)
 
             next_url = None
@@ -168,8 +246,7 @@ class BlackboardSession:
                     break
             if next_url is not None:
                 o = urlparse(next_url)
-                p = o.netloc + o.path
-                if p == 'bb.au.dk/webapps/login/':
+                if (o.netloc, o.path) == (login_page.netloc, login_page.path):
                     qs = parse_qs(o.query)
                     try:
                         return_url = qs['new_loc'][0]
@@ -178,13 +255,13 @@ class BlackboardSession:
                         return_url = ''
                     # It seems that making a GET request to this page
                     # logs you out?
-                    if return_url == '/webapps/login/?action=relogin':
+                    if return_url == login_page.path + '?action=relogin':
                         logger.debug(
                             "Not setting returnUrl to %r", return_url)
                         return_url = ''
                     new_qs = urlencode(
                         dict(returnUrl=return_url,
-                             authProviderId='_102_1'))
+                             authProviderId=self.endpoints.auth_provider_id))
                     next_url = '%s?%s' % (real_login_url, new_qs)
                 response = self.session.get(next_url)
                 history += list(response.history) + [response]
@@ -193,34 +270,42 @@ class BlackboardSession:
         response.history = history[:-1]
         return response
 
-    def autologin(self, response):
+    def autologin(self, response, logins=None):
         """Automatically log in if necessary.
 
         If the given response is not for a login form,
         just follow HTML redirects and return the response.
         Otherwise, log in using wayf_login and get_auth.
+
+        Only one thread logs in at a time. If logins is given, it is the
+        number of logins when the request was made; if another thread
+        has logged in since, the request is made again instead.
         """
 
         response = self.follow_html_redirect(response)
         o = urlparse(response.url)
-        if o.netloc == 'wayf.au.dk':
-            response = self.wayf_login(response)
+        if o.netloc == self.endpoints.login_host:
+            with self._login_lock:
+                if logins is not None and logins != self._logins:
+                    first = (response.history or [response])[0]
+                    return self.autologin(self.session.get(first.url))
+                response = self.wayf_login(response)
+                self._logins += 1
         return response
 
     def get_edit_mode(self, response):
-        document = html5lib.parse(response.content, encoding=response.encoding)
-        mode_switch = document.find('.//*[@id="editModeToggleLink"]', NS)
+        mode_switch = element_attributes(response, 'editModeToggleLink')
         if mode_switch is not None:
             return 'read-on' in (mode_switch.get('class') or '').split()
 
+    def set_edit_mode(self):
+        """Switch the course to edit mode, whatever mode it is in."""
+        logger.debug("Switch to edit mode")
+        return self.get(self.url('edit_mode'))
+
     def ensure_edit_mode(self, response):
         if self.get_edit_mode(response) is False:
-            url = ('https://bb.au.dk/webapps/blackboard/execute/' +
-                   'doCourseMenuAction?cmd=setDesignerParticipantViewMode' +
-                   '&courseId=' + self.course_id +
-                   '&mode=designer')
-            logger.debug("Switch to edit mode")
-            r = self.get(url)
+            r = self.set_edit_mode()
             history = (list(response.history) + [response] +
                        list(r.history) + [r])
             response = self.get(history[0].url)
@@ -228,7 +313,15 @@ class BlackboardSession:
         return response
 
     def get(self, url):
-        response = self.autologin(self.session.get(url))
+        started = time.time()
+        response = self._get(url)
+        self.tracer.add_request('GET', url, response, started,
+                                time.time() - started)
+        return response
+
+    def _get(self, url):
+        logins = self._logins
+        response = self.autologin(self.session.get(url), logins)
         if self.detect_login(response) is False:
             history = response.history + [response]
             relogin_response = self.relogin()
@@ -243,8 +336,7 @@ class BlackboardSession:
         return response
 
     def log_error(self, response):
-        document = html5lib.parse(response.content, encoding=response.encoding)
-        content = document.find('.//h:div[@id="contentPanel"]', NS)
+        content = element_attributes(response, 'contentPanel')
         if content is not None:
             class_list = (content.get('class') or '').split()
             if 'error' in class_list:
@@ -252,8 +344,11 @@ class BlackboardSession:
                 # raise ParserError("Error", response)
 
     def post(self, url, data, files=None, headers=None):
+        started = time.time()
         response = self.session.post(
             url, data=data, files=files, headers=headers)
+        self.tracer.add_request('POST', url, response, started,
+                                time.time() - started)
         # if response.history:
         #     logger.warning('POST %r redirected', url)
         #     for r in response.history:
@@ -261,12 +356,28 @@ class BlackboardSession:
         #     logger.warning("... to %r", response.url)
         return response
 
+    def download(self, url, fp):
+        """
+        Stream the file at url into the binary file object fp,
+        raising requests.HTTPError if the server returns an error.
+        Returns the number of bytes written.
+        """
+        started = time.time()
+        response = self.session.get(url, stream=True)
+        size = 0
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64*1024):
+                if chunk:
+                    fp.write(chunk)
+                    size += len(chunk)
+        finally:
+            self.tracer.add_request('GET', url, response, started,
+                                    time.time() - started, size=size)
+        return size
+
     def ensure_logged_in(self):
-        url = (
-            'https://bb.au.dk/webapps/blackboard/content/manageDashboard.jsp' +
-            '?course_id=%s' % self.course_id +
-            '&sortCol=LastLoginCol&sortDir=D')
-        self.get(url)
+        self.get(self.url('dashboard'))
 
 
 class PassBlackboardSession(BlackboardSession):
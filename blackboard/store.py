@@ -0,0 +1,150 @@
+"""
+Content-addressed storage of downloaded files.
+
+Each downloaded file is stored once under its SHA-256 digest and
+hardlinked into the attempt directories that contain it.
+The store also remembers the digest of every download link,
+so a file whose link has been seen before is not downloaded again.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from blackboard import logger
+from blackboard.download import download_file
+
+
+class DownloadStore:
+    """
+    The store is shared by the threads of Grading.download_pipeline,
+    so the index of download links is only modified under a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.index_filename = os.path.join(path, 'links.json')
+        try:
+            with open(self.index_filename) as fp:
+                self.links = json.load(fp)
+        except FileNotFoundError:
+            self.links = {}
+        self._lock = threading.Lock()
+
+    def add_link(self, download_link, digest):
+        with self._lock:
+            self.links[download_link] = digest
+            self._save_index()
+
+    def save_index(self):
+        with self._lock:
+            self._save_index()
+
+    def _save_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.index_filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.links, fp, indent=0, sort_keys=True)
+        os.replace(tmp, self.index_filename)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def get(self, download_link):
+        """
+        Return the digest of the file at download_link,
+        or None if it is not in the store.
+        """
+        digest = self.links.get(download_link)
+        if digest is not None and os.path.exists(self.object_path(digest)):
+            return digest
+
+    def add_file(self, fp):
+        """
+        Copy the binary file object fp into the store
+        and return its digest.
+        """
+        os.makedirs(self.objects, exist_ok=True)
+        h = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.objects,
+                                         delete=False) as tmp:
+            try:
+                while True:
+                    chunk = fp.read(64*1024)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                os.remove(tmp.name)
+                raise
+        return self._commit(tmp.name, h.hexdigest())
+
+    def _commit(self, tmp, digest):
+        target = self.object_path(digest)
+        if os.path.exists(target):
+            # Identical contents are already stored
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Objects are shared between attempt directories through
+            # hardlinks, so they must not be modified in place.
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, target)
+        return digest
+
+    def download(self, session, download_link):
+        """
+        Download the file at download_link and return its digest.
+        Interrupted downloads are resumed on the next call.
+        """
+        partial = os.path.join(self.path, 'partial')
+        os.makedirs(partial, exist_ok=True)
+        name = hashlib.sha1(download_link.encode('utf8')).hexdigest()
+        filename = os.path.join(partial, name)
+        metadata = download_file(session, download_link, filename)
+        digest = self._commit(filename, metadata['sha256'])
+        self.add_link(download_link, digest)
+        return digest
+
+    def get_metadata(self, digest):
+        return dict(size=os.path.getsize(self.object_path(digest)),
+                    sha256=digest)
+
+    def link(self, digest, filename):
+        """
+        Hardlink the stored file into place as filename.
+
+        The object is shared by every attempt directory that contains
+        it, so anything that writes into an attempt directory must
+        replace files (write a new file and os.replace it into place),
+        never open them for writing. Replacing a file only changes the
+        attempt directory:
+
+        >>> import io
+        >>> d = tempfile.mkdtemp()
+        >>> store = DownloadStore(os.path.join(d, 'store'))
+        >>> digest = store.add_file(io.BytesIO(b'handin'))
+        >>> filename = os.path.join(d, 'handin.pdf')
+        >>> store.link(digest, filename)
+        >>> with open(filename + '.part', 'wb') as fp:
+        ...     _ = fp.write(b'annotated')
+        >>> os.replace(filename + '.part', filename)
+        >>> with open(store.object_path(digest), 'rb') as fp:
+        ...     data = fp.read()
+        >>> data, hashlib.sha256(data).hexdigest() == digest
+        (b'handin', True)
+        >>> shutil.rmtree(d)
+        """
+        source = self.object_path(digest)
+        try:
+            os.link(source, filename)
+        except OSError as exn:
+            # Different file systems, or hardlinks are not supported
+            logger.debug("Could not hardlink %s (%s); copying instead",
+                         filename, exn)
+            shutil.copyfile(source, filename)
@@ -0,0 +1,336 @@
+"""
+Record the HTTP requests made through a BlackboardSession.
+
+For each request the Tracer records the URL, a URL template that groups
+requests to the same endpoint, the status code, the response size, the
+number of redirects and login hops, the time reported by requests for
+the server round trips, and the backend function that made the request.
+
+Backend functions are decorated with @traced, which records the time
+spent in the function outside of HTTP requests (mostly HTML parsing)
+as its parse time.
+
+The records are aggregated into per-endpoint latency statistics
+(`grading --stats`) and can be exported as JSON Lines or HAR
+(`grading --trace FILE`) for offline analysis. Since the daemon
+(blackboard.daemon) keeps its session for as long as it runs, only the
+last MAX_RECORDS records are kept for export, and the statistics are
+aggregated as the requests are made, with the median and 90th
+percentile computed from the last SAMPLES requests of each endpoint.
+"""
+
+import re
+import json
+import math
+import time
+import datetime
+import functools
+import threading
+import collections
+
+from six.moves.urllib.parse import urlparse, parse_qsl
+
+from blackboard.base import logger
+
+
+# Requests slower than this are logged
+SLOW_REQUEST = 2
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, float('inf'))
+
+# Number of requests and operations kept for save()
+MAX_RECORDS = 10000
+
+# Number of request times per endpoint kept for the percentiles
+SAMPLES = 1000
+
+# Blackboard ids, such as course ids and the xid-... of file downloads
+ID_PATTERN = re.compile(r'(?:xid-\d+|_\d+)_\d+')
+
+
+def url_template(url):
+    """
+    Return url with the query values and Blackboard ids replaced,
+    so that requests to the same endpoint get the same template.
+
+    >>> url_template('https://bb.au.dk/webapps/assignment/gradeAssignment' +
+    ...              'Redirector?course_id=_1234_1&attempt_id=_42_1')
+    '/webapps/assignment/gradeAssignmentRedirector?attempt_id=&course_id='
+    >>> url_template('https://bb.au.dk/webapps/rubric/_17_1/grid')
+    '/webapps/rubric/_ID_/grid'
+    >>> url_template('https://bb.au.dk/bbcswebdav/xid-1234567_1')
+    '/bbcswebdav/_ID_'
+    """
+    o = urlparse(url)
+    path = ID_PATTERN.sub('_ID_', o.path)
+    keys = sorted(set(k for k, v in parse_qsl(o.query,
+                                               keep_blank_values=True)))
+    if keys:
+        return '%s?%s' % (path, '&'.join('%s=' % k for k in keys))
+    return path
+
+
+def is_login_hop(response, endpoints):
+    """
+    Return True if response is a step of logging in to the Blackboard
+    server described by endpoints (see blackboard.endpoints).
+
+    >>> from blackboard.endpoints import Endpoints
+    >>> e = Endpoints(login_host='login.example.org')
+    >>> class R: url = 'https://login.example.org/sso?x=1'
+    >>> is_login_hop(R, e)
+    True
+    >>> R.url = e.url('login')
+    >>> is_login_hop(R, e)
+    True
+    >>> R.url = e.url('course_main', course_id='_1_1')
+    >>> is_login_hop(R, e)
+    False
+    """
+    o = urlparse(response.url)
+    if o.netloc == endpoints.login_host:
+        return True
+    login_paths = (urlparse(endpoints.path(name)).path
+                   for name in ('shibboleth_login', 'login_page'))
+    return any(o.path.startswith(path) for path in login_paths)
+
+
+def percentile(sorted_values, p):
+    """
+    >>> percentile([1, 2, 3, 4], 0.5)
+    2
+    >>> percentile([1, 2, 3, 4], 0.9)
+    4
+    """
+    if not sorted_values:
+        return 0
+    # Nearest-rank method
+    i = max(0, math.ceil(p * len(sorted_values)) - 1)
+    return sorted_values[i]
+
+
+class Tracer:
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.reset()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def reset(self):
+        """Forget the requests and operations recorded so far."""
+        self.requests = collections.deque(maxlen=MAX_RECORDS)
+        self.operations = collections.deque(maxlen=MAX_RECORDS)
+        # (method, template) -> aggregated statistics of the requests
+        self._endpoints = collections.OrderedDict()
+        # name -> aggregated statistics of the operations
+        self._operations = collections.OrderedDict()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def add_request(self, method, url, response, started, elapsed,
+                    size=None):
+        """
+        Record a request. size is the number of bytes received; it must
+        be given for streamed responses, whose content is not read here.
+        """
+        history = list(response.history) + [response]
+        server_time = sum(r.elapsed.total_seconds() for r in history)
+        stack = self._stack()
+        record = collections.OrderedDict([
+            ('started', started),
+            ('method', method),
+            ('url', url),
+            ('template', url_template(url)),
+            ('status', response.status_code),
+            ('bytes', len(response.content) if size is None else size),
+            ('redirects', len(response.history)),
+            ('login_hops', sum(1 for r in history
+                               if is_login_hop(r, self.endpoints))),
+            ('time', elapsed),
+            ('server_time', server_time),
+            ('caller', stack[-1][0] if stack else None),
+        ])
+        for op in stack:
+            op[1] += elapsed
+        with self._lock:
+            self.requests.append(record)
+            key = (method, record['template'])
+            try:
+                stats = self._endpoints[key]
+            except KeyError:
+                stats = self._endpoints[key] = collections.OrderedDict([
+                    ('method', method), ('template', key[1]),
+                    ('count', 0), ('total', 0), ('max', 0), ('bytes', 0),
+                    ('login_hops', 0), ('histogram', [0] * len(BUCKETS)),
+                    ('times', collections.deque(maxlen=SAMPLES)),
+                ])
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['bytes'] += record['bytes']
+            stats['login_hops'] += record['login_hops']
+            stats['histogram'][next(i for i, b in enumerate(BUCKETS)
+                                    if elapsed < b)] += 1
+            stats['times'].append(elapsed)
+        if elapsed > SLOW_REQUEST:
+            logger.debug("%s %s took %.1f s", method, record['template'],
+                         elapsed)
+
+    def operation(self, name):
+        """
+        Context manager that attributes the requests made inside it
+        to the operation name and records its parse time.
+        """
+        return _Operation(self, name)
+
+    def _finish_operation(self, name, started, elapsed, request_time):
+        record = collections.OrderedDict([
+            ('started', started),
+            ('operation', name),
+            ('time', elapsed),
+            ('request_time', request_time),
+            ('parse_time', elapsed - request_time),
+        ])
+        with self._lock:
+            self.operations.append(record)
+            s = self._operations.get(name)
+            if s is None:
+                s = self._operations[name] = collections.OrderedDict(
+                    [('operation', name), ('count', 0), ('time', 0),
+                     ('request_time', 0), ('parse_time', 0)])
+            s['count'] += 1
+            for k in ('time', 'request_time', 'parse_time'):
+                s[k] += record[k]
+
+    def endpoint_stats(self):
+        with self._lock:
+            aggregates = [(dict(s), sorted(s['times']))
+                          for s in self._endpoints.values()]
+        result = []
+        for stats, times in aggregates:
+            result.append(collections.OrderedDict([
+                ('method', stats['method']),
+                ('template', stats['template']),
+                ('count', stats['count']),
+                ('total', stats['total']),
+                ('median', percentile(times, 0.5)),
+                ('p90', percentile(times, 0.9)),
+                ('max', stats['max']),
+                ('bytes', stats['bytes']),
+                ('login_hops', stats['login_hops']),
+                ('histogram', list(stats['histogram'])),
+            ]))
+        result.sort(key=lambda s: s['total'], reverse=True)
+        return result
+
+    def operation_stats(self):
+        with self._lock:
+            stats = [collections.OrderedDict(s)
+                     for s in self._operations.values()]
+        return sorted(stats, key=lambda s: s['time'], reverse=True)
+
+    def print_stats(self, file=None):
+        def p(*args):
+            print(*args, file=file)
+
+        if not self._endpoints:
+            p("No requests")
+            return
+        p("%5s %8s %8s %8s %8s %9s  %s" %
+          ('Count', 'Total', 'Median', 'p90', 'Max', 'KiB', 'Endpoint'))
+        for s in self.endpoint_stats():
+            p("%5d %7.1fs %7.2fs %7.2fs %7.2fs %9.0f  %s %s" %
+              (s['count'], s['total'], s['median'], s['p90'], s['max'],
+               s['bytes'] / 1024, s['method'], s['template']))
+            p("%s%s" % (' ' * 47, ' '.join(
+                '<%s:%d' % (b, n) if b != float('inf') else '>=%s:%d' %
+                (BUCKETS[-2], n)
+                for b, n in zip(BUCKETS, s['histogram']))))
+        ops = self.operation_stats()
+        if ops:
+            p()
+            p("%5s %8s %8s %8s  %s" %
+              ('Count', 'Total', 'Network', 'Parse', 'Operation'))
+            for s in ops:
+                p("%5d %7.1fs %7.1fs %7.1fs  %s" %
+                  (s['count'], s['time'], s['request_time'],
+                   s['parse_time'], s['operation']))
+
+    def save_jsonl(self, filename):
+        with open(filename, 'w') as fp:
+            for r in self.requests:
+                fp.write(json.dumps(dict(r, type='request')) + '\n')
+            for o in self.operations:
+                fp.write(json.dumps(dict(o, type='operation')) + '\n')
+
+    def save_har(self, filename):
+        entries = []
+        for r in self.requests:
+            started = datetime.datetime.fromtimestamp(
+                r['started'], datetime.timezone.utc)
+            entries.append(collections.OrderedDict([
+                ('startedDateTime', started.isoformat()),
+                ('time', r['time'] * 1000),
+                ('request', dict(
+                    method=r['method'], url=r['url'], httpVersion='HTTP/1.1',
+                    headers=[], queryString=[], cookies=[],
+                    headersSize=-1, bodySize=-1)),
+                ('response', dict(
+                    status=r['status'], statusText='', httpVersion='HTTP/1.1',
+                    headers=[], cookies=[], redirectURL='',
+                    content=dict(size=r['bytes'], mimeType=''),
+                    headersSize=-1, bodySize=r['bytes'])),
+                ('cache', {}),
+                ('timings', dict(send=0, wait=r['server_time'] * 1000,
+                                 receive=0)),
+                ('comment', r['caller'] or ''),
+            ]))
+        har = dict(log=dict(version='1.2',
+                            creator=dict(name='bbfetch', version=''),
+                            entries=entries))
+        with open(filename, 'w') as fp:
+            json.dump(har, fp, indent=1)
+
+    def save(self, filename):
+        """Save as HAR if filename ends with .har, otherwise JSON Lines."""
+        if filename.endswith('.har'):
+            self.save_har(filename)
+        else:
+            self.save_jsonl(filename)
+
+
+class _Operation:
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        self.entry = [self.name, 0.0]
+        self.tracer._stack().append(self.entry)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer._stack().pop()
+        self.tracer._finish_operation(
+            self.name, self.started, time.time() - self.started,
+            self.entry[1])
+
+
+def traced(fn):
+    """
+    Decorator for backend functions taking a BlackboardSession
+    as their first argument.
+    """
+    @functools.wraps(fn)
+    def wrapper(session, *args, **kwargs):
+        with session.tracer.operation(fn.__name__):
+            return fn(session, *args, **kwargs)
+
+    return wrapper
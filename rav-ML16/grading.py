@@ -1,7 +1,6 @@
 import os
 import re
 import sys
-import subprocess
 # Path to bbfetch repository
 sys.path += [os.path.expanduser('~/bbfetch')]
 import blackboard.grading
@@ -41,11 +40,6 @@ class Grading(blackboard.grading.Grading):
         return (int(self.get_student_group_display(student) or '0'),
                 student.name)
 
-    def extract_rar(self, filename):
-        subprocess.check_call(
-            ('/usr/bin/unrar', 'x', filename),
-            cwd=os.path.dirname(filename))
-
     def get_ml_feedback(self, attempt):
         """
         Compute (score, feedback_file) for given attempt, or (None, None)